@@ -1,7 +1,194 @@
+import os
+import re
+import json
+import time
+import sqlite3
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 import tornado.httputil
+import tornado.ioloop
+
+# ShowCard sends "(title) name <id>", the table endpoints send "id,id,id"
+CARD_REF = re.compile(r"<([0-9]+)>$")
+
+def card_ids_of(value):
+    if not value:
+        return []
+    m = CARD_REF.search(value)
+    if m:
+        return [int(m.group(1))]
+    return [int(x) for x in value.split(",") if x.isdigit()]
+
+def day_of(timestamp):
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+class SQLiteSink(object):
+    """ Appends events to a table, and keeps daily per-endpoint, per-card
+        and per-chara counts. Only ever used from the writer thread. """
+    def __init__(self, path):
+        self.path = path
+        self.hnd = None
+
+    def for_worker(self, task_id):
+        # SQLite does its own locking, so the workers can share the file.
+        return self
+
+    def connect(self):
+        hnd = sqlite3.connect(self.path, timeout=10)
+        hnd.execute("CREATE TABLE IF NOT EXISTS events (time REAL, endpoint TEXT, params TEXT)")
+        hnd.execute("CREATE TABLE IF NOT EXISTS counts (day TEXT, kind TEXT, key TEXT, n INTEGER, "
+                    "PRIMARY KEY (day, kind, key))")
+        return hnd
+
+    def write(self, events):
+        if self.hnd is None:
+            self.hnd = self.connect()
+
+        counts = Counter()
+        for ts, endpoint, params, cards, charas in events:
+            day = day_of(ts)
+            counts[(day, "endpoint", endpoint)] += 1
+            for card in cards:
+                counts[(day, "card", str(card))] += 1
+            for chara in charas:
+                counts[(day, "chara", chara)] += 1
+
+        with self.hnd:
+            self.hnd.executemany("INSERT INTO events VALUES (?, ?, ?)",
+                ((ts, endpoint, json.dumps(params, ensure_ascii=0) if params else None)
+                 for ts, endpoint, params, _, _ in events))
+            self.hnd.executemany("INSERT OR IGNORE INTO counts VALUES (?, ?, ?, 0)", counts.keys())
+            self.hnd.executemany("UPDATE counts SET n = n + ? WHERE day = ? AND kind = ? AND key = ?",
+                ((n,) + key for key, n in counts.items()))
+
+class NDJSONSink(object):
+    """ One JSON object per line. The file is rotated to path.1, path.2, ...
+        when it grows past max_bytes. Nothing is locked, so each worker
+        process has to get its own file (see for_worker). """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, keep=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+
+    def for_worker(self, task_id):
+        """ events.ndjson -> events.3.ndjson for worker 3. """
+        root, ext = os.path.splitext(self.path)
+        return NDJSONSink("{0}.{1}{2}".format(root, task_id, ext), self.max_bytes, self.keep)
+
+    def rotate(self):
+        for n in range(self.keep - 1, 0, -1):
+            src = "{0}.{1}".format(self.path, n)
+            if os.path.exists(src):
+                os.rename(src, "{0}.{1}".format(self.path, n + 1))
+        os.rename(self.path, self.path + ".1")
+
+    def write(self, events):
+        try:
+            if os.path.getsize(self.path) >= self.max_bytes:
+                self.rotate()
+        except OSError:
+            pass
+
+        with open(self.path, "a", encoding="utf8") as f:
+            f.write("".join(json.dumps({"time": ts, "endpoint": endpoint, "params": params,
+                                        "cards": cards, "charas": charas}, ensure_ascii=0) + "\n"
+                            for ts, endpoint, params, cards, charas in events))
+
+def sink_from_string(spec):
+    """ "sqlite:path/to/db" or "ndjson:path/to/file". None or "" means no sink. """
+    if not spec:
+        return None
+    kind, _, path = spec.partition(":")
+    if kind == "sqlite":
+        return SQLiteSink(path)
+    elif kind == "ndjson":
+        return NDJSONSink(path)
+    raise ValueError("unknown analytics sink '{0}'".format(kind))
 
 class Analytics(object):
-    """ Called by most endpoints. Log, analyze, whatever here. """
+    """ Called by most endpoints. Log, analyze, whatever here.
+
+        Events are counted in memory, then queued in a bounded buffer that a
+        writer thread drains into the sink every few seconds. Recording an
+        event never blocks: if the buffer is full because the sink can't
+        keep up, the event is dropped (and counted as such). """
+    def __init__(self, sink=None, capacity=8192, flush_interval=5):
+        self.sink = sink
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+
+        self.buffer = deque()
+        self.writer = ThreadPoolExecutor(1) if sink else None
+        self.pending_write = None
+        self.flusher = None
+
+        self.endpoints = Counter()
+        self.cards = Counter()
+        self.charas = Counter()
+
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.write_errors = 0
+
+    def for_worker(self, task_id):
+        """ Called in each worker after prefork.start, before any events are
+            written, so sinks that can't be shared get a file per process. """
+        if self.sink is not None:
+            self.sink = self.sink.for_worker(task_id)
+
     def analyze_request(self, request: tornado.httputil.HTTPServerRequest,
                         endpoint_class: str, cpar: dict = None):
-        pass
+        cards = card_ids_of(cpar.get("card_id")) if cpar else []
+        charas = [cpar["chara"]] if cpar and cpar.get("chara") else []
+
+        self.recorded += 1
+        self.endpoints[endpoint_class] += 1
+        self.cards.update(cards)
+        self.charas.update(charas)
+
+        if self.sink is None:
+            return
+
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self.buffer.append((time.time(), endpoint_class, cpar, cards, charas))
+
+        if self.flusher is None:
+            # Started here rather than in __init__, so that it's on the
+            # IOLoop the requests come from (and after any fork).
+            self.flusher = tornado.ioloop.PeriodicCallback(self.flush, self.flush_interval * 1000)
+            self.flusher.start()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.pending_write is not None and not self.pending_write.done():
+            # The sink is still busy with the last batch. Events pile up in
+            # the buffer until it's full, then get dropped.
+            return
+
+        batch = list(self.buffer)
+        self.buffer.clear()
+        self.pending_write = self.writer.submit(self.sink.write, batch)
+        tornado.ioloop.IOLoop.current().add_future(self.pending_write,
+            lambda f: self.write_done(f, len(batch)))
+
+    def write_done(self, future, n):
+        try:
+            future.result()
+        except Exception as e:
+            self.write_errors += 1
+            print("trace Analytics: sink write failed:", e)
+        else:
+            self.written += n
+
+    def stats(self):
+        return {
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "written": self.written,
+            "buffered": len(self.buffer),
+            "write_errors": self.write_errors,
+        }
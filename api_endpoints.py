@@ -1,20 +1,34 @@
 import tornado.web
 import tornado.template
 import tornado.escape
+import tornado.gen
 from dispatch import *
 import os
 import json
 import starlight
 import hashlib
+import hmac
+import math
 import base64
 import time
 import pytz
 import itertools
+import bisect
+import random
 import enums
 from datetime import datetime, timedelta
 from functools import partial
 import webutil
-import ipaddress
+import iprange
+from payloadcache import EncodedPayloadMixin, PAYLOADS, SELECTION_PAYLOADS, FORMATS, encode_object
+import payloadcache
+import msgpack
+import api_serializers
+import metrics
+import useragent
+import profiler
+import ratelimit
+import table
 
 class CORSBlessMixin(object):
     """ Implements HTTP OPTIONS to allow requests via XHR on modern browsers. """
@@ -29,7 +43,7 @@ class CORSBlessMixin(object):
 class TranslateReadAPI(CORSBlessMixin, tornado.web.RequestHandler):
     """ Queries database for cs translation entries """
 
-    @tornado.web.asynchronous
+    @tornado.gen.coroutine
     def post(self):
         self.set_cors_policy()
 
@@ -37,27 +51,154 @@ class TranslateReadAPI(CORSBlessMixin, tornado.web.RequestHandler):
             load = json.loads(self.request.body.decode("utf8"))
         except ValueError:
             self.set_status(400)
-            return self.finish()
+            return
         else:
             if not isinstance(load, list):
                 self.set_status(400)
-                return self.finish()
+                return
 
-        unique = list(set(load))
+        # Overlapping lookups from concurrent requests are merged; see tlbatch.
+        from_db = yield self.settings["tl_batcher"].lookup(load)
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        json.dump(from_db, self, ensure_ascii=0)
 
-        if not unique:
-            self.set_header("Content-Type", "application/json; charset=utf-8")
-            self.write("{}")
-            self.finish()
+@route("/api/private/read_tl_stats")
+class TranslateReadStats(tornado.web.RequestHandler):
+    def get(self):
+        self.write(self.settings["tl_batcher"].stats())
 
-        self.settings["tle"].translate(self.complete, *unique)
+@route("/api/private/version_check")
+class VersionCheckStatus(tornado.web.RequestHandler):
+    """ Times are UNIX timestamps. When running several processes, only the
+        leader's scheduler runs; the others say "stopped". """
+    def get(self):
+        status = self.settings["version_check"].status()
+        status["serving"] = str(starlight.data.version)
+        status["updating_to"] = starlight.updating_to_version
+        status["update_phase"] = starlight.update_phase
+        self.write(status)
+
+
+@conditional_route(os.environ.get("ENABLE_METRICS"),
+    "Metrics are off. Set ENABLE_METRICS=1 to serve /api/private/metrics.",
+    r"/api/private/metrics")
+class MetricsAPI(tornado.web.RequestHandler):
+    """ Prometheus text format. When running several processes, this only
+        describes the one that answered. """
+    def get(self):
+        tl = self.settings["tl_batcher"].stats()
+        ua = useragent.CLASSIFIER.stats()
+        an = self.settings["analytics"].stats()
+        gr = starlight.data.live_cache["gacha"].stats()
+        limits = [(name, limiter.stats()) for name, limiter in
+            (("ip", TranslateWriteAPI.IP_LIMITER), ("key", TranslateWriteAPI.KEY_LIMITER)) if limiter]
+        data = starlight.data
+
+        families = [
+            ("sparklebox_truth_version", "gauge", "The truth version being served.",
+                [((), data.version)]),
+            ("sparklebox_truth_age_seconds", "gauge", "Time since the current truth was loaded.",
+                [((), (datetime.utcnow() - data.load_date).total_seconds())]),
+            ("sparklebox_version_check_age_seconds", "gauge", "Time since the last version check.",
+                [((), time.time() - starlight.last_version_check if starlight.last_version_check else None)]),
+            ("sparklebox_data_cache_entries", "gauge", "Records loaded into DataCache.",
+                [((("cache", "card"),), len(data.card_cache)),
+                 ((("cache", "char"),), len(data.char_cache))]),
+            ("sparklebox_payload_cache_entries", "gauge", "Encoded responses in payloadcache.",
+                [((("cache", c.name),), len(c)) for c in payloadcache.CACHES]),
+            ("sparklebox_payload_cache_lookups_total", "counter", "payloadcache lookups.",
+                [((("cache", c.name), ("result", result)), count) for c in payloadcache.CACHES
+                 for result, count in (("hit", c.hits), ("miss", c.misses))]),
+            ("sparklebox_translation_keys_total", "counter",
+                "read_tl keys: requested by clients, queried from the database, and found there.",
+                [((("stage", "requested"),), tl["keys_requested"]),
+                 ((("stage", "queried"),), tl["keys_queried"]),
+                 ((("stage", "found"),), tl["keys_found"])]),
+            ("sparklebox_translation_hit_ratio", "gauge", "Fraction of queried read_tl keys that had a translation.",
+                [((), tl["keys_found"] / tl["keys_queried"] if tl["keys_queried"] else None)]),
+            ("sparklebox_translation_coalescing_ratio", "gauge", "read_tl keys requested per key queried.",
+                [((), tl["coalescing_ratio"])]),
+            ("sparklebox_user_agent_lookups_total", "counter", "How User-Agents were classified.",
+                [((("result", "cache_hit"),), ua["cache_hits"]),
+                 ((("result", "fast_path"),), ua["fast_path"]),
+                 ((("result", "parsed"),), ua["parsed"])]),
+            ("sparklebox_send_tl_rate_limit_total", "counter",
+                "send_tl submissions let through or refused by the per-IP and per-key limits.",
+                [((("by", name), ("result", result)), stats[result])
+                 for name, stats in limits for result in ("allowed", "limited")]),
+            ("sparklebox_send_tl_rate_limit_buckets", "gauge", "Rate limit buckets being tracked.",
+                [((("by", name),), stats["entries"]) for name, stats in limits]),
+            ("sparklebox_gacha_rate_lookups_total", "counter",
+                "Live gacha rate lookups: fresh, served stale while refreshing, missing, and waiting on another fetch.",
+                [((("result", "hit"),), gr["hits"]),
+                 ((("result", "stale"),), gr["stale_hits"]),
+                 ((("result", "miss"),), gr["misses"]),
+                 ((("result", "coalesced"),), gr["coalesced"])]),
+            ("sparklebox_gacha_rate_fetches_total", "counter", "Calls to the game API for gacha rates.",
+                [((("result", "started"),), gr["fetches"]),
+                 ((("result", "failed"),), gr["failures"]),
+                 ((("result", "timed_out"),), gr["timeouts"])]),
+            ("sparklebox_analytics_events_total", "counter",
+                "Analytics events: recorded, dropped because the sink fell behind, and written to the sink.",
+                [((("result", "recorded"),), an["recorded"]),
+                 ((("result", "dropped"),), an["dropped"]),
+                 ((("result", "written"),), an["written"])]),
+            ("sparklebox_analytics_buffered_events", "gauge", "Analytics events waiting to be written.",
+                [((), an["buffered"])]),
+            ("sparklebox_endpoint_hits_total", "counter", "Analyzed requests, by endpoint.",
+                [((("endpoint", name),), n) for name, n in sorted(self.settings["analytics"].endpoints.items())]),
+        ]
+
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.exposition(families))
+
+@conditional_route(os.environ.get("PROFILER_KEY"),
+    "The profiler is off. Set PROFILER_KEY to serve /api/private/profile.",
+    r"/api/private/profile")
+class ProfileAPI(tornado.web.RequestHandler):
+    """ Samples the IOLoop's stack at ?hz= for ?seconds=, across all requests,
+        and returns collapsed stacks grouped by handler. ?route=SkillTable
+        keeps only that handler's stacks. Requires ?key=$PROFILER_KEY.
+        When running several processes, only the one that answers is profiled. """
+    MAX_SECONDS = 300
+    MAX_HZ = 1000
+
+    @tornado.gen.coroutine
+    def get(self):
+        key = self.get_argument("key", "").encode("utf8")
+        if not hmac.compare_digest(key, os.environ.get("PROFILER_KEY", "").encode("utf8")):
+            self.set_status(403)
+            return
 
-    def complete(self, ret):
-        from_db = {tlo.key: tlo.english for tlo in ret if tlo.english != tlo.key}
-        self.set_header("Content-Type", "application/json; charset=utf-8")
-        json.dump(from_db, self, ensure_ascii=0)
-        self.finish()
+        try:
+            seconds = float(self.get_argument("seconds", 10))
+            hz = min(max(int(self.get_argument("hz", 100)), 1), self.MAX_HZ)
+        except ValueError:
+            self.set_status(400)
+            self.write("seconds and hz must be numbers")
+            return
+
+        # nan and inf would get through min() below.
+        if not math.isfinite(seconds) or seconds <= 0:
+            self.set_status(400)
+            self.write("seconds must be a positive number")
+            return
+        seconds = min(seconds, self.MAX_SECONDS)
 
+        session = profiler.start(hz)
+        if session is None:
+            self.set_status(409)
+            self.write("A profile is already being taken.")
+            return
+
+        try:
+            yield tornado.gen.sleep(seconds)
+        finally:
+            profiler.stop(session)
+
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.set_header("X-Profile-Samples", str(session.samples))
+        self.write(session.collapsed(self.get_argument("route", None)))
 
 @route("/api/v1/send_tl")
 class TranslateWriteAPI(tornado.web.RequestHandler):
@@ -67,29 +208,35 @@ class TranslateWriteAPI(tornado.web.RequestHandler):
 
     BAD_WORDS = ["undefined", "null", ""]
     BAD_RANGES = None
+    # "N/S": bursts of N submissions, refilling at N every S seconds.
+    IP_LIMITER = ratelimit.TokenBucketLimiter.from_env("SEND_TL_IP_RATE", "30/60")
+    KEY_LIMITER = ratelimit.TokenBucketLimiter.from_env("SEND_TL_KEY_RATE", "10/60")
 
     @classmethod
     def load_bad_ranges_file(cls):
-        br = set()
-        try:
-            with open(starlight.private_data_path("tlwrite_blocked_ranges.txt"), "r") as cf:
-                for line in cf:
-                    br.add(ipaddress.ip_network(line.strip()))
-        except OSError:
-            pass
-        cls.BAD_RANGES = br
+        # Reloaded automatically when the file changes.
+        cls.BAD_RANGES = iprange.IPRangeFile(starlight.private_data_path("tlwrite_blocked_ranges.txt"))
 
     def is_address_blocked(self, addr):
         if TranslateWriteAPI.BAD_RANGES is None:
             self.load_bad_ranges_file()
 
-        for net in TranslateWriteAPI.BAD_RANGES:
-            if ipaddress.ip_address(addr) in net:
-                return 1
+        return 1 if addr in TranslateWriteAPI.BAD_RANGES else 0
 
+    def rate_limited(self, limiter, key):
+        if limiter is None:
+            return 0
+        wait = limiter.take(key)
+        if wait:
+            self.set_status(429)
+            self.set_header("Retry-After", ratelimit.retry_after_header(wait))
+            return 1
         return 0
 
     def post(self):
+        if self.rate_limited(self.IP_LIMITER, self.request.remote_ip):
+            return
+
         try:
             load = json.loads(self.request.body.decode("utf8"))
         except ValueError:
@@ -112,6 +259,9 @@ class TranslateWriteAPI(tornado.web.RequestHandler):
             self.set_status(400)
             return
 
+        if self.rate_limited(self.KEY_LIMITER, key):
+            return
+
         # ** resets the string
         if s == "**":
             s = key
@@ -226,81 +376,115 @@ class APIUtilMixin(object):
                 yield obj
 
 @route(r"/api/v1/([a-z_]+)_t/(.+)")
-class ObjectAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
+class ObjectAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin, EncodedPayloadMixin):
     SELECTOR_ALL = object()
     SELECTOR_RANDOM = object()
 
-    def real_expand_spec(self, spec):
+    # Batches bigger than this are streamed out in pieces instead of
+    # going through the payload cache.
+    STREAM_THRESHOLD = 200
+    STREAM_BATCH_SIZE = 100
+    # Most ids one request can ask for, after duplicates are removed,
+    # unless there are more objects of that kind than this (for "all").
+    MAX_IDS = 1000
+
+    def id_index(self, kind):
+        return api_serializers.all_ids_of_kind(starlight.data, kind)
+
+    def resolve_selector(self, kind, selector, arg=None):
+        index = self.id_index(kind)
+
+        if selector is self.SELECTOR_ALL:
+            return list(index)
+        elif selector is self.SELECTOR_RANDOM:
+            return random.sample(index, min(arg, len(index)))
+
+    def real_expand_spec(self, kind, spec):
+        if spec == "all":
+            return self.resolve_selector(kind, self.SELECTOR_ALL)
+
+        if spec.startswith("random:"):
+            count = int(spec[7:])
+            if count < 1:
+                raise ValueError("random selector needs a positive count")
+            return self.resolve_selector(kind, self.SELECTOR_RANDOM, count)
+
+        if "-" in spec:
+            low, high = map(int, spec.split("-", 1))
+            if low > high:
+                raise ValueError("range {0} is backwards".format(spec))
+
+            index = self.id_index(kind)
+            return index[bisect.bisect_left(index, low):bisect.bisect_right(index, high)]
+
         return [ int(spec) ]
 
-    def expand_spec(self, spec):
-        comp = filter(bool, spec.split(","))
+    def expand_spec(self, kind, spec):
+        """ Returns (ids, is_random). Each id appears once, where it was
+            first asked for. """
+        comp = list(filter(bool, spec.split(",")))
+        if len(comp) > self.MAX_IDS:
+            raise ValueError("too many selectors, at most {0} can be used at once".format(self.MAX_IDS))
+
+        limit = max(self.MAX_IDS, len(self.id_index(kind)))
         real_spec = []
+        seen = set()
+        is_random = 0
         for component in comp:
-            real_spec.extend(self.real_expand_spec(component))
-        return real_spec
-
+            component = component.strip()
+            is_random |= component.startswith("random:")
+            for id in self.real_expand_spec(kind, component):
+                if id not in seen:
+                    seen.add(id)
+                    real_spec.append(id)
+            if len(real_spec) > limit:
+                raise ValueError("too many ids, at most {0} can be requested at once".format(limit))
+        return real_spec, is_random
+
+    @tornado.gen.coroutine
     def get(self, objectid, spec):
         self.set_cors_policy()
 
         try:
-            ids = self.expand_spec(spec)
+            ids, is_random = self.expand_spec(objectid, spec)
         except Exception as e:
             self.set_status(400)
             self.write({"error": str(e)})
             return
 
-        self.do_object_request(objectid, ids)
+        # A random pick would never be asked for again, so don't cache it.
+        yield self.do_object_request(objectid, ids, cacheable=not is_random)
 
-    def collect_chars(self, ids, cfg):
-        result = []
-        for char in starlight.data.charas(ids):
-            if hasattr(char, "_asdict"):
-                d = self.fix_namedtuples(char.__class__.__name__, char._asdict(), cfg)
-                result.append(d)
-            else:
-                result.append(char)
+    def collect(self, objects, cfg):
+        serializers = api_serializers.serializers_for(starlight.data.version,
+            self.settings["image_host"])
+        return serializers.serialize_all(objects, cfg["projection"])
 
-        return result
+    def collect_chars(self, ids, cfg):
+        return self.collect(starlight.data.charas(ids), cfg)
 
     def collect_skill(self, ids, cfg):
-        result = []
-        for skill in starlight.data.skills(ids):
-            if hasattr(skill, "_asdict"):
-                d = self.fix_namedtuples(skill.__class__.__name__, skill._asdict(), cfg)
-                result.append(d)
-            else:
-                result.append(skill)
-
-        return result
+        return self.collect(starlight.data.skills(ids), cfg)
 
     def collect_lskill(self, ids, cfg):
-        result = []
-        for skill in starlight.data.lead_skills(ids):
-            if hasattr(skill, "_asdict"):
-                d = self.fix_namedtuples(skill.__class__.__name__, skill._asdict(), cfg)
-                result.append(d)
-            else:
-                result.append(skill)
-
-        return result
+        return self.collect(starlight.data.lead_skills(ids), cfg)
 
     def collect_cards(self, ids, cfg):
-        result = []
-        for card in starlight.data.cards(ids):
-            if hasattr(card, "_asdict"):
-                d = self.fix_namedtuples(card.__class__.__name__, card._asdict(), cfg)
-                result.append(d)
-            else:
-                result.append(card)
+        return self.collect(starlight.data.cards(ids), cfg)
 
-        return result
-
-    def do_object_request(self, kind, ids):
+    @tornado.gen.coroutine
+    def do_object_request(self, kind, ids, cacheable=1):
         cfg = {
             "stubs": self.get_argument("stubs", "no"),
             "datetime": self.get_argument("datetime", "unix")
         }
+        # ?fields=a,b,c only serializes those keys. ?expand=chara,skill says which
+        # nested records are included in full instead of as refs; if it's not
+        # given, stubs=yes means none of them, and stubs=no means all of them.
+        cfg["projection"] = api_serializers.make_projection(
+            self.get_argument("fields", None),
+            self.get_argument("expand", None),
+            cfg["stubs"] == "yes")
         handlers = {"card": self.collect_cards,
                     "char": self.collect_chars,
                     "skill": self.collect_skill,
@@ -312,77 +496,230 @@ class ObjectAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
             self.write({"error": "you requested an unknown object type '{0}_t'".format(kind)})
             return
 
-        self.set_header("Content-Type", "application/json; charset=utf-8")
-        if self.settings["is_dev"]:
-            json.dump({"result": h(ids, cfg)}, self, ensure_ascii=0, sort_keys=1, indent=2)
+        if len(ids) > self.STREAM_THRESHOLD:
+            yield self.stream_objects(h, ids, cfg)
+            return
+
+        if not cacheable:
+            self.write_object({"result": h(ids, cfg)})
+            return
+
+        key = ("object", kind, tuple(ids), cfg["projection"], cfg["datetime"])
+        self.write_cached_object(starlight.data.version, key, lambda: {"result": h(ids, cfg)},
+            cache=SELECTION_PAYLOADS)
+
+    @tornado.gen.coroutine
+    def stream_objects(self, h, ids, cfg):
+        """ Writes {"result": [...]} a batch of objects at a time, so big
+            selections like "all" don't have to be encoded in one piece. """
+        fmt = self.response_format()
+        self.set_header("Content-Type", FORMATS[fmt])
+        self.add_header("Vary", "Accept")
+
+        if fmt == "msgpack":
+            packer = msgpack.Packer(use_bin_type=True)
+            self.write(packer.pack_map_header(1) + packer.pack("result") +
+                packer.pack_array_header(len(ids)))
         else:
-            json.dump({"result": h(ids, cfg)}, self, ensure_ascii=0)
+            encode = partial(encode_object, fmt="json", pretty=self.settings["is_dev"])
+            self.write('{"result": [')
+
+        for start in range(0, len(ids), self.STREAM_BATCH_SIZE):
+            objects = h(ids[start:start + self.STREAM_BATCH_SIZE], cfg)
+            if fmt == "msgpack":
+                self.write(b"".join(map(packer.pack, objects)))
+            else:
+                self.write(("," if start else "") + ",".join(map(encode, objects)))
+            yield self.flush()
+
+        self.finish(b"" if fmt == "msgpack" else "]}")
 
 @route(r"/api/v1/list/card_t")
-class CardListAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
+class CardListAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin, EncodedPayloadMixin):
     KEYS = ["id", "chara_id", "attribute", "has_spread", "pose", "title", "name_only",
         "hp_min", "hp_max", "vocal_min", "vocal_max", "visual_min", "visual_max",
         "dance_min", "dance_max", "bonus_hp", "bonus_dance", "bonus_vocal", "bonus_visual",
         "evolution_id"]
     STRUCTS = ["rarity_dep"]
 
-    def stub_object(self, obj, user_want_keys):
+    @classmethod
+    def stub_object(cls, obj, user_want_keys):
         base = {}
 
-        user_want_keys = user_want_keys or (self.KEYS + self.STRUCTS)
+        user_want_keys = user_want_keys or (cls.KEYS + cls.STRUCTS)
 
-        for key in self.KEYS:
+        for key in cls.KEYS:
             if key in user_want_keys:
                 base[key] = getattr(obj, key)
 
-        for key in self.STRUCTS:
+        # STRUCTS are flat records (no nested namedtuples and no EXTEND_FUNC),
+        # so fix_namedtuples would just hand back _asdict() anyway.
+        for key in cls.STRUCTS:
             if key in user_want_keys:
-                ob = getattr(obj, key)
-                base[key] = self.fix_namedtuples(ob.__class__.__name__, ob._asdict(), {"stubs": "no"})
+                base[key] = dict(getattr(obj, key)._asdict())
 
-        self.post_stubbing(base, obj)
+        cls.post_stubbing(base, obj)
 
         base.update(APIUtilMixin.stub_object(obj))
         return base
 
-    def post_stubbing(self, base, obj):
+    @classmethod
+    def post_stubbing(cls, base, obj):
         base["conventional"] = obj.chara.conventional
         base["chara"] = APIUtilMixin.stub_object(obj.chara)
 
-    def list_objects(self):
+    @classmethod
+    def list_objects(cls):
         return starlight.data.cards([chain[0] for _, chain in starlight.data.id_chain.items()])
 
+    @staticmethod
+    def normalize_keys(ks_raw):
+        """ Order and case of ?keys= don't matter, so fold them into one cache key. """
+        return tuple(sorted(set(filter(bool, (x.lower().strip() for x in ks_raw.split(","))))))
+
+    @classmethod
+    def payload_key(cls, normalized):
+        return ("list", cls.__name__, normalized)
+
+    @classmethod
+    def list_payload(cls, normalized):
+        f = partial(cls.stub_object, user_want_keys=list(normalized))
+        return {"result": list(map(f, cls.list_objects()))}
+
+    @classmethod
+    def prewarm(cls, is_dev):
+        """ Serialize the default (all keys) JSON listing ahead of the first
+            request, and pin it so other responses can't evict it. """
+        PAYLOADS.get_or_encode(starlight.data.version, cls.payload_key(()),
+            partial(cls.list_payload, ()), "json", is_dev, pin=1)
+
     def get(self):
         self.set_cors_policy()
 
-        ks_raw = self.get_argument("keys", "")
-        if ks_raw:
-            normalized = (x.lower().strip() for x in ks_raw.split(","))
-        else:
-            normalized = ""
-        f = partial(self.stub_object, user_want_keys=list(normalized))
-        roots = map(f, self.list_objects())
-
-        self.set_header("Content-Type", "application/json; charset=utf-8")
-        if self.settings["is_dev"]:
-            json.dump({"result": list(roots)}, self, ensure_ascii=0, sort_keys=1, indent=2)
-        else:
-            json.dump({"result": list(roots)}, self, ensure_ascii=0)
+        normalized = self.normalize_keys(self.get_argument("keys", ""))
+        self.write_cached_object(starlight.data.version, self.payload_key(normalized),
+            partial(self.list_payload, normalized))
 
 @route(r"/api/v1/list/char_t")
 class CharListAPI(CardListAPI):
     KEYS = ["chara_id", "conventional", "kanji_spaced", "kana_spaced"]
     STRUCTS = []
 
-    def list_objects(self):
+    @classmethod
+    def list_objects(cls):
         # TODO proper way to get all charids
         return starlight.data.charas(starlight.data.all_chara_id_to_cards())
 
-    def post_stubbing(self, base, obj):
+    @classmethod
+    def post_stubbing(cls, base, obj):
         base["cards"] = starlight.data.cards_belonging_to_char(obj.chara_id)
 
+@route(r"/api/v1/export/([a-z_]+)\.ndjson")
+class ExportAPI(CORSBlessMixin, HandlerSyncedWithMaster):
+    """ Dumps every record of a kind, one JSON object per line, in the same
+        format as ObjectAPI. With ?since_version=, only records that changed
+        since that truth version are sent, followed by a {key: ..., "deleted": true}
+        line for each record that no longer exists. """
+    BATCH_SIZE = 100
+
+    @tornado.gen.coroutine
+    def get(self, kind):
+        self.set_cors_policy()
+
+        if kind not in api_serializers.KINDS:
+            self.set_status(400)
+            self.write({"error": "you requested an unknown object type '{0}_t'".format(kind)})
+            return
+
+        version = starlight.data.version
+        since = self.get_argument("since_version", None)
+        image_host = self.settings["image_host"]
+
+        if since is not None:
+            try:
+                since = str(int(since))
+            except ValueError:
+                self.set_status(400)
+                self.write({"error": "since_version must be a truth version number"})
+                return
+
+            if since != str(version) and not api_serializers.truth_available(since):
+                self.set_status(400)
+                self.write({"error": "truth version {0} is not available".format(since)})
+                return
+
+        self.set_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.set_header("Etag", '"{0}-{1}-{2}"'.format(kind, version, since or "all"))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        deleted = []
+        if since is None:
+            ids = api_serializers.all_ids_of_kind(starlight.data, kind)
+        elif since == str(version):
+            ids = []
+        else:
+            ids, deleted = yield api_serializers.diff_executor.submit(
+                api_serializers.changed_records, since, str(version), kind, image_host)
+
+        serializers = api_serializers.serializers_for(version, image_host)
+        for start in range(0, len(ids), self.BATCH_SIZE):
+            objects = api_serializers.load_records(starlight.data, kind, ids[start:start + self.BATCH_SIZE])
+            self.write("".join(json.dumps(d, ensure_ascii=0) + "\n"
+                for d in serializers.serialize_all(objects, api_serializers.FULL) if d is not None))
+            yield self.flush()
+
+        key_field = api_serializers.KINDS[kind][2]
+        self.finish("".join(json.dumps({key_field: key, "deleted": True}) + "\n" for key in deleted))
+
+@route(r"/api/v1/card_table/(all|skill|lead_skill)")
+class CardTableAPI(CORSBlessMixin, HandlerSyncedWithMaster, EncodedPayloadMixin):
+    """ The JSON sibling of /skill_table and /lead_skill_table. It takes the
+        same filter, sort and page arguments (see table.parse_query), plus
+        fields= and expand= like ObjectAPI, and always paginates. """
+    def get(self, base):
+        self.set_cors_policy()
+
+        try:
+            query = table.parse_query(self.get_argument) or \
+                table.table_query_t((), None, 1, None, None)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"error": str(e)})
+            return
+
+        if query.page is None:
+            query = query._replace(page=1, per_page=table.DEFAULT_PER_PAGE)
+
+        plus = self.get_argument("plus", "NO") == "YES"
+        projection = api_serializers.make_projection(
+            self.get_argument("fields", None),
+            self.get_argument("expand", ""), 1)
+
+        def make_object():
+            cards = table.base_cards(base)
+            if plus:
+                cards = map(lambda card: starlight.data.card(starlight.data.chain(card.series_id)[-1]), cards)
+
+            cards, page_info = table.card_index().select(cards, query, (base, plus))
+            serializers = api_serializers.serializers_for(starlight.data.version,
+                self.settings["image_host"])
+
+            ret = dict(page_info._asdict())
+            ret["result"] = serializers.serialize_all(cards, projection)
+            return ret
+
+        key = ("card_table", base, plus, query, projection)
+        self.write_cached_object(starlight.data.version, key, make_object,
+            cache=SELECTION_PAYLOADS)
+
+def prewarm_list_payloads(is_dev):
+    for cls in (CardListAPI, CharListAPI):
+        cls.prewarm(is_dev)
+
 @route(r"/api/v1/happening/(now|-?[0-9]+)")
-class HappeningAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
+class HappeningAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin, EncodedPayloadMixin):
     def fix_datetime(self, obj):
         if isinstance(obj, datetime):
             fmt = self.get_argument("datetime", "unix")
@@ -396,7 +733,8 @@ class HappeningAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
     def get(self, timespec):
         self.set_cors_policy()
 
-        if timespec == "now":
+        is_now = timespec == "now"
+        if is_now:
             timespec = datetime.utcnow()
         else:
             try:
@@ -413,31 +751,31 @@ class HappeningAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
             "datetime": self.get_argument("datetime", "unix")
         }
 
-        self.set_header("Content-Type", "application/json; charset=utf-8")
-        payload = self.fix_namedtuples("",
-            {"events": starlight.data.events(timespec),
-             "gachas": starlight.data.gachas(timespec)}, cfg)
-        if self.settings["is_dev"]:
-            json.dump(payload, self, ensure_ascii=0, sort_keys=1, indent=2, default=self.fix_datetime)
+        def make_object():
+            return self.fix_namedtuples("",
+                {"events": starlight.data.events(timespec),
+                 "gachas": starlight.data.gachas(timespec)}, cfg)
+
+        if is_now:
+            self.write_object(make_object(), self.fix_datetime)
         else:
-            json.dump(payload, self, ensure_ascii=0, default=self.fix_datetime)
+            key = ("happening", timespec, cfg["stubs"], cfg["datetime"])
+            self.write_cached_object(starlight.data.version, key, make_object, self.fix_datetime,
+                cache=SELECTION_PAYLOADS)
 
 @route(r"/api/v1/info")
-class InformationAPI(CORSBlessMixin, HandlerSyncedWithMaster):
+class InformationAPI(CORSBlessMixin, HandlerSyncedWithMaster, EncodedPayloadMixin):
     def get(self):
         self.set_cors_policy()
-        self.set_header("Content-Type", "application/json; charset=utf-8")
 
-        payload = {
-            "truth_version": starlight.data.version,
-            "api_major": 1,
-            "api_revision": 4,
-        }
+        def make_object():
+            return {
+                "truth_version": starlight.data.version,
+                "api_major": 1,
+                "api_revision": 5,
+            }
 
-        if self.settings["is_dev"]:
-            json.dump(payload, self, ensure_ascii=0, sort_keys=1, indent=2)
-        else:
-            json.dump(payload, self, ensure_ascii=0)
+        self.write_cached_object(starlight.data.version, ("info",), make_object)
 
 @route(r"/api/private/va_table")
 class VATable(HandlerSyncedWithMaster):
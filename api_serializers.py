@@ -0,0 +1,255 @@
+""" Per-record-type serializers for ObjectAPI.
+
+    APIUtilMixin.fix_namedtuples works for any object, but it has to inspect
+    every field of every record on every request. The record types that
+    ObjectAPI hands out are fixed, so we describe each output key of each of
+    them once, and build serializers that compute only the keys a request
+    asked for. Full serializations are remembered, since they can't change
+    until the next truth version. With no projection, the output is the same
+    as fix_namedtuples + EXTEND_FUNC. """
+
+import os
+import json
+import hashlib
+import operator
+from functools import lru_cache
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import enums
+import starlight
+
+RECORD_TO_API = {"chara_data_t": "char_t",
+                 "skill_data_t": "skill_t",
+                 "leader_skill_data_t": "leader_skill_t",
+                 "card_data_t": "card_t"}
+
+# kind (as in /api/v1/<kind>_t) -> (DataCache id index, DataCache loader, key field)
+KINDS = {"card": ("all_card_ids", "cards", "id"),
+         "char": ("all_chara_ids", "charas", "chara_id"),
+         "skill": ("all_skill_ids", "skills", "id"),
+         "leader_skill": ("all_lead_skill_ids", "lead_skills", "id")}
+
+# Output keys that hold another record. Unless they're expanded, they're
+# replaced with a ref (or for rarity, which has no endpoint, the raw value).
+EXPANDABLE = {"chara", "skill", "lead_skill", "rarity"}
+
+# fields=None means every field.
+projection_t = namedtuple("projection_t", ("fields", "expand"))
+FULL = projection_t(None, frozenset(EXPANDABLE))
+STUBS = projection_t(None, frozenset(("rarity",)))
+
+def make_projection(fields, expand, stubs):
+    """ Build a projection_t from the comma-separated fields= and expand=
+        arguments. Without expand=, the legacy stubs= argument decides. """
+    if fields:
+        fields = frozenset(filter(bool, (x.strip() for x in fields.split(","))))
+    else:
+        fields = None
+
+    if expand is not None:
+        expand = frozenset(x.strip() for x in expand.split(",")) & EXPANDABLE
+    elif stubs:
+        expand = STUBS.expand
+    else:
+        expand = FULL.expand
+
+    return projection_t(fields, expand)
+
+def record_key(obj):
+    if obj.__class__.__name__ == "chara_data_t":
+        return obj.chara_id
+    return obj.id
+
+def record_ref(obj):
+    return {"ref": "/api/v1/{0}/{1}".format(RECORD_TO_API[obj.__class__.__name__], record_key(obj))}
+
+def field_getters(the_type, transforms, skip=()):
+    """ (key, getter) for each field of the_type, in order. Fields named in
+        `transforms` are passed through the associated function. """
+    ret = []
+    for index, field in enumerate(the_type._fields):
+        if field in skip:
+            continue
+
+        get = operator.itemgetter(index)
+        func = transforms.get(field)
+        if func:
+            get = (lambda get, func: lambda obj: func(get(obj)))(get, func)
+        ret.append((field, get))
+    return ret
+
+def compile_table(table, fields):
+    if fields is not None:
+        table = [(k, get) for k, get in table if k in fields]
+
+    def serialize(obj):
+        return {k: get(obj) for k, get in table}
+    return serialize
+
+class SerializerSet(object):
+    """ Serializers and their output for one (truth version, image host) pair. """
+    def __init__(self, version, image_host):
+        self.version = version
+        self.image_host = image_host
+
+        self.compiled = {}
+        self.memo = {}
+
+    def serialize(self, obj, projection):
+        if obj is None:
+            return None
+
+        if projection.fields is not None:
+            return self.serializer_for(obj.__class__, projection)(obj)
+
+        memo_key = (obj.__class__.__name__, record_key(obj), projection.expand)
+        ret = self.memo.get(memo_key)
+        if ret is None:
+            ret = self.memo[memo_key] = self.serializer_for(obj.__class__, projection)(obj)
+        return ret
+
+    def serialize_all(self, objects, projection):
+        return [self.serialize(obj, projection) for obj in objects]
+
+    def serializer_for(self, the_type, projection):
+        compiled = self.compiled.get((the_type, projection))
+        if compiled is None:
+            table = getattr(self, "table_" + the_type.__name__)(the_type, projection.expand)
+            compiled = self.compiled[(the_type, projection)] = compile_table(table, projection.fields)
+        return compiled
+
+    def nested(self, key, expand):
+        if key in expand:
+            return lambda obj: self.serialize(obj, FULL)
+        else:
+            return lambda obj: record_ref(obj) if obj is not None else None
+
+    def table_card_data_t(self, the_type, expand):
+        sign_fmt = "/".join((self.image_host, "sign", "{0}.png"))
+        spread_fmt = "/".join((self.image_host, "spread", "{0}.png"))
+        card_fmt = "/".join((self.image_host, "card", "{0}.png"))
+        sprite_fmt = "/".join((self.image_host, "chara2", "{0}", "{1}.png"))
+        icon_fmt = "/".join((self.image_host, "icon_card", "{0}.png"))
+
+        table = field_getters(the_type, {
+            "chara": self.nested("chara", expand),
+            "skill": self.nested("skill", expand),
+            "lead_skill": self.nested("lead_skill", expand),
+            "valist": list,
+            "attribute": enums.api_char_type,
+        }, skip=("rarity_dep",))
+
+        if "rarity" in expand:
+            rarity_dep = lambda card: dict(card.rarity_dep._asdict()) if card.rarity_dep is not None else None
+            table = [(k, rarity_dep if k == "rarity" else get) for k, get in table]
+
+        table.extend([
+            ("sign_image_ref", lambda card: sign_fmt.format(card.id) if card.has_sign else None),
+            ("spread_image_ref", lambda card: spread_fmt.format(card.id) if card.has_spread else None),
+            ("card_image_ref", lambda card: card_fmt.format(card.id)),
+            ("sprite_image_ref", lambda card: sprite_fmt.format(card.chara_id, card.pose)),
+            ("icon_image_ref", lambda card: icon_fmt.format(card.id)),
+        ])
+        return table
+
+    def table_chara_data_t(self, the_type, expand):
+        icon_fmt = "/".join((self.image_host, "icon_char", "{0}.png"))
+
+        table = field_getters(the_type, {
+            "type": enums.api_char_type,
+            "valist": list,
+        })
+        table.append(("icon_image_ref", lambda chara: icon_fmt.format(chara.chara_id)))
+        return table
+
+    def table_skill_data_t(self, the_type, expand):
+        def effect_length(skill):
+            duration = skill.dur.args[0][skill.available_time_type]
+            return [duration.available_time_min, duration.available_time_max]
+
+        def proc_chance(skill):
+            chance = skill.chance.args[0][skill.probability_type]
+            return [chance.probability_min, chance.probability_max]
+
+        table = field_getters(the_type, {
+            "skill_type": enums.skill_type,
+        }, skip=("available_time_type", "probability_type", "chance", "dur"))
+        table.extend([
+            ("explain_en", starlight.en.describe_skill),
+            ("skill_type_id", operator.attrgetter("skill_type")),
+            ("effect_length", effect_length),
+            ("proc_chance", proc_chance),
+        ])
+        return table
+
+    def table_leader_skill_data_t(self, the_type, expand):
+        table = field_getters(the_type, {
+            "target_attribute": enums.lskill_target_attr,
+            "target_param": enums.lskill_target_param,
+            "target_attribute_2": enums.lskill_target_attr,
+            "target_param_2": enums.lskill_target_param,
+        })
+        table.append(("explain_en", starlight.en.describe_lead_skill))
+        return table
+
+_current = None
+
+def serializers_for(version, image_host):
+    global _current
+
+    if _current is None or _current.version != version or _current.image_host != image_host:
+        _current = SerializerSet(version, image_host)
+    return _current
+
+def all_ids_of_kind(data, kind):
+    if kind not in KINDS:
+        raise ValueError("you requested an unknown object type '{0}_t'".format(kind))
+    return getattr(data, KINDS[kind][0])()
+
+def load_records(data, kind, ids):
+    return getattr(data, KINDS[kind][1])(ids)
+
+def record_digests(data, kind, image_host, batch_size=100):
+    """ {record key: digest of its full serialization} for every record of
+        `kind` in DataCache `data`. """
+    serializers = SerializerSet(data.version, image_host)
+    ids = all_ids_of_kind(data, kind)
+    digests = {}
+
+    for start in range(0, len(ids), batch_size):
+        for obj in load_records(data, kind, ids[start:start + batch_size]):
+            if obj is None:
+                continue
+            blob = json.dumps(serializers.serialize(obj, FULL), sort_keys=1, ensure_ascii=0)
+            digests[record_key(obj)] = hashlib.sha1(blob.encode("utf8")).digest()
+    return digests
+
+def truth_available(version):
+    return os.path.exists(starlight.transient_data_path("{0}.mdb".format(version)))
+
+# Diffing two truth versions reads every record of both, so it's done here
+# instead of on the IOLoop.
+diff_executor = ThreadPoolExecutor(1)
+
+@lru_cache(8)
+def version_digests(version, kind, image_host):
+    """ record_digests for a truth version, read from a DataCache that's
+        opened just for this and dropped afterwards. Run on diff_executor. """
+    data = starlight.DataCache(version)
+    try:
+        return record_digests(data, kind, image_host)
+    finally:
+        data.hnd.close()
+
+@lru_cache(16)
+def changed_records(old_version, new_version, kind, image_host):
+    """ Compares every record of `kind` between two truth versions. Returns
+        (changed or new keys, deleted keys), sorted. Run on diff_executor. """
+    if not truth_available(old_version):
+        raise ValueError("truth version {0} is not available".format(old_version))
+    old = version_digests(str(old_version), kind, image_host)
+    new = version_digests(str(new_version), kind, image_host)
+
+    changed = sorted(k for k, digest in new.items() if old.get(k) != digest)
+    deleted = sorted(set(old) - set(new))
+    return changed, deleted
@@ -1,16 +1,19 @@
+import time
+STARTED = time.perf_counter()
+
 import locale
 locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
+import tornado.template
 import os
+import sys
 import tornado.options
 import json
-import ipaddress
 import functools
 import subprocess
-import user_agents
 from collections import namedtuple
 
 import models
@@ -20,7 +23,13 @@ import api_endpoints
 import enums
 import starlight
 import analytics
+import tlbatch
 import webutil
+import iprange
+import useragent
+import prefork
+import metrics
+import warmup
 from starlight import private_data_path
 
 def early_init():
@@ -36,21 +45,15 @@ def early_init():
         tornado.web.RequestHandler.prepare = _swizzle_RequestHandler_prepare
 
     if os.environ.get("BEHIND_CLOUDFLARE") == "1":
-        cloudflare_ranges = []
-
-        with open("cloudflare.txt", "r") as cf:
-            for line in cf:
-                cloudflare_ranges.append(ipaddress.ip_network(line.strip()))
+        cloudflare_ranges = iprange.IPRangeFile("cloudflare.txt")
 
         _super_RequestHandler_prepare2 = tornado.web.RequestHandler.prepare
 
         def _swizzle_RequestHandler_prepare2(self):
-            for net in cloudflare_ranges:
-                if ipaddress.ip_address(self.request.remote_ip) in net:
-                    if "CF-Connecting-IP" in self.request.headers:
-                        self.request.remote_ip = self.request.headers[
-                            "CF-Connecting-IP"]
-                    break
+            if self.request.remote_ip in cloudflare_ranges:
+                if "CF-Connecting-IP" in self.request.headers:
+                    self.request.remote_ip = self.request.headers[
+                        "CF-Connecting-IP"]
             _super_RequestHandler_prepare2(self)
 
         tornado.web.RequestHandler.prepare = _swizzle_RequestHandler_prepare2
@@ -59,38 +62,95 @@ def early_init():
     def _swizzle_RequestHandler_prepare3(self):
         self.request.is_low_bandwidth = 0
         if "User-Agent" in self.request.headers:
-            ua = user_agents.parse(self.request.headers["User-Agent"])
-            if ua.is_mobile or ua.is_tablet:
-                self.request.is_low_bandwidth = 1
+            self.request.is_low_bandwidth = useragent.CLASSIFIER.is_low_bandwidth(
+                self.request.headers["User-Agent"])
 
         _super_RequestHandler_prepare3(self)
     tornado.web.RequestHandler.prepare = _swizzle_RequestHandler_prepare3
 
+tornado.options.define("startup_benchmark", default=False, type=bool,
+    help="Start up, report how long each phase took, and exit.")
+tornado.options.define("warm_up", default=True, type=bool,
+    help="Compile templates and prime caches before serving.")
+
 def main():
-    starlight.init()
+    timer = warmup.StartupTimer(STARTED)
+    timer.mark("imports")
+    options = tornado.options.options
+    args = tornado.options.parse_command_line()
+
+    with timer.phase("truth"):
+        starlight.init(args)
     early_init()
+    extra_settings = {}
+    if os.environ.get("ENABLE_METRICS"):
+        metrics.install()
+        extra_settings["log_function"] = metrics.log_request
     in_dev_mode = os.environ.get("DEV")
     image_server = os.environ.get("IMAGE_HOST", "")
-    tornado.options.parse_command_line()
+    template_loader = tornado.template.Loader("webui")
     application = tornado.web.Application(dispatch.ROUTES,
         template_path="webui",
+        template_loader=template_loader,
         static_path="static",
         image_host=image_server,
         debug=in_dev_mode,
         is_dev=in_dev_mode,
 
         tle=models.TranslationEngine(starlight),
+        tl_batcher=tlbatch.TranslationBatcher(),
         enums=enums,
         starlight=starlight,
         tlable=webutil.tlable,
         webutil=webutil,
-        analytics=analytics.Analytics())
+        version_check=starlight.versioncheck.VersionCheckScheduler(starlight.check_version,
+            interval=int(os.environ.get("VERSION_CHECK_INTERVAL", 3600)),
+            jitter=int(os.environ.get("VERSION_CHECK_JITTER", 60)),
+            abandon=starlight.abandon_update),
+        analytics=analytics.Analytics(analytics.sink_from_string(os.environ.get("ANALYTICS_SINK"))),
+        **extra_settings)
     http_server = tornado.httpserver.HTTPServer(application, xheaders=1)
+    timer.mark("app")
+
+    if options.warm_up:
+        with timer.phase("templates"):
+            warmup.compile_templates(template_loader, "webui")
+        with timer.phase("data"):
+            starlight.data.warm_up()
+
+    prewarm = functools.partial(api_endpoints.prewarm_list_payloads, in_dev_mode)
+    starlight.data_switch_listeners.append(prewarm)
+    with timer.phase("payloads"):
+        prewarm()
 
     addr = os.environ.get("ADDRESS", "0.0.0.0")
     port = int(os.environ.get("PORT", 5000))
 
-    http_server.listen(port, addr)
+    # PROCESSES=0 starts one worker per CPU.
+    processes = int(os.environ.get("PROCESSES", 1))
+    if in_dev_mode and processes != 1:
+        # autoreload needs the IOLoop before we'd get a chance to fork.
+        print("DEV is set, so PROCESSES is ignored.")
+        processes = 1
+    if options.startup_benchmark and processes != 1:
+        print("--startup-benchmark only measures one process, so PROCESSES is ignored.")
+        processes = 1
+
+    with timer.phase("listen"):
+        if processes == 1:
+            http_server.listen(port, addr)
+        else:
+            task_id = prefork.start(processes, http_server, port, addr)
+            application.settings["analytics"].for_worker(task_id)
+
+    timer.report()
+    if options.startup_benchmark:
+        sys.exit(0)
+
+    # After forking, so only the leader checks.
+    if starlight.check_version_enabled and starlight.apiclient.is_usable():
+        application.settings["version_check"].start()
+
     print("Current APP_VER:", os.environ.get("VC_APP_VER",
         "1.9.1 (warning: Truth updates will fail in the future if an accurate VC_APP_VER "
         "is not set. Export VC_APP_VER to suppress this warning.)"))
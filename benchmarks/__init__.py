@@ -0,0 +1,27 @@
+""" Micro-benchmarks. Run them from the repository root, e.g.
+
+        python3 -m benchmarks.object_api
+
+    Benchmarks that need truth data load it the same way app.py does, so
+    the same environment variables apply. """
+
+import time
+
+def measure(func, min_time=0.5):
+    """ Calls func repeatedly for at least min_time seconds.
+        Returns the average time per call, in seconds. """
+    n = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time:
+        func()
+        n += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / n
+
+def report(label, seconds, items=None):
+    if items:
+        print("{0:<40} {1:>10.1f} us/call {2:>12.0f} items/s".format(
+            label, seconds * 1e6, items / seconds))
+    else:
+        print("{0:<40} {1:>10.1f} us/call".format(label, seconds * 1e6))
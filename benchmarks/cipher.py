@@ -0,0 +1,47 @@
+""" AES-CBC backends for apiclient: runs the known-answer tests against every
+    backend that's installed, checks they agree with the old pyaes
+    Encrypter/Decrypter code, then times a version-check-sized message.
+
+        python3 -m benchmarks.cipher """
+
+import os
+import pyaes
+from starlight import cipher
+from benchmarks import measure, report
+
+# Roughly what ApiClient.call encrypts and gets back for /load/check.
+MESSAGE_SIZE = 512
+
+def old_encrypt_cbc(s, iv, key):
+    # what apiclient.encrypt_cbc used to be
+    e = pyaes.Encrypter(pyaes.AESModeOfOperationCBC(key, iv))
+    return e.feed(s) + e.feed()
+
+def old_decrypt_cbc(s, iv, key):
+    e = pyaes.Decrypter(pyaes.AESModeOfOperationCBC(key, iv))
+    return e.feed(s) + e.feed()
+
+def main():
+    key, iv = os.urandom(32), os.urandom(16)
+    message = os.urandom(MESSAGE_SIZE - 7)
+    expect = old_encrypt_cbc(message, iv, key)
+    assert old_decrypt_cbc(expect, iv, key) == message
+
+    backends = cipher.available_backends()
+    print("installed:", ", ".join(b.name for b in backends), "- selected:", cipher.BACKEND.name)
+
+    for backend in backends:
+        cipher.selftest(backend)
+        assert cipher.unpad(backend.decrypt(expect, iv, key)) == message, backend.name
+        assert backend.encrypt(cipher.pad(message), iv, key) == expect, backend.name
+
+        report("{0} encrypt {1} bytes".format(backend.name, MESSAGE_SIZE),
+            measure(lambda: backend.encrypt(cipher.pad(message), iv, key)), MESSAGE_SIZE)
+        report("{0} decrypt {1} bytes".format(backend.name, MESSAGE_SIZE),
+            measure(lambda: cipher.unpad(backend.decrypt(expect, iv, key))), MESSAGE_SIZE)
+
+    report("old pyaes Encrypter {0} bytes".format(MESSAGE_SIZE),
+        measure(lambda: old_encrypt_cbc(message, iv, key)), MESSAGE_SIZE)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+""" JSON vs. MessagePack for the payloads the API serves most: size
+    (raw and gzipped), encode time and decode time.
+
+        python3 -m benchmarks.encoding [truth version] """
+
+import json
+import itertools
+import msgpack
+import starlight
+import api_endpoints
+import api_serializers
+from payloadcache import encode_object, gzip_encode
+from benchmarks import measure, report
+
+IMAGE_HOST = "https://static.example.com"
+
+def payloads():
+    yield "list/card_t", api_endpoints.CardListAPI.list_payload(())
+    yield "list/char_t", api_endpoints.CharListAPI.list_payload(())
+
+    sset = api_serializers.SerializerSet(starlight.data.version, IMAGE_HOST)
+    all_ids = sorted(itertools.chain.from_iterable(starlight.data.id_chain.values()))
+    for n in (1, 100, 1000):
+        cards = starlight.data.cards(all_ids[:n])
+        yield "card_t x{0}".format(len(cards)), {"result": sset.serialize_all(cards, api_serializers.FULL)}
+
+def main():
+    starlight.init()
+
+    for label, obj in payloads():
+        print("--- {0}".format(label))
+        for fmt in ("json", "msgpack"):
+            blob = encode_object(obj, fmt)
+            if fmt == "json":
+                raw = blob.encode("utf8")
+                decode = lambda: json.loads(blob)
+            else:
+                raw = blob
+                decode = lambda: msgpack.unpackb(blob, raw=False)
+
+            print("{0}: {1} bytes, {2} gzipped".format(fmt, len(raw), len(gzip_encode(raw))))
+            report("  encode", measure(lambda: encode_object(obj, fmt)))
+            report("  decode", measure(decode))
+
+if __name__ == "__main__":
+    main()
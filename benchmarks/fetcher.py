@@ -0,0 +1,116 @@
+""" acquisition.MultiFetcher against a local stand-in for the asset server,
+    at a few concurrency levels. The server adds a little latency to each
+    response, drops some connections halfway (so downloads have to resume),
+    and serves one file with the wrong contents (so it has to fail).
+
+        python3 -m benchmarks.fetcher """
+
+import os
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+from starlight import acquisition
+
+N_FILES = 64
+FILE_SIZE = 256 * 1024
+LATENCY = 0.02
+DROP_RATE = 0.2
+
+class StandIn(tornado.web.RequestHandler):
+    """ Serves FILES[hash], honouring Range. """
+    FILES = {}
+
+    @tornado.gen.coroutine
+    def get(self, prefix, hash):
+        body = self.FILES.get(hash)
+        if body is None or hash[0:2] != prefix:
+            raise tornado.web.HTTPError(404)
+
+        yield tornado.gen.sleep(LATENCY)
+
+        start = 0
+        byte_range = self.request.headers.get("Range")
+        if byte_range:
+            start = int(byte_range.split("=")[1].split("-")[0])
+            if start >= len(body):
+                raise tornado.web.HTTPError(416)
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes {0}-{1}/{2}".format(start, len(body) - 1, len(body)))
+
+        if random.random() < DROP_RATE:
+            # Promise the whole thing, send half, hang up.
+            self.set_header("Content-Length", len(body) - start)
+            self.write(body[start:start + (len(body) - start) // 2])
+            yield self.flush()
+            self.request.connection.stream.close()
+            return
+
+        self.write(body[start:])
+
+def make_files(rng):
+    files = {}
+    for _ in range(N_FILES):
+        body = bytes(rng.getrandbits(8) for _ in range(64)) * (FILE_SIZE // 64)
+        files[hashlib.md5(body).hexdigest()] = body
+    return files
+
+@tornado.gen.coroutine
+def run(url_format, index, concurrency):
+    dest_dir = tempfile.mkdtemp()
+    try:
+        names = sorted(index.entries)
+        jobs = acquisition.fetch_jobs(index, names, dest_dir, url_format)
+        fetcher = acquisition.MultiFetcher(concurrency=concurrency, retries=5)
+
+        start = time.perf_counter()
+        results = yield fetcher.fetch_all(jobs)
+        elapsed = time.perf_counter() - start
+
+        bad = [name for name in names if results[os.path.join(dest_dir, name)] is not None]
+        for name in names:
+            if name not in bad:
+                path = os.path.join(dest_dir, name)
+                assert acquisition.md5_of_file(path) == index.get(name).hash, name
+
+        print("concurrency {0:>2}: {1:7.1f} ms, {2:6.1f} MB/s, {3}, failed: {4}".format(
+            concurrency, elapsed * 1000, N_FILES * FILE_SIZE / elapsed / 1e6, fetcher.stats(), bad))
+
+        # Everything that worked is skipped the second time around.
+        fetcher = acquisition.MultiFetcher(concurrency=concurrency, retries=0)
+        yield fetcher.fetch_all(jobs)
+        assert fetcher.skipped == len(names) - len(bad), fetcher.stats()
+    finally:
+        shutil.rmtree(dest_dir)
+
+@tornado.gen.coroutine
+def main():
+    rng = random.Random(1)
+    StandIn.FILES = make_files(rng)
+
+    index = acquisition.ManifestIndex({"file{0:03d}".format(i): acquisition.manifest_entry_t(hash, 0)
+                                       for i, hash in enumerate(sorted(StandIn.FILES))})
+    # One file whose manifest hash doesn't match what the server has.
+    index.entries["corrupt"] = acquisition.manifest_entry_t(
+        next(iter(StandIn.FILES))[:2] + "0" * 30, 0)
+    StandIn.FILES[index.entries["corrupt"].hash] = b"not what you asked for"
+
+    app = tornado.web.Application([(r"/([0-9a-f]{2})/([0-9a-f]{32})", StandIn)])
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    url_format = "http://127.0.0.1:{0}/{{1}}/{{0}}".format(sockets[0].getsockname()[1])
+
+    for concurrency in (1, 4, 16):
+        yield run(url_format, index, concurrency)
+
+    server.stop()
+
+if __name__ == "__main__":
+    tornado.ioloop.IOLoop.current().run_sync(main)
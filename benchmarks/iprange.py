@@ -0,0 +1,63 @@
+""" IP range matching: the old linear scan over ip_network objects vs.
+    iprange.IPRangeSet, with 10k random v4 and v6 ranges.
+
+        python3 -m benchmarks.iprange """
+
+import random
+import ipaddress
+import iprange
+from benchmarks import measure, report
+
+N_RANGES = 10000
+N_ADDRESSES = 1000
+
+def random_networks(rng, n):
+    nets = []
+    for _ in range(n):
+        if rng.random() < 0.7:
+            prefix = rng.randint(12, 32)
+            nets.append(ipaddress.ip_network((rng.getrandbits(32), prefix), strict=False))
+        else:
+            prefix = rng.randint(24, 64)
+            nets.append(ipaddress.ip_network((rng.getrandbits(128), prefix), strict=False))
+    return nets
+
+def random_addresses(rng, nets, n):
+    addrs = []
+    for _ in range(n):
+        if rng.random() < 0.5:
+            net = rng.choice(nets)
+            addrs.append(str(net.network_address + rng.randint(0, net.num_addresses - 1)))
+        elif rng.random() < 0.7:
+            addrs.append(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+        else:
+            addrs.append(str(ipaddress.IPv6Address(rng.getrandbits(128))))
+    return addrs
+
+def linear_contains(nets, addr):
+    # what app.early_init and TranslateWriteAPI.is_address_blocked used to do
+    for net in nets:
+        if ipaddress.ip_address(addr) in net:
+            return 1
+    return 0
+
+def main():
+    rng = random.Random(1)
+    nets = random_networks(rng, N_RANGES)
+    addrs = random_addresses(rng, nets, N_ADDRESSES)
+
+    report("IPRangeSet build, {0} ranges".format(N_RANGES),
+        measure(lambda: iprange.IPRangeSet(nets)))
+    ranges = iprange.IPRangeSet(nets)
+    print("{0} intervals after merging".format(len(ranges)))
+
+    for addr in addrs:
+        if bool(linear_contains(nets, addr)) != (addr in ranges):
+            raise AssertionError("IPRangeSet disagrees with the linear scan on " + addr)
+
+    sample = addrs[:20]
+    report("linear scan", measure(lambda: [linear_contains(nets, a) for a in sample]), len(sample))
+    report("IPRangeSet", measure(lambda: [a in ranges for a in addrs]), len(addrs))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+""" ObjectAPI serialization: fix_namedtuples vs. api_serializers, and the
+    effect of ?fields= and ?expand= on time and payload size.
+
+        python3 -m benchmarks.object_api [truth version] """
+
+import json
+import itertools
+import starlight
+import api_endpoints
+import api_serializers
+from benchmarks import measure, report
+
+IMAGE_HOST = "https://static.example.com"
+BATCH_SIZES = [1, 10, 100, 1000]
+
+PROJECTIONS = [
+    ("everything", None, None),
+    ("no expansion", None, ""),
+    ("expand=skill", None, "skill"),
+    ("5 fields", "id,chara_id,title,rarity,attribute", ""),
+    ("5 fields, expand=chara", "id,chara,title,rarity,attribute", "chara"),
+]
+
+class LegacySerializer(api_endpoints.APIUtilMixin):
+    settings = {"image_host": IMAGE_HOST}
+
+    def collect(self, objects, cfg):
+        return [self.fix_namedtuples(o.__class__.__name__, o._asdict(), cfg) if o else o
+                for o in objects]
+
+def compare_with_legacy(all_ids):
+    legacy = LegacySerializer()
+
+    for stubs in ("no", "yes"):
+        cfg = {"stubs": stubs, "datetime": "unix"}
+        projection = api_serializers.make_projection(None, None, stubs == "yes")
+
+        for n in BATCH_SIZES:
+            cards = starlight.data.cards(all_ids[:n])
+
+            # a fresh SerializerSet so the memo starts out cold
+            cold = lambda: api_serializers.SerializerSet(starlight.data.version, IMAGE_HOST) \
+                .serialize_all(cards, projection)
+            warm_set = api_serializers.serializers_for(starlight.data.version, IMAGE_HOST)
+            warm = lambda: warm_set.serialize_all(cards, projection)
+
+            expect = json.dumps(legacy.collect(cards, cfg), sort_keys=1)
+            if json.dumps(cold(), sort_keys=1) != expect:
+                raise AssertionError("serializer output differs from fix_namedtuples")
+
+            print("--- {0} card(s), stubs={1}".format(len(cards), stubs))
+            report("fix_namedtuples", measure(lambda: legacy.collect(cards, cfg)), len(cards))
+            report("compiled (cold)", measure(cold), len(cards))
+            report("compiled (warm)", measure(warm), len(cards))
+            report("compiled (warm) + json.dumps",
+                measure(lambda: json.dumps({"result": warm()}, ensure_ascii=0)), len(cards))
+
+def compare_projections(all_ids):
+    cards = starlight.data.cards(all_ids[:1000])
+    print("--- projections, {0} card(s)".format(len(cards)))
+
+    for label, fields, expand in PROJECTIONS:
+        projection = api_serializers.make_projection(fields, expand, 0)
+
+        def run():
+            # cold every time, to count the cost of computing the fields
+            sset = api_serializers.SerializerSet(starlight.data.version, IMAGE_HOST)
+            return json.dumps({"result": sset.serialize_all(cards, projection)}, ensure_ascii=0)
+
+        size = len(run().encode("utf8"))
+        report("{0} ({1} KiB)".format(label, size // 1024), measure(run), len(cards))
+
+def main():
+    starlight.init()
+
+    all_ids = sorted(itertools.chain.from_iterable(starlight.data.id_chain.values()))
+    compare_with_legacy(all_ids)
+    compare_projections(all_ids)
+
+if __name__ == "__main__":
+    main()
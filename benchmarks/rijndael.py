@@ -0,0 +1,34 @@
+""" starlight.rijndael: checks the test vectors, then times single blocks and
+    4 KB CBC runs for every key and block size, with pyaes (16-byte blocks
+    only) for comparison.
+
+        python3 -m benchmarks.rijndael """
+
+import os
+import pyaes
+from starlight import rijndael
+from benchmarks import measure, report
+
+CBC_SIZE = 4096
+
+def main():
+    rijndael.selftest()
+    print("test vectors ok")
+
+    for key_size, block_size in sorted(rijndael.TEST_VECTORS):
+        key, block = os.urandom(key_size), os.urandom(block_size)
+        iv, data = os.urandom(block_size), os.urandom(CBC_SIZE - CBC_SIZE % block_size)
+        r = rijndael.rijndael(key, block_size)
+        label = "k{0} b{1}".format(key_size * 8, block_size * 8)
+
+        report(label + " encrypt block", measure(lambda: r.encrypt(block)), block_size)
+        report(label + " decrypt block", measure(lambda: r.decrypt(block)), block_size)
+        report(label + " encrypt_cbc 4k", measure(lambda: r.encrypt_cbc(data, iv)), len(data))
+        report(label + " decrypt_cbc 4k", measure(lambda: r.decrypt_cbc(data, iv)), len(data))
+
+        if block_size == 16:
+            aes = pyaes.AES(key)
+            report(label + " pyaes encrypt block", measure(lambda: aes.encrypt(block)), block_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+""" The cost of setting request.is_low_bandwidth in prepare(): user_agents.parse
+    on every request vs. useragent.UserAgentClassifier.
+
+        python3 -m benchmarks.useragent """
+
+import random
+import itertools
+import user_agents
+import useragent
+from benchmarks import measure, report
+
+UA_STRINGS = [
+    # desktop
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.140 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.140 Safari/537.36 Edge/17.17134",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:58.0) Gecko/20100101 Firefox/58.0",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko",
+    "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.132 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_3) AppleWebKit/604.5.6 (KHTML, like Gecko) Version/11.0.3 Safari/604.5.6",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.140 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.13; rv:58.0) Gecko/20100101 Firefox/58.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.140 Safari/537.36",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:58.0) Gecko/20100101 Firefox/58.0",
+    # phones and tablets
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 11_2_5 like Mac OS X) AppleWebKit/604.5.6 (KHTML, like Gecko) Version/11.0 Mobile/15D60 Safari/604.1",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 11_2_6 like Mac OS X) AppleWebKit/604.1.34 (KHTML, like Gecko) CriOS/64.0.3282.112 Mobile/15D100 Safari/604.1",
+    "Mozilla/5.0 (iPad; CPU OS 11_2_5 like Mac OS X) AppleWebKit/604.5.6 (KHTML, like Gecko) Version/11.0 Mobile/15D60 Safari/604.1",
+    "Mozilla/5.0 (iPod touch; CPU iPhone OS 10_3_3 like Mac OS X) AppleWebKit/603.3.8 (KHTML, like Gecko) Version/10.0 Mobile/14G60 Safari/602.1",
+    "Mozilla/5.0 (Linux; Android 8.0.0; SM-G950F Build/R16NW) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.137 Mobile Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 7.0; SO-01J Build/39.2.B.0.336) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.137 Mobile Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 7.1.1; Pixel Build/NOF26V; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/63.0.3239.111 Mobile Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 7.0; SM-T810 Build/NRD90M) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.137 Safari/537.36",
+    "Mozilla/5.0 (Android 8.0.0; Mobile; rv:58.0) Gecko/58.0 Firefox/58.0",
+    # the odd ones
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2272.96 Mobile Safari/537.36 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Mozilla/5.0 (Linux; U; Android 4.0.3; en-us; KFTT Build/IML74K) AppleWebKit/537.36 (KHTML, like Gecko) Silk/3.68 like Chrome/39.0.2171.93 Safari/537.36",
+    "Mozilla/5.0 (PlayStation 4 5.05) AppleWebKit/601.2 (KHTML, like Gecko)",
+    "Twitterbot/1.0",
+    "curl/7.58.0",
+]
+
+def legacy_prepare(ua):
+    # what app.early_init's prepare3 used to do
+    parsed = user_agents.parse(ua)
+    return 1 if parsed.is_mobile or parsed.is_tablet else 0
+
+def main():
+    for ua in UA_STRINGS:
+        if useragent.UserAgentClassifier().classify(ua) != legacy_prepare(ua):
+            raise AssertionError("classifier disagrees with user_agents on " + ua)
+
+    # A skewed mix, like real traffic: a few browsers make most of the requests.
+    rng = random.Random(1)
+    weights = [1 / (i + 1) for i in range(len(UA_STRINGS))]
+    traffic = rng.choices(UA_STRINGS, weights, k=1000)
+
+    # ua-parser keeps a small cache of its own, so time a miss separately.
+    unique = ("{0} {1}".format(ua, i) for i in itertools.count())
+    report("user_agents.parse, cache miss", measure(lambda: legacy_prepare(next(unique))))
+    report("user_agents.parse every time", measure(lambda: [legacy_prepare(ua) for ua in traffic]), len(traffic))
+
+    def cold():
+        classifier = useragent.UserAgentClassifier()
+        return [classifier.classify(ua) for ua in traffic]
+    report("fast path, no cache", measure(cold), len(traffic))
+
+    classifier = useragent.UserAgentClassifier()
+    report("fast path + LRU", measure(lambda: [classifier.is_low_bandwidth(ua) for ua in traffic]), len(traffic))
+    print(classifier.stats())
+
+if __name__ == "__main__":
+    main()
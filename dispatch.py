@@ -1,12 +1,10 @@
 import tornado.web
+import tornado.gen
 import json
 import os
 import starlight
-import time
-try:
-    from plop.collector import Collector, PlopFormatter
-except ImportError:
-    pass
+import itertools
+from payloadcache import encode_payload, EncodedPayloadMixin
 
 ROUTES = []
 
@@ -27,14 +25,13 @@ def route(*regexes):
 
 
 def expose_static_json(path, an_object):
-    precomputed = json.dumps(an_object)
+    precomputed = encode_payload(json.dumps(an_object))
 
-    class ret(tornado.web.RequestHandler):
+    class ret(EncodedPayloadMixin, tornado.web.RequestHandler):
         def get(self):
-            self.set_header("Content-Type", "application/json")
             self.set_header("Cache-Control", "no-cache")
             self.set_header("Expires", "0")
-            self.write(precomputed)
+            self.write_encoded_payload(precomputed, "application/json")
 
     route(path)(ret)
 
@@ -56,19 +53,34 @@ def dev_mode_only(wrapped):
 class HandlerSyncedWithMaster(tornado.web.RequestHandler):
     def prepare(self):
         starlight.data.reset_statistics()
-        starlight.check_version()
 
         super().prepare()
 
-        if self.get_argument("profile", None) and os.environ.get("ALLOW_PROFILING"):
-            self.collector = Collector()
-            self.collector.start()
 
-    def finish(self, *args, **kw):
-        super().finish(*args, **kw)
+class StreamingRenderMixin(object):
+    """ Renders a page in pieces: a head template, the row template once per
+        batch of items, and a tail template. The connection is flushed after
+        each piece, so the client starts receiving the page right away and we
+        never hold more than one batch of markup in memory. """
+    STREAM_BATCH_SIZE = 50
 
-        if self.get_argument("profile", None) and os.environ.get("ALLOW_PROFILING"):
-            self.collector.stop()
-            formatter = PlopFormatter(max_stacks=9001)
-            if self.collector.samples_taken:
-                formatter.store(self.collector, "{0}_{1}.profile".format(self.__class__.__name__, time.time()))
+    @tornado.gen.coroutine
+    def render_streamed(self, head, rows, tail, item_name, items, **kwargs):
+        self.set_header("Content-Type", "text/html; charset=UTF-8")
+
+        kwargs[item_name] = items
+        self.write(self.render_string(head, **kwargs))
+        yield self.flush()
+
+        iterator = iter(items)
+        while 1:
+            batch = list(itertools.islice(iterator, self.STREAM_BATCH_SIZE))
+            if not batch:
+                break
+
+            kwargs[item_name] = batch
+            self.write(self.render_string(rows, **kwargs))
+            yield self.flush()
+
+        kwargs[item_name] = []
+        self.finish(self.render_string(tail, **kwargs))
@@ -2,6 +2,7 @@ import tornado.web
 import tornado.template
 import tornado.escape
 import tornado.ioloop
+import tornado.gen
 from dispatch import *
 import os
 import json
@@ -9,20 +10,20 @@ import starlight
 import time
 import pytz
 import itertools
+import urllib.parse
 import enums
 import table
 from collections import defaultdict
 from datetime import datetime, timedelta
 
 import webutil
+from payloadcache import EncodedPayloadMixin
 
 @route(r"/([0-9]+-[0-9]+-[0-9]+)?")
 class Home(HandlerSyncedWithMaster):
-    @tornado.web.asynchronous
     def head(self, pretend_date):
         return self.get(pretend_date)
 
-    @tornado.web.asynchronous
     def get(self, pretend_date):
         actually_now = pytz.utc.localize(datetime.utcnow())
 
@@ -53,30 +54,16 @@ class Home(HandlerSyncedWithMaster):
             preprime_set.update(h.card_list())
         starlight.data.cards(preprime_set)
 
+        # Rates come from the game API, which can be slow. Render with
+        # whatever is cached; a miss is fetched in the background.
         self.rates = {}
-        self.complete = 0
         for gacha in self.gachas:
             if (now >= gacha.start_date) and (now <= gacha.end_date):
-                starlight.data.live_gacha_rates(gacha, self.receive_live_gacha_rate)
-            else:
-                self.complete += 1
-
-        # case where we don't make any calls to live_gacha_rates
-        if self.complete == len(self.gachas):
-            # we need to return to the ioloop or else a bogus exception gets raised
-            tornado.ioloop.IOLoop.current().add_callback(self.complete_for_real)
-
-    def receive_live_gacha_rate(self, rate):
-        if rate:
-            try:
-                self.rates[rate["gacha"]] = rate["rates"]
-            finally:
-                self.complete += 1
-        else:
-            self.complete += 1
+                rate = starlight.data.live_gacha_rates_nowait(gacha)
+                if rate:
+                    self.rates[rate["gacha"]] = rate["rates"]
 
-        if self.complete == len(self.gachas):
-            self.complete_for_real()
+        self.complete_for_real()
 
     def complete_for_real(self):
         self.render("main.html", history=self.recent_history,
@@ -87,15 +74,35 @@ class Home(HandlerSyncedWithMaster):
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route("/suggest")
-class SuggestNames(HandlerSyncedWithMaster):
-    def get(self):
+class SuggestNames(HandlerSyncedWithMaster, EncodedPayloadMixin):
+    """ Without arguments, returns the whole name list for client-side searching.
+        With ?q=, searches on the server and returns at most `limit` matches. """
+    MAX_LIMIT = 50
+
+    def full_name_list(self):
         names = {value.conventional.lower(): [value.conventional, key] for key, value in starlight.data.names.items()}
         names.update({str(key): [value.conventional, key] for key, value in starlight.data.names.items()})
+        return json.dumps(names)
 
-        self.set_header("Content-Type", "application/json")
+    def get(self):
         self.set_header("Cache-Control", "no-cache")
         self.set_header("Expires", "0")
-        self.write(names)
+
+        query = self.get_argument("q", None)
+        if query is None:
+            self.write_cached_payload(starlight.data.version, ("suggest",),
+                self.full_name_list, "application/json")
+            return
+
+        try:
+            limit = min(max(int(self.get_argument("limit", "10")), 1), self.MAX_LIMIT)
+        except ValueError:
+            self.set_status(400)
+            self.write({"error": "limit must be an integer"})
+            return
+
+        found = starlight.data.suggest_names(query, limit)
+        self.write({"result": [[starlight.data.names[key].conventional, key] for key in found]})
 
 @route(r"/_evt")
 class EventD(HandlerSyncedWithMaster):
@@ -196,8 +203,11 @@ class Card(HandlerSyncedWithMaster):
             self.render("card.html", cards=acard, use_table=use_table,
                 just_one_card=just_one_card, availability=availability,
                 now=pytz.utc.localize(datetime.utcnow()), **self.settings)
+            # Only count ids that exist, so the analytics counters can't be
+            # grown with made-up ones.
+            found = ",".join(str(id) for id, ch in zip(card_ids, chains) if ch)
             self.settings["analytics"].analyze_request(
-                self.request, self.__class__.__name__, {"card_id": card_idlist})
+                self.request, self.__class__.__name__, {"card_id": found})
         else:
             self.set_status(404)
             self.write("Not found.")
@@ -209,7 +219,7 @@ class Card(HandlerSyncedWithMaster):
 # it apply globally to all tables.
 
 @route(r"/t/([A-Za-z]+)/([^/]+)")
-class ShortlinkTable(HandlerSyncedWithMaster):
+class ShortlinkTable(StreamingRenderMixin, HandlerSyncedWithMaster):
     # This shouldn't take too long.
     # The full chain is pre-emptively loaded when any member is requested
     def flip_chain(self, card):
@@ -217,18 +227,54 @@ class ShortlinkTable(HandlerSyncedWithMaster):
 
     def rendertable(self, dataset, cards,
                     allow_shortlink=1, table_name="Custom Table",
-                    template="generictable.html", **extra):
+                    template="generictable.html", stream=0, base=None, **extra):
+        """ With stream=1, the table is sent in batches of rows instead of
+            being rendered all at once. Only generictable.html can be streamed,
+            and the caller must yield the returned future.
+
+            The arguments read by table.parse_query filter, sort and paginate
+            the cards here instead of in the browser. If cards is one of
+            table.BASES, pass its name as base so the sorted orderings can be
+            reused between requests. """
         if isinstance(dataset, str):
             filters, categories = table.select_categories(dataset)
         else:
             filters, categories = dataset
 
+        try:
+            query = table.parse_query(self.get_argument, "".join(c.uid for c in categories))
+        except ValueError as e:
+            self.set_status(400)
+            self.finish(str(e))
+            return tornado.gen.maybe_future(None)
+
         should_switch_chain_head = self.get_argument("plus", "NO") == "YES"
         if should_switch_chain_head:
-            cards = list(map(self.flip_chain, cards))
+            cards = map(self.flip_chain, cards)
+
+        page_info = None
+        if query is not None:
+            cards, page_info = table.card_index().select(cards, query,
+                (base, should_switch_chain_head) if base else None)
+        elif not stream:
+            cards = list(cards)
 
         extra.update(self.settings)
 
+        if stream:
+            return self.render_streamed("partials/table_open.html",
+                "partials/table_rows.html", "partials/table_close.html",
+                "cards", cards,
+                filters=filters,
+                categories=categories,
+                original_dataset=dataset,
+                show_shortlink=allow_shortlink,
+                table_name=table_name,
+                is_displaying_awake_forms=should_switch_chain_head,
+                page_info=page_info,
+                query=query,
+                **extra)
+
         self.render(template,
                     filters=filters,
                     categories=categories,
@@ -237,8 +283,16 @@ class ShortlinkTable(HandlerSyncedWithMaster):
                     show_shortlink=allow_shortlink,
                     table_name=table_name,
                     is_displaying_awake_forms=should_switch_chain_head,
+                    page_info=page_info,
+                    query=query,
                     **extra)
 
+    def page_link(self, page):
+        """ The current URL with ?page= replaced. """
+        args = {k: self.get_argument(k) for k in self.request.query_arguments}
+        args["page"] = page
+        return "?" + urllib.parse.urlencode(sorted(args.items()))
+
     def get(self, dataset, spec):
         try:
             idlist = webutil.decode_cardlist(spec)
@@ -252,20 +306,24 @@ class ShortlinkTable(HandlerSyncedWithMaster):
 
 @route(r"/skill_table")
 class SkillTable(ShortlinkTable):
+    @tornado.gen.coroutine
     def get(self):
-        ds = filter(lambda C: C.skill is not None, starlight.data.cards(starlight.data.all_chain_ids()))
-        self.rendertable("CASDE", ds,
+        yield self.rendertable("CASDE", table.base_cards("skill"),
             allow_shortlink=0,
-            table_name="Cards by skill")
+            table_name="Cards by skill",
+            stream=1,
+            base="skill")
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/lead_skill_table")
 class LeadSkillTable(ShortlinkTable):
+    @tornado.gen.coroutine
     def get(self):
-        ds = filter(lambda C: C.lead_skill is not None, starlight.data.cards(starlight.data.all_chain_ids()))
-        self.rendertable("CAKL", ds,
+        yield self.rendertable("CAKL", table.base_cards("lead_skill"),
             allow_shortlink=0,
-            table_name="Cards by lead skill")
+            table_name="Cards by lead skill",
+            stream=1,
+            base="lead_skill")
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/table/([A-Za-z]+)/([0-9\,]+)")
@@ -284,7 +342,7 @@ class CompareCard(ShortlinkTable):
         if acard:
             self.rendertable(dataset.upper(), acard, table_name="Custom Table")
             self.settings["analytics"].analyze_request(
-                self.request, self.__class__.__name__, {"card_id": card_idlist})
+                self.request, self.__class__.__name__, {"card_id": ",".join(str(c.id) for c in acard if c)})
         else:
             self.set_status(404)
             self.write("Not found.")
@@ -396,17 +454,26 @@ class SpriteViewerEX(tornado.web.RequestHandler):
             self.write("Not found.")
 
 @route("/history")
-class History(HandlerSyncedWithMaster):
+class History(StreamingRenderMixin, HandlerSyncedWithMaster):
     """ Display all history entries. """
+    def primed(self, entries):
+        """ Passes entries through a batch at a time, loading the cards each
+            batch shows before it's rendered. """
+        entries = iter(entries)
+        while 1:
+            batch = list(itertools.islice(entries, self.STREAM_BATCH_SIZE))
+            if not batch:
+                return
+            starlight.data.cards({id for h in batch for id in h.card_list()})
+            yield from batch
+
+    @tornado.gen.coroutine
     def get(self):
-        all_history = self.settings["tle"].get_history(nent=None)
-
-        preprime_set = set()
-        for h in all_history:
-            preprime_set.update(h.card_list())
-        starlight.data.cards(preprime_set)
+        all_history = self.settings["tle"].iter_history(self.STREAM_BATCH_SIZE)
 
-        self.render("history.html", history=all_history, **self.settings)
+        yield self.render_streamed("partials/history_open.html",
+            "partials/history_entries.html", "partials/history_close.html",
+            "history", self.primed(all_history), **self.settings)
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/tl_cacheall")
@@ -0,0 +1,105 @@
+""" Sets of IP networks with fast membership tests.
+
+    Networks are stored as merged, sorted integer intervals (one list for v4
+    and one for v6), so checking an address is a single bisect no matter how
+    many ranges there are. """
+
+import os
+import time
+import ipaddress
+from bisect import bisect_right
+
+def merge_intervals(intervals):
+    ret = []
+    for start, end in sorted(intervals):
+        if ret and start <= ret[-1][1] + 1:
+            if end > ret[-1][1]:
+                ret[-1][1] = end
+        else:
+            ret.append([start, end])
+    return ret
+
+class IPRangeSet(object):
+    def __init__(self, networks=()):
+        intervals = {4: [], 6: []}
+        for net in networks:
+            if not isinstance(net, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+                net = ipaddress.ip_network(net, strict=False)
+            intervals[net.version].append((int(net.network_address), int(net.broadcast_address)))
+
+        self.starts = {}
+        self.ends = {}
+        for version, ivs in intervals.items():
+            merged = merge_intervals(ivs)
+            self.starts[version] = [start for start, _ in merged]
+            self.ends[version] = [end for _, end in merged]
+
+    @classmethod
+    def from_file(cls, path):
+        """ One network per line. Blank lines and lines starting with # are skipped. """
+        with open(path, "r") as f:
+            return cls(line.strip() for line in f if line.strip() and not line.startswith("#"))
+
+    def __len__(self):
+        return len(self.starts[4]) + len(self.starts[6])
+
+    def contains_int(self, version, n):
+        starts = self.starts[version]
+        i = bisect_right(starts, n) - 1
+        return i >= 0 and n <= self.ends[version][i]
+
+    def __contains__(self, addr):
+        """ addr can be a string or an ipaddress object. Strings that aren't
+            addresses are never contained. """
+        if isinstance(addr, str):
+            try:
+                addr = ipaddress.ip_address(addr)
+            except ValueError:
+                return False
+
+        if self.contains_int(addr.version, int(addr)):
+            return True
+        # ::ffff:a.b.c.d, as seen on dual-stack sockets
+        mapped = getattr(addr, "ipv4_mapped", None)
+        return mapped is not None and self.contains_int(4, int(mapped))
+
+class IPRangeFile(object):
+    """ An IPRangeSet loaded from a file, which is reloaded if the file
+        changes. The file is checked at most once every `check_interval`
+        seconds. If it's missing or can't be parsed, the last good ranges
+        are kept (or none, if it never loaded). """
+    def __init__(self, path, check_interval=10):
+        self.path = path
+        self.check_interval = check_interval
+
+        self.ranges = IPRangeSet()
+        self.mtime = None
+        self.next_check = 0
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        self.next_check = time.monotonic() + self.check_interval
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.mtime:
+            return
+
+        try:
+            self.ranges = IPRangeSet.from_file(self.path)
+        except (OSError, ValueError) as e:
+            print("trace IPRangeFile: can't load {0}: {1}".format(self.path, e))
+            return
+        self.mtime = mtime
+        print("trace IPRangeFile: loaded {0} ranges from {1}".format(len(self.ranges), self.path))
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __contains__(self, addr):
+        if time.monotonic() >= self.next_check:
+            self.reload_if_changed()
+        return addr in self.ranges
@@ -0,0 +1,156 @@
+""" Latency histograms, in Prometheus text format.
+
+    Each request is timed as a whole ("handler"), and the time it spends in
+    TranslationSQL ("db"), DataCache's sqlite ("sqlite") and templates
+    ("template") is added up separately. Template time includes any queries
+    the template makes.
+
+    Requests interleave on the IOLoop, so phase time goes to whichever
+    handler most recently started running code (in prepare or render_string).
+    That's exact for synchronous handlers and close enough for the others.
+
+    Everything here is per process. """
+
+import time
+import threading
+from bisect import bisect_left
+import tornado.web
+from tornado.log import access_log
+
+# seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ("db", "sqlite", "template")
+
+MAIN_THREAD = threading.get_ident()
+
+class Histogram(object):
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        # the last one is +Inf
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+# (route, phase) -> Histogram
+HISTOGRAMS = {}
+
+def observe(route, phase, value):
+    h = HISTOGRAMS.get((route, phase))
+    if h is None:
+        h = HISTOGRAMS[(route, phase)] = Histogram()
+    h.observe(value)
+
+# The phase totals of the request that's running now, or None.
+active = None
+
+def activate(phases):
+    global active
+    active = phases
+
+class phase(object):
+    """ with phase("db"): ... adds the time spent to the active request.
+        Nested uses of the same phase are only counted once, and time spent
+        on other threads isn't counted at all. """
+    __slots__ = ("name", "start")
+    depth = dict.fromkeys(PHASES, 0)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if threading.get_ident() != MAIN_THREAD:
+            self.start = None
+            return
+        phase.depth[self.name] += 1
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.start is None:
+            return
+        phase.depth[self.name] -= 1
+        if active is not None and not phase.depth[self.name]:
+            active[self.name] += time.perf_counter() - self.start
+
+def install():
+    """ Start timing requests. Pass log_request as the Application's log_function. """
+    _super_prepare = tornado.web.RequestHandler.prepare
+    def _metrics_prepare(self):
+        self._metric_phases = dict.fromkeys(PHASES, 0.0)
+        activate(self._metric_phases)
+        _super_prepare(self)
+    tornado.web.RequestHandler.prepare = _metrics_prepare
+
+    _super_render_string = tornado.web.RequestHandler.render_string
+    def _metrics_render_string(self, template_name, **kwargs):
+        phases = getattr(self, "_metric_phases", None)
+        activate(phases)
+        start = time.perf_counter()
+        try:
+            return _super_render_string(self, template_name, **kwargs)
+        finally:
+            if phases is not None:
+                phases["template"] += time.perf_counter() - start
+    tornado.web.RequestHandler.render_string = _metrics_render_string
+
+def log_request(handler):
+    """ Records the request's timings, then writes the usual access log line. """
+    route = handler.__class__.__name__
+    request_time = handler.request.request_time()
+    observe(route, "handler", request_time)
+
+    phases = getattr(handler, "_metric_phases", None)
+    if phases is not None:
+        for name, value in phases.items():
+            observe(route, name, value)
+        if active is phases:
+            activate(None)
+
+    # This is what tornado.web.Application.log_request does without a log_function.
+    if handler.get_status() < 400:
+        log_method = access_log.info
+    elif handler.get_status() < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", handler.get_status(),
+               handler._request_summary(), 1000.0 * request_time)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, escape_label(v)) for k, v in labels) + "}"
+
+def exposition(families):
+    """ families is a list of (name, type, help, [(labels, value), ...]), where
+        type is "gauge" or "counter" and labels is a tuple of (key, value)
+        pairs. Returns the full metrics page, histograms included. """
+    lines = [
+        "# HELP sparklebox_request_seconds Time spent handling requests, by route and phase.",
+        "# TYPE sparklebox_request_seconds histogram",
+    ]
+    for (route, phase_name), h in sorted(HISTOGRAMS.items()):
+        labels = (("route", route), ("phase", phase_name))
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), h.counts):
+            cumulative += count
+            lines.append("sparklebox_request_seconds_bucket{0} {1}".format(
+                format_labels(labels + (("le", bound),)), cumulative))
+        lines.append("sparklebox_request_seconds_sum{0} {1}".format(format_labels(labels), h.sum))
+        lines.append("sparklebox_request_seconds_count{0} {1}".format(format_labels(labels), cumulative))
+
+    for name, metric_type, help_text, samples in families:
+        lines.append("# HELP {0} {1}".format(name, help_text))
+        lines.append("# TYPE {0} {1}".format(name, metric_type))
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+
+    return "\n".join(lines) + "\n"
@@ -9,6 +9,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, aliased, load_only
 from sqlalchemy import func
 from collections import defaultdict, namedtuple
+import metrics
 
 from .base import *
 from .extra import *
@@ -31,6 +32,7 @@ class TranslationSQL(object):
     def __init__(self, override_url=None):
         self.really_connected = 0
         self.session_nest = []
+        self.session_timers = []
         self.connect_url = override_url
 
         self.history_cache = []
@@ -55,14 +57,20 @@ class TranslationSQL(object):
             self.Session = sessionmaker(self.engine)
             self.really_connected = 1
 
-        self.session_nest.append(self.Session())
-        return self.session_nest[-1]
+        # If Session() raises, __exit__ won't run, so don't push anything first.
+        session = self.Session()
+        timer = metrics.phase("db")
+        timer.__enter__()
+        self.session_timers.append(timer)
+        self.session_nest.append(session)
+        return session
 
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_value:
             self.session_nest[-1].rollback()
         self.session_nest[-1].close()
         self.session_nest.pop()
+        self.session_timers.pop().__exit__(exc_type, exc_value, traceback)
 
     @retry(5)
     def all(self):
@@ -283,6 +291,29 @@ class TranslationSQL(object):
             self.history_is_all_loaded = 1
         return self.history_cache
 
+    def iter_history(self, batch_size=100):
+        """ All history entries, newest first. Unless the cache already has
+            them all, they're read batch_size rows at a time and not cached,
+            so callers can stream the history without holding all of it. """
+        if not self.caches_disabled and self.history_is_all_loaded:
+            yield from self.history_cache
+            return
+
+        offset = 0
+        while 1:
+            batch = self._get_history_page(offset, batch_size) or []
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            offset += batch_size
+
+    @retry(5)
+    def _get_history_page(self, offset, limit):
+        print("trace _get_history_page", offset)
+        with self as s:
+            return s.query(HistoryEventEntry).order_by(HistoryEventEntry.start_time.desc(),
+                HistoryEventEntry.descriptor.desc()).offset(offset).limit(limit).all()
+
     @retry(5)
     def _get_history(self, nent):
         print("trace _get_history")
@@ -381,6 +412,12 @@ class TranslationEngine(TranslationSQL):
 
         return super().get_history(nent)
 
+    def iter_history(self, batch_size=100):
+        if self.cache_id != self.dsrc.data.version:
+            self.kill_caches(self.dsrc.data.version)
+
+        return super().iter_history(batch_size)
+
     def gacha_availability(self, cards, gacha_list):
         if self.cache_id != self.dsrc.data.version:
             self.kill_caches(self.dsrc.data.version)
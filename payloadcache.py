@@ -0,0 +1,191 @@
+import hashlib
+import json
+import zlib
+import msgpack
+from collections import namedtuple, OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+FORMATS = {"json": "application/json; charset=utf-8",
+           "msgpack": "application/msgpack"}
+MSGPACK_MIME_TYPES = ("application/msgpack", "application/x-msgpack")
+
+encoded_payload_t = namedtuple("encoded_payload_t", ("digest", "identity", "gzip", "br"))
+
+def gzip_encode(body):
+    # wbits=31 gets us a gzip container. Unlike gzip.compress, zlib leaves
+    # the mtime field zeroed, so the same body always encodes the same way.
+    z = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return z.compress(body) + z.flush()
+
+def encode_payload(body):
+    if isinstance(body, str):
+        body = body.encode("utf8")
+
+    return encoded_payload_t(hashlib.sha1(body).hexdigest(),
+        body,
+        gzip_encode(body),
+        brotli.compress(body) if brotli else None)
+
+def encode_object(obj, fmt, pretty=0, default=None):
+    """ Serializes obj in one of FORMATS. `default` is called on objects
+        neither encoder knows how to handle, like json.dumps's. """
+    if fmt == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True, default=default)
+    elif pretty:
+        return json.dumps(obj, ensure_ascii=0, sort_keys=1, indent=2, default=default)
+    else:
+        return json.dumps(obj, ensure_ascii=0, default=default)
+
+def parse_accept_encoding(header):
+    """ Returns the set of codings the client is willing to accept. """
+    ok = set()
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        q = 1.0
+        for param in params.split(";"):
+            k, _, v = param.partition("=")
+            if k.strip() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            ok.add(coding)
+    return ok
+
+class PayloadCache(object):
+    """ Holds pre-encoded response bodies for the current truth version.
+        Everything is thrown away when the version changes. Pinned entries
+        don't count towards max_entries and are never evicted, so put
+        payloads that were prepared ahead of time there. """
+    def __init__(self, name, max_entries=512):
+        self.name = name
+        self.max_entries = max_entries
+        self.version = None
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.pinned.clear()
+            self.version = version
+
+    def get(self, version, key):
+        self.check_version(version)
+
+        entry = self.pinned.get(key)
+        if entry is None:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, version, key, body, pin=0):
+        self.check_version(version)
+
+        entry = encode_payload(body)
+        if pin:
+            self.entries.pop(key, None)
+            self.pinned[key] = entry
+            return entry
+
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def get_or_generate(self, version, key, generate, pin=0):
+        entry = self.get(version, key)
+        if entry is None:
+            entry = self.put(version, key, generate(), pin)
+        return entry
+
+    def get_or_encode(self, version, key, make_object, fmt, pretty=0, default=None, pin=0):
+        """ get_or_generate for plain objects. Each format is cached separately. """
+        return self.get_or_generate(version, key + (fmt, bool(pretty)),
+            lambda: encode_object(make_object(), fmt, pretty, default), pin)
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+# Responses whose cache keys come from a small, fixed set of options.
+PAYLOADS = PayloadCache("shared")
+# Responses for whatever ids or times a client asks for. Kept small and
+# separate, so that requests for arbitrary selections can't push the shared
+# responses out.
+SELECTION_PAYLOADS = PayloadCache("selections", max_entries=64)
+CACHES = (PAYLOADS, SELECTION_PAYLOADS)
+
+class EncodedPayloadMixin(object):
+    """ Sends a pre-encoded payload, picking whichever encoding the client
+        prefers and answering conditional requests with 304. """
+    def write_encoded_payload(self, entry, content_type):
+        accepted = parse_accept_encoding(self.request.headers.get("Accept-Encoding", ""))
+
+        if entry.br is not None and "br" in accepted:
+            coding, body = "br", entry.br
+        elif "gzip" in accepted:
+            coding, body = "gzip", entry.gzip
+        else:
+            coding, body = None, entry.identity
+
+        self.set_header("Content-Type", content_type)
+        self.add_header("Vary", "Accept-Encoding")
+        # Each representation needs its own strong validator.
+        self.set_header("Etag", '"{0}{1}"'.format(entry.digest, "-" + coding if coding else ""))
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        if coding:
+            self.set_header("Content-Encoding", coding)
+        self.write(body)
+
+    def write_cached_payload(self, version, key, generate, content_type):
+        entry = PAYLOADS.get_or_generate(version, key, generate)
+        self.write_encoded_payload(entry, content_type)
+
+    def response_format(self):
+        """ ?format= wins, otherwise msgpack if the Accept header asks for it. """
+        fmt = self.get_argument("format", None)
+        if fmt in FORMATS:
+            return fmt
+
+        accept = self.request.headers.get("Accept", "")
+        if any(mime in accept for mime in MSGPACK_MIME_TYPES):
+            return "msgpack"
+        return "json"
+
+    def write_object(self, obj, default=None):
+        """ Sends obj in whichever format the client negotiated, without
+            caching it. """
+        fmt = self.response_format()
+        self.set_header("Content-Type", FORMATS[fmt])
+        self.add_header("Vary", "Accept")
+        self.write(encode_object(obj, fmt, self.settings["is_dev"], default))
+
+    def write_cached_object(self, version, key, make_object, default=None, cache=PAYLOADS):
+        """ Like write_cached_payload, but make_object returns a plain object
+            that's encoded in whichever format the client negotiated. """
+        fmt = self.response_format()
+        entry = cache.get_or_encode(version, key, make_object, fmt,
+            self.settings["is_dev"], default)
+        self.add_header("Vary", "Accept")
+        self.write_encoded_payload(entry, FORMATS[fmt])
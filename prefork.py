@@ -0,0 +1,127 @@
+""" Serving from several processes.
+
+    The parent loads the current truth, then forks the workers, which share
+    it copy-on-write. Each worker binds its own listening socket with
+    SO_REUSEPORT so the kernel spreads connections between them (or, where
+    that isn't available, they all accept on one socket bound before the
+    fork).
+
+    Worker 0 is the leader. It's the only one that runs the version check scheduler, and
+    so the only one that downloads new truth and runs do_preswitch_tasks.
+    When it switches versions, it tells the other workers through a pipe
+    each, and they open the new DataCache themselves. The version is also
+    written to a file, which workers read when they start, in case one was
+    restarted after an update. """
+
+import os
+import socket
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import starlight
+
+LEADER = 0
+VERSION_FILE = starlight.transient_data_path("serving_version")
+
+def read_version_file():
+    try:
+        with open(VERSION_FILE, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def write_version_file(version):
+    tmp = VERSION_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(str(version))
+    os.rename(tmp, VERSION_FILE)
+
+def catch_up():
+    """ Switch to the version the leader last announced, if it's not ours. """
+    version = read_version_file()
+    if version and str(version) != str(starlight.data.version):
+        print("trace prefork: catching up to", version)
+        starlight.switch_to_version(version)
+
+class Leader(object):
+    def __init__(self, followers):
+        self.followers = followers
+        for fd in followers:
+            os.set_blocking(fd, False)
+
+    def announce(self):
+        version = str(starlight.data.version)
+        write_version_file(version)
+
+        message = (version + "\n").encode("utf8")
+        for fd in self.followers:
+            try:
+                os.write(fd, message)
+            except (BlockingIOError, BrokenPipeError):
+                # Their pipe is full or gone; they'll catch up from the
+                # version file when they're restarted.
+                print("trace prefork: couldn't notify a worker on fd", fd)
+
+class Follower(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = b""
+        tornado.ioloop.IOLoop.current().add_handler(fd, self.on_readable, tornado.ioloop.IOLoop.READ)
+
+    def on_readable(self, fd, events):
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            # the parent went away
+            tornado.ioloop.IOLoop.current().remove_handler(fd)
+            return
+
+        self.buf += chunk
+        *lines, self.buf = self.buf.split(b"\n")
+        if lines:
+            version = lines[-1].decode("utf8")
+            if version != str(starlight.data.version):
+                print("trace prefork: leader switched to", version)
+                starlight.switch_to_version(version, lambda error: None)
+
+def start(num_processes, http_server, port, address):
+    """ Forks into num_processes workers (0 means one per CPU) that serve
+        http_server on port. Returns in each worker, which should then start
+        its IOLoop. The parent never returns: it restarts workers that die. """
+    if num_processes <= 0:
+        num_processes = tornado.process.cpu_count()
+
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    if not reuse_port:
+        sockets = tornado.netutil.bind_sockets(port, address)
+
+    pipes = [os.pipe() for _ in range(num_processes)]
+    write_version_file(starlight.data.version)
+
+    task_id = tornado.process.fork_processes(num_processes)
+
+    if reuse_port:
+        sockets = tornado.netutil.bind_sockets(port, address, reuse_port=True)
+
+    starlight.data.reopen()
+
+    followers = []
+    for i, (r, w) in enumerate(pipes):
+        if i != task_id:
+            os.close(r)
+        if task_id == LEADER and i != LEADER:
+            followers.append(w)
+        else:
+            os.close(w)
+
+    if task_id == LEADER:
+        leader = Leader(followers)
+        starlight.data_switch_listeners.append(leader.announce)
+    else:
+        starlight.check_version_enabled = 0
+        Follower(pipes[task_id][0])
+
+    catch_up()
+    http_server.add_sockets(sockets)
+    print("trace prefork: worker {0} (pid {1}) is {2}".format(task_id, os.getpid(),
+        "the leader" if task_id == LEADER else "a follower"))
+    return task_id
@@ -0,0 +1,101 @@
+""" A statistical profiler for the IOLoop thread.
+
+    A background thread looks at the IOLoop thread's stack `hz` times a
+    second and counts each distinct stack, keyed by the RequestHandler it
+    was running (if any). The result is in collapsed-stack format, one
+    "route;outer;...;inner count" line per stack, which flamegraph.pl and
+    speedscope read directly. """
+
+import os
+import sys
+import threading
+from collections import Counter
+import tornado.web
+
+IDLE = "(idle)"
+NO_HANDLER = "(ioloop)"
+
+class Sampler(threading.Thread):
+    def __init__(self, thread_id, hz):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = 1.0 / hz
+        self.counts = Counter()
+        self.samples = 0
+        self.labels = {}
+        self.stopped = threading.Event()
+
+    def label(self, code):
+        ret = self.labels.get(code)
+        if ret is None:
+            ret = self.labels[code] = "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+        return ret
+
+    def collapse(self, frame):
+        stack = []
+        route = None
+        top = frame
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append(self.label(code))
+            if route is None and code.co_argcount and code.co_varnames[0] == "self":
+                obj = frame.f_locals.get("self")
+                if isinstance(obj, tornado.web.RequestHandler):
+                    route = obj.__class__.__name__
+            frame = frame.f_back
+
+        if route is None:
+            # Sitting in IOLoop.start means we're waiting in poll().
+            route = IDLE if top.f_code.co_name == "start" else NO_HANDLER
+
+        stack.append(route)
+        stack.reverse()
+        return ";".join(stack)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.counts[self.collapse(frame)] += 1
+            self.samples += 1
+            del frame
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self, route=None):
+        lines = []
+        for stack, count in sorted(self.counts.items()):
+            if route is not None and not stack.startswith(route + ";"):
+                continue
+            lines.append("{0} {1}".format(stack, count))
+        return "\n".join(lines) + "\n"
+
+    def by_route(self):
+        ret = Counter()
+        for stack, count in self.counts.items():
+            ret[stack.split(";", 1)[0]] += count
+        return ret
+
+_session = None
+
+def start(hz, thread_id=None):
+    """ Starts sampling the given thread (the current one by default).
+        Only one session can run at a time; returns None if one already is. """
+    global _session
+
+    if _session is not None:
+        return None
+    _session = Sampler(thread_id or threading.get_ident(), hz)
+    _session.start()
+    return _session
+
+def stop(session):
+    global _session
+
+    session.stop()
+    if _session is session:
+        _session = None
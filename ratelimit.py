@@ -0,0 +1,85 @@
+""" Token bucket rate limiting.
+
+    Each key gets a bucket of `burst` tokens that refills at `rate` tokens a
+    second, and every action takes one. Buckets are kept in an LRU of at most
+    `max_entries`; a bucket that falls out just starts over full, which is
+    what it would have refilled to anyway unless the table is far too small. """
+
+import os
+import math
+import time
+from collections import OrderedDict
+
+class TokenBucketLimiter(object):
+    def __init__(self, rate, burst, max_entries=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        # key -> [tokens, time they were counted]
+        self.buckets = OrderedDict()
+
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_spec(cls, spec, **kwargs):
+        """ "N/S" allows bursts of N, refilling at N every S seconds.
+            Returns None (no limit) for an empty spec or N = 0. """
+        if not spec:
+            return None
+        count, _, seconds = spec.partition("/")
+        try:
+            count, seconds = int(count), float(seconds or 1)
+        except ValueError:
+            raise ValueError("rate limit {0!r} isn't in the form N/S".format(spec))
+        if count <= 0:
+            return None
+        if not math.isfinite(seconds) or seconds <= 0:
+            raise ValueError("rate limit {0!r} needs a positive number of seconds".format(spec))
+        return cls(count / seconds, count, **kwargs)
+
+    @classmethod
+    def from_env(cls, name, default, **kwargs):
+        """ from_spec($name), or from_spec(default) if it's unset or invalid. """
+        try:
+            return cls.from_spec(os.environ.get(name, default), **kwargs)
+        except ValueError as e:
+            print("Warning: ${0}: {1}. Using the default, {2}.".format(name, e, default))
+            return cls.from_spec(default, **kwargs)
+
+    def take(self, key, now=None):
+        """ Takes a token from key's bucket. Returns 0 if there was one, or
+            else how many seconds until there will be. """
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed += 1
+            return 0
+
+        self.limited += 1
+        return (1 - bucket[0]) / self.rate
+
+    def stats(self):
+        return {
+            "entries": len(self.buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "evictions": self.evictions,
+        }
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
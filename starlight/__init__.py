@@ -4,18 +4,25 @@ import pickle
 import os
 import subprocess
 import sys
+import traceback
+import itertools
+from bisect import bisect_left
 from time import time
 from datetime import datetime, timedelta
 from pytz import timezone, utc
-from functools import lru_cache, partial
+from functools import partial, wraps
 from collections import defaultdict, namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
 from tornado import ioloop
 
 from csvloader import clean_value, load_keyed_db_file, load_db_file
+import metrics
 from . import en
 from . import apiclient
 from . import acquisition
 from . import extra_va_tables
+from . import livecache
+from . import versioncheck
 
 ark_data_path = partial(os.path.join, "_data", "ark")
 private_data_path = partial(os.path.join, "_data", "private")
@@ -97,24 +104,97 @@ TITLE_ONLY_REGEX = r"^［(.+)］"
 NAME_ONLY_REGEX = r"^(?:［.+］)?(.+)$"
 AWAKENED_SYMBOL = "＋"
 
+# katakana -> hiragana, so name searches don't care which one you type
+_KANA_FOLD = {c: c - 0x60 for c in range(0x30A1, 0x30F7)}
+
+def fold_name(s):
+    return s.strip().lower().translate(_KANA_FOLD)
+
+class TimedCursor(object):
+    """ Counts the time spent stepping through a cursor as sqlite time. """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __iter__(self):
+        while 1:
+            with metrics.phase("sqlite"):
+                rows = self.cursor.fetchmany(256)
+            if not rows:
+                return
+            yield from rows
+
+    def fetchone(self):
+        with metrics.phase("sqlite"):
+            return self.cursor.fetchone()
+
+    def fetchall(self):
+        with metrics.phase("sqlite"):
+            return self.cursor.fetchall()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class TimedConnection(sqlite3.Connection):
+    def execute(self, *args):
+        with metrics.phase("sqlite"):
+            return TimedCursor(super().execute(*args))
+
+def open_mdb(version):
+    # switch_to_version builds the DataCache on preswitch_executor and then
+    # hands it to the IOLoop, so the connection changes threads once. It's
+    # never used by two at the same time.
+    return sqlite3.connect(transient_data_path("{0}.mdb".format(version)),
+        factory=TimedConnection, check_same_thread=False)
+
+def memoized(method):
+    """ Remembers what a DataCache method with no arguments returns, in that
+        DataCache's memo dict. (lru_cache would share one slot between every
+        instance, so a new DataCache warming up and the one still serving
+        would keep evicting each other.) """
+    @wraps(method)
+    def wrapper(self):
+        try:
+            return self.memo[method.__name__]
+        except KeyError:
+            value = self.memo[method.__name__] = method(self)
+            return value
+    return wrapper
+
 class DataCache(object):
     def __init__(self, version):
         self.version = version
         self.load_date = datetime.utcnow()
-        self.hnd = sqlite3.connect(transient_data_path("{0}.mdb".format(version)))
+        self.hnd = open_mdb(version)
         self.class_cache = {}
+        self.memo = {}
         self.prime_caches()
         self.reset_statistics()
 
         self.live_cache = {
-            "gacha": {}
+            "gacha": livecache.LiveCache(self.fetch_live_gacha_rates)
         }
 
+    def reopen(self):
+        """ Call this in a forked child. sqlite connections can't be shared
+            across processes. """
+        self.hnd = open_mdb(self.version)
+
     def reset_statistics(self):
-        self.vc_this = 0
         self.primed_this = Counter()
 
-    @lru_cache(1)
+    def warm_up(self):
+        """ Fills the lazily populated caches, so the first requests after a
+            start or a truth switch don't have to. """
+        self.gacha_ids()
+        self.event_ids()
+        self.birthdays()
+        self.name_index()
+        self.all_chara_id_to_cards()
+        self.cards(self.all_card_ids())
+        self.charas(self.all_chara_ids())
+        self.reset_statistics()
+
+    @memoized
     def gacha_ids(self):
         gachas = []
         gacha_stub_t = namedtuple("gacha_stub_t", ("id", "name", "start_date", "end_date", "type", "subtype", "rates"))
@@ -128,7 +208,7 @@ class DataCache(object):
         self.primed_this["sel_gacha"] += 1
         return sorted(gachas, key=lambda x: x.start_date)
 
-    @lru_cache(1)
+    @memoized
     def event_ids(self):
         events = []
         event_stub_t = namedtuple("event_stub_t", ("id", "name", "start_date", "end_date"))
@@ -376,10 +456,19 @@ class DataCache(object):
 
         return ret
 
+    def iter_cards(self, ids, batch_size=100):
+        """ Like cards(), but loads and yields batch_size cards at a time. """
+        ids = iter(ids)
+        while 1:
+            batch = list(itertools.islice(ids, batch_size))
+            if not batch:
+                return
+            yield from self.cards(batch)
+
     def cards_belonging_to_char(self, id):
         return self.all_chara_id_to_cards().get(id, [])
 
-    @lru_cache(1)
+    @memoized
     def all_chara_id_to_cards(self):
         print("all_chara_id_to_cards")
         ret = defaultdict(lambda: [])
@@ -422,6 +511,22 @@ class DataCache(object):
     def all_chain_ids(self):
         return sorted(self.id_chain.keys())
 
+    @memoized
+    def all_card_ids(self):
+        return sorted(self.chain_id.keys())
+
+    @memoized
+    def all_chara_ids(self):
+        return sorted(self.all_chara_id_to_cards().keys())
+
+    @memoized
+    def all_skill_ids(self):
+        return sorted(self._skills.keys())
+
+    @memoized
+    def all_lead_skill_ids(self):
+        return sorted(self._lead_skills.keys())
+
     def skills(self, ids):
         return [self._skills.get(id) for id in ids]
 
@@ -456,7 +561,7 @@ class DataCache(object):
         else:
             return self.kanji_to_name.get(kanji, kanji)
 
-    @lru_cache(1)
+    @memoized
     def birthdays(self):
         return_value = defaultdict(lambda: [])
 
@@ -466,6 +571,61 @@ class DataCache(object):
         self.primed_this["sel_birth"] += 1
         return return_value
 
+    @memoized
+    def name_index(self):
+        """Sorted (name variant, chara id) pairs for suggest_names. Every chara
+           is indexed by id, conventional (romaji) name, kanji and kana, plus
+           each individual word of those."""
+        pairs = set()
+        for chara_id, name in self.names.items():
+            variants = {str(chara_id), name.kanji}
+            for spaced in (name.conventional, name.kanji_spaced, name.kana_spaced):
+                if not spaced:
+                    continue
+                variants.add(spaced)
+                variants.add(spaced.replace(" ", ""))
+                variants.update(spaced.split())
+
+            pairs.update((fold_name(v), chara_id) for v in variants if v)
+
+        pairs = sorted(pairs)
+        return [v for v, _ in pairs], [c for _, c in pairs]
+
+    def suggest_names(self, query, limit):
+        """Returns up to `limit` chara ids. Prefix matches on any name variant
+           come first; if there aren't enough, the rest are filled in with
+           fuzzy (subsequence) matches, shortest match first."""
+        query = fold_name(query)
+        if not query:
+            return []
+
+        keys, ids = self.name_index()
+        result = []
+
+        for i in range(bisect_left(keys, query), len(keys)):
+            if not keys[i].startswith(query):
+                break
+            if ids[i] not in result:
+                result.append(ids[i])
+                if len(result) >= limit:
+                    return result
+
+        fuzzy = re.compile(".*?".join(map(re.escape, query)))
+        candidates = []
+        for key, chara_id in zip(keys, ids):
+            if chara_id in result:
+                continue
+            match = fuzzy.search(key)
+            if match:
+                candidates.append((match.end() - match.start(), match.start(), chara_id))
+
+        for _, _, chara_id in sorted(candidates):
+            if chara_id not in result:
+                result.append(chara_id)
+                if len(result) >= limit:
+                    break
+        return result
+
     def potential_birthdays(self, date):
         # the date changes depending on timezone.
         # we can't assume everyone is in UTC, so we'll
@@ -489,10 +649,11 @@ class DataCache(object):
 
         return self.charas(pool)
 
-    def live_gacha_rates(self, gacha_t, done):
-        def update_livecache_for_gacha_rates(http, api_data):
+    def fetch_live_gacha_rates(self, gacha_id, done):
+        def parse_gacha_rates(http, api_data):
             if not api_data:
                 done(None)
+                return
 
             try:
                 rate_dict = api_data[b"data"][b"gacha_rate"][b"charge"]
@@ -502,23 +663,31 @@ class DataCache(object):
                     cl = {X[b"card_id"]: float(X[b"charge_odds"]) for X in api_data[b"data"][b"idol_list"].get(k, [])}
                     individual_rate_dict.update(cl)
 
-                self.live_cache["gacha"][gacha_t.id] = {
+                result = {
                     "rates": gacha_rates_t(float(rate_dict[b"r"]), float(rate_dict[b"sr"]), float(rate_dict[b"ssr"])),
                     "indiv": individual_rate_dict,
-                    "gacha": gacha_t.id,
+                    "gacha": gacha_id,
                 }
-            finally:
-                done(self.live_cache["gacha"].get(gacha_t.id, None))
+            except (KeyError, TypeError, ValueError) as e:
+                print("trace live_gacha_rates: bad response for", gacha_id, e)
+                result = None
+            done(result)
 
-        cached = self.live_cache["gacha"].get(gacha_t.id)
+        apiclient.gacha_rates(gacha_id, parse_gacha_rates)
 
-        if cached is None:
-            if apiclient.is_usable():
-                apiclient.gacha_rates(gacha_t.id, update_livecache_for_gacha_rates)
-            else:
-                ioloop.IOLoop.current().add_callback(done, None)
+    def live_gacha_rates(self, gacha_t, done):
+        """ Calls done with the gacha's rates from the game API (or None),
+            waiting for the API only if nothing is cached. """
+        if apiclient.is_usable():
+            self.live_cache["gacha"].get(gacha_t.id, done)
         else:
-            ioloop.IOLoop.current().add_callback(done, cached)
+            ioloop.IOLoop.current().add_callback(done, None)
+
+    def live_gacha_rates_nowait(self, gacha_t):
+        """ The cached rates, or None (in which case they're fetched for next time). """
+        if apiclient.is_usable():
+            return self.live_cache["gacha"].peek(gacha_t.id)
+        return None
 
     def __del__(self):
         self.hnd.close()
@@ -526,6 +695,11 @@ class DataCache(object):
 def display_app_ver():
     return os.environ.get("VC_APP_VER", "(unset)")
 
+def display_last_version_check():
+    if not last_version_check:
+        return "(never)"
+    return datetime.utcfromtimestamp(last_version_check).strftime("%Y-%m-%d %H:%M:%S UTC")
+
 def do_preswitch_tasks(new_db_path, old_db_path):
     print("trace do_preswitch_tasks", new_db_path, old_db_path)
     subprocess.call(["toolchain/name_finder.py",
@@ -539,79 +713,200 @@ def do_preswitch_tasks(new_db_path, old_db_path):
     if old_db_path:
         subprocess.call(["toolchain/make_contiguous_gacha.py", old_db_path, new_db_path])
 
-def update_to_res_ver(res_ver):
-    global is_updating_to_new_truth
-
-    def ok_to_reload(path):
-        global data, last_version_check, is_updating_to_new_truth
+def abandon_update():
+    """ Gives up on a version check or update that never finished, so the
+        next one can start. Its callbacks are ignored if they do turn up. """
+    global is_updating_to_new_truth, updating_to_version, update_phase, update_generation
+
+    print("trace abandon_update", updating_to_version, update_phase)
+    update_generation += 1
+    is_updating_to_new_truth = 0
+    updating_to_version = None
+    update_phase = None
+
+def update_to_res_ver(res_ver, done=None):
+    """ Downloads truth res_ver and runs do_preswitch_tasks on it, then
+        switches to it. The slow parts happen in the background, and the
+        current truth keeps being served until the new one is ready.
+        done(error) is called at the end, with None for success.
+
+        A truth that was already downloaded (by an earlier attempt that
+        failed later on, or put in place by hand) isn't downloaded again. """
+    global is_updating_to_new_truth, updating_to_version, update_phase
+    generation = update_generation
+
+    def abandoned():
+        if generation != update_generation:
+            print("trace update_to_res_ver: update to", res_ver, "was abandoned")
+            return 1
+        return 0
+
+    def finish(error):
+        global is_updating_to_new_truth, updating_to_version, update_phase, last_version_check
 
         is_updating_to_new_truth = 0
+        updating_to_version = None
+        update_phase = None
         last_version_check = time()
+        if done:
+            done(error)
 
-        if path:
-            try:
-                do_preswitch_tasks(path, transient_data_path("{0}.mdb".format(data.version)) if data else None)
-                data = DataCache(res_ver)
-                apiclient.ApiClient.shared().res_ver = str(res_ver)
-            except Exception as e:
-                print("do_preswitch_tasks croaked, update aborted.")
-                raise
+    def ok_to_reload(path):
+        global update_phase
+        if abandoned():
+            return
+
+        if not path:
+            finish(RuntimeError("couldn't download truth {0}".format(res_ver)))
+            return
+
+        update_phase = "preparing"
+        old_db_path = transient_data_path("{0}.mdb".format(data.version)) if data else None
+        future = preswitch_executor.submit(do_preswitch_tasks, path, old_db_path)
+        ioloop.IOLoop.current().add_future(future, preswitch_done)
+
+    def preswitch_done(future):
+        global update_phase
+        if abandoned():
+            return
+
+        try:
+            future.result()
+        except Exception as e:
+            print("do_preswitch_tasks croaked, update aborted.")
+            traceback.print_exc()
+            finish(e)
+            return
+
+        update_phase = "switching"
+        switch_to_version(res_ver, switched)
+
+    def switched(error):
+        if not abandoned():
+            finish(error)
 
     is_updating_to_new_truth = 1
-    mdb_path = ark_data_path("{0}.mdb".format(res_ver))
-    if not os.path.exists(mdb_path):
-        acquisition.get_master(res_ver, transient_data_path("{0}.mdb".format(res_ver)), ok_to_reload)
-    else:
-        ok_to_reload(mdb_path)
+    updating_to_version = str(res_ver)
+    for mdb_path in (ark_data_path("{0}.mdb".format(res_ver)), transient_data_path("{0}.mdb".format(res_ver))):
+        if os.path.exists(mdb_path):
+            ok_to_reload(mdb_path)
+            return
+
+    update_phase = "downloading"
+    acquisition.get_master(res_ver, transient_data_path("{0}.mdb".format(res_ver)), ok_to_reload)
+
+def load_version(res_ver):
+    new_data = DataCache(res_ver)
+    new_data.warm_up()
+    return new_data
+
+def install_version(new_data):
+    global data
+
+    data = new_data
+    apiclient.ApiClient.shared().res_ver = str(new_data.version)
+
+    for listener in data_switch_listeners:
+        listener()
+
+def switch_to_version(res_ver, done=None):
+    """ Starts serving a truth version whose mdb is already in place and
+        processed (i.e. do_preswitch_tasks has run for it).
+
+        With done, the new DataCache is loaded and warmed up on
+        preswitch_executor while the current one keeps serving, and
+        done(error) is called once it has been swapped in. Without it,
+        everything happens before returning, which is only OK before the
+        IOLoop is serving anything. """
+    if done is None:
+        install_version(load_version(res_ver))
+        return
 
-def check_version_api_recv(response, msg):
+    def loaded(future):
+        try:
+            install_version(future.result())
+        except Exception as e:
+            print("couldn't switch to truth", res_ver)
+            traceback.print_exc()
+            done(e)
+        else:
+            done(None)
+
+    ioloop.IOLoop.current().add_future(preswitch_executor.submit(load_version, res_ver), loaded)
+
+def check_version_api_recv(done, generation, response, msg):
     global is_updating_to_new_truth
 
+    if generation != update_generation:
+        print("trace check_version_api_recv: check was abandoned")
+        return
+
     if response.error:
         is_updating_to_new_truth = 0
-        response.rethrow()
+        done(response.error)
         return
 
-    res_ver = msg.get(b"data_headers", {}).get(b"required_res_ver", b"-1").decode("utf8")
+    try:
+        res_ver = msg.get(b"data_headers", {}).get(b"required_res_ver", b"-1").decode("utf8")
+    except (AttributeError, TypeError, UnicodeDecodeError) as e:
+        is_updating_to_new_truth = 0
+        done(ValueError("unexpected /load/check reply: {0!r}".format(e)))
+        return
     if not data or res_ver != data.version:
         if res_ver != "-1":
-            update_to_res_ver(res_ver)
+            update_to_res_ver(res_ver, done)
+            return
         else:
             print("no required_res_ver, we're either on latest or app update available")
-            is_updating_to_new_truth = 0
             # FIXME if data is none, we'll get stuck after this
-    else:
-        is_updating_to_new_truth = 0
 
-def check_version():
+    is_updating_to_new_truth = 0
+    done(None)
+
+def check_version(done=None):
+    """ Asks the game API which truth is current, and updates to it if it's
+        not the one we have. done(error) is called when that's over, with
+        None for success (including when there was nothing to do).
+        Normally called by a VersionCheckScheduler, not directly. """
     global is_updating_to_new_truth, last_version_check
 
-    if not is_updating_to_new_truth and (time() - last_version_check >= 3600
-                                         or time() < last_version_check):
-        if not apiclient.is_usable():
-            return
+    if done is None:
+        done = lambda error: None
 
-        print("trace check_version")
-        if data:
-            data.vc_this = 1
+    if not check_version_enabled or not apiclient.is_usable() or is_updating_to_new_truth:
+        ioloop.IOLoop.current().add_callback(done, None)
+        return
 
-        is_updating_to_new_truth = 1
-        # usually updates happen on the hour so this keeps our
-        # schedule on the hour too
-        t = time()
-        last_version_check = t - (t % 3600)
-        apiclient.versioncheck(check_version_api_recv)
+    print("trace check_version")
+    is_updating_to_new_truth = 1
+    last_version_check = time()
+    apiclient.versioncheck(partial(check_version_api_recv, done, update_generation))
 
 is_updating_to_new_truth = 0
+updating_to_version = None
+# "downloading", "preparing" or "switching" while updating_to_version is set
+update_phase = None
+# bumped by abandon_update, so callbacks from before it can tell
+update_generation = 0
 last_version_check = 0
+# do_preswitch_tasks runs tools that take a while; keep them off the IOLoop.
+preswitch_executor = ThreadPoolExecutor(1)
+# When serving from several processes, only one of them checks for updates.
+check_version_enabled = 1
 data = None
+# called with no arguments after `data` is replaced by a new truth version
+data_switch_listeners = []
 
-def init():
+def init(args=None):
+    """ args are the command line arguments left after tornado's options; the
+        first one, if any, is the truth version to load. """
     global data
+    if args is None:
+        args = sys.argv[1:]
     available_mdbs = sorted(list(filter(lambda x: x.endswith(".mdb"), os.listdir(transient_data_path()))), reverse=1)
 
     try:
-        explicit_vers = int(sys.argv[1])
+        explicit_vers = int(args[0])
     except (ValueError, IndexError):
         if available_mdbs:
             explicit_vers = available_mdbs[0].split(".")[0]
@@ -631,7 +926,7 @@ def init():
             check_version()
         else:
             try:
-                vers = int(sys.argv[1])
+                vers = int(args[0])
             except (ValueError, IndexError):
                 print("No data installed and we can't get it automatically. Crashing.")
                 print("Hint: Try running this again with a version number.")
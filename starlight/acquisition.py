@@ -1,18 +1,24 @@
 import os
 import sqlite3
 import lz4
-import io
+import mmap
+import struct
+import hashlib
 from time import time
 from email.utils import mktime_tz, parsedate_tz
-from collections import namedtuple
-from tornado import httpclient
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tornado import httpclient, ioloop, gen
+from tornado.concurrent import Future
 
 try:
     lz4_decompress = lz4.loads
+    lz4_has_size_argument = 0
     print("Warning: You're using an outdated LZ4 library. Please update it with pip.")
 except AttributeError:
     import lz4.block
     lz4_decompress = lz4.block.decompress
+    lz4_has_size_argument = 1
 
 DBMANIFEST = "https://asset-starlight-stage.akamaized.net/dl/{0}/manifests"
 ASSETBBASEURL = "https://asset-starlight-stage.akamaized.net/dl/resources/AssetBundles"
@@ -24,21 +30,242 @@ try:
 except FileExistsError:
     pass
 
+# Truth files are tens of megabytes, and the default timeout is 20 seconds.
+DOWNLOAD_TIMEOUT = 600
+# Decompression takes a moment, so it's done here instead of on the IOLoop.
+unpack_executor = ThreadPoolExecutor(1)
+
 def extra_acquisition_headers():
     return {"X-Unity-Version": os.environ.get("VC_UNITY_VER", "5.4.5p1")}
 
+def hash_file(path):
+    """ Returns (md5 object, size) for the file at path. Files can be tens of
+        megabytes, so call this on unpack_executor. """
+    digest = hashlib.md5()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest, size
+
+def md5_of_file(path):
+    return hash_file(path)[0].hexdigest()
+
+class Download(object):
+    """ One file, streamed to dest_file.part as it arrives (never held in
+        memory) and hashed on the way, then renamed to dest_file if its md5
+        matches. When the md5 is known, a .part left over from an earlier
+        attempt is continued with a Range request instead of started over.
+        Without one there'd be no way to tell if the pieces belong together. """
+    def __init__(self, url, dest_file, md5=None):
+        self.url = url
+        self.dest_file = dest_file
+        self.tmp_file = dest_file + ".part"
+        self.md5 = md5
+        self.error = None
+
+    def start(self, callback):
+        """ Calls callback(path, response), where path is None if the
+            download failed (and self.error says why). response is None if
+            it failed before a request was made. """
+        self.callback = callback
+        self.code = None
+
+        if self.md5 and os.path.exists(self.tmp_file):
+            future = unpack_executor.submit(hash_file, self.tmp_file)
+            ioloop.IOLoop.current().add_future(future, self.resume)
+        else:
+            self.request(hashlib.md5(), 0)
+
+    def resume(self, future):
+        try:
+            try:
+                digest, offset = future.result()
+            except OSError as e:
+                print("trace Download: can't read", self.tmp_file, e)
+                digest, offset = hashlib.md5(), 0
+            self.request(digest, offset)
+        except Exception as e:
+            # Anything escaping here would be swallowed by the IOLoop and the
+            # callback would never be called.
+            self.error = e
+            print("trace Download: failed", self.url, self.error)
+            self.callback(None, None)
+
+    def request(self, digest, offset):
+        self.digest = digest
+        self.offset = offset
+
+        headers = extra_acquisition_headers()
+        if self.offset:
+            headers["Range"] = "bytes={0}-".format(self.offset)
+
+        try:
+            os.makedirs(os.path.dirname(self.tmp_file) or ".", exist_ok=True)
+            self.out = open(self.tmp_file, "ab" if self.offset else "wb")
+        except OSError as e:
+            self.error = e
+            print("trace Download: failed", self.url, self.error)
+            return self.callback(None, None)
+
+        req = httpclient.HTTPRequest(self.url, headers=headers,
+            header_callback=self.on_header, streaming_callback=self.on_chunk,
+            request_timeout=DOWNLOAD_TIMEOUT)
+        httpclient.AsyncHTTPClient().fetch(req, self.on_done)
+
+    def on_header(self, line):
+        if line.startswith("HTTP/"):
+            self.code = int(line.split(" ", 2)[1])
+            if self.code == 200 and self.offset:
+                # The server ignored our Range, so it's starting from the top.
+                self.out.seek(0)
+                self.out.truncate()
+                self.digest = hashlib.md5()
+                self.offset = 0
+
+    def on_chunk(self, chunk):
+        # Error pages are streamed too; keep them out of the file.
+        if self.code in (200, 206):
+            self.digest.update(chunk)
+            self.out.write(chunk)
+
+    def on_done(self, response):
+        # Always call back exactly once, even if cleaning up fails, so that
+        # fetch_all doesn't wait forever for this file.
+        try:
+            path = self.finish(response)
+        except Exception as e:
+            # If it was removing a bad .part that failed, the reason it
+            # was bad is the more useful error.
+            if self.error is None:
+                self.error = e
+            path = None
+            print("trace Download: failed", self.url, e)
+        self.callback(path, response)
+
+    def finish(self, response):
+        """ Returns dest_file, or None with self.error set. """
+        self.out.close()
+
+        # 416 means we already had all of it.
+        if response.error and not (response.code == 416 and self.offset):
+            self.error = response.error
+            print("trace Download: failed", self.url, self.error)
+            # Keep partial data from a dropped connection for next time.
+            if not (self.md5 and response.code == 599):
+                os.unlink(self.tmp_file)
+            return None
+
+        if self.md5 and self.digest.hexdigest() != self.md5:
+            self.error = ValueError("md5 mismatch: got {0}, expected {1}".format(self.digest.hexdigest(), self.md5))
+            print("trace Download: failed", self.url, self.error)
+            os.unlink(self.tmp_file)
+            return None
+
+        os.replace(self.tmp_file, self.dest_file)
+        return self.dest_file
+
+def fetch_to_file(url, dest_file, md5, callback):
+    """ Downloads url to dest_file; see Download. Calls callback(path, response),
+        where path is None if the download failed or didn't match md5. """
+    Download(url, dest_file, md5).start(callback)
+
+def unpack_file(src, dest):
+    """ Decompresses a Unity LZ4 file (a 16-byte header with the unpacked size
+        at offset 4, then one LZ4 block) from src to dest. The compressed data
+        is mapped rather than read, so only the output is held in memory. """
+    tmp_file = dest + ".part"
+
+    with open(src, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size, = struct.unpack_from("<I", mm, 4)
+        if lz4_has_size_argument:
+            with memoryview(mm) as whole, whole[16:] as block:
+                data = lz4_decompress(block, uncompressed_size=size)
+        else:
+            data = lz4_decompress(mm[4:8] + mm[16:])
+
+    with open(tmp_file, "wb") as out:
+        out.write(data)
+        del data
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_file, dest)
+
+def fetch_and_unpack(url, dest_file, md5, callback):
+    """ fetch_to_file, then unpack_file into dest_file on a worker thread.
+        The compressed download is kept alongside as dest_file.lz4 only until
+        it's unpacked. Calls callback(path, response) like fetch_to_file. """
+    compressed = dest_file + ".lz4"
+
+    def fetched(path, response):
+        if not path:
+            return callback(None, response)
+
+        future = unpack_executor.submit(unpack_file, compressed, dest_file)
+        ioloop.IOLoop.current().add_future(future, lambda f: unpacked(f, response))
+
+    def unpacked(future, response):
+        os.unlink(compressed)
+        try:
+            future.result()
+        except Exception as e:
+            print("trace fetch_and_unpack: couldn't unpack", url, e)
+            return callback(None, response)
+        callback(dest_file, response)
+
+    fetch_to_file(url, compressed, md5, fetched)
+
 def filename(version, platform, asset_qual, sound_qual):
     return "{0}_{1}_{2}_{3}".format(version, platform, asset_qual, sound_qual)
 
-def read_manifest(version, platform, asset_qual, sound_qual, callback):
-    dest_file = os.path.join(CACHE, filename(version, platform, asset_qual, sound_qual))
+manifest_entry_t = namedtuple("manifest_entry_t", ("hash", "attr"))
+class ManifestIndex(object):
+    """ Every name -> manifest_entry_t in one manifest, read once. """
+    def __init__(self, entries):
+        self.entries = entries
+
+    @classmethod
+    def from_file(cls, path):
+        conn = sqlite3.connect(path)
+        try:
+            return cls({name: manifest_entry_t(hash, attr)
+                for name, hash, attr in conn.execute("SELECT name, hash, attr FROM manifests")})
+        finally:
+            conn.close()
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+# manifest filename -> ManifestIndex, most recently used last
+MANIFEST_INDEXES = OrderedDict()
+MAX_MANIFEST_INDEXES = 4
+
+def manifest_index(version, platform, asset_qual, sound_qual, callback):
+    """ Calls callback with the ManifestIndex for the given manifest (downloading
+        it if needed), or None. Indexes are kept in memory for reuse. """
+    key = filename(version, platform, asset_qual, sound_qual)
+    index = MANIFEST_INDEXES.get(key)
+    if index is not None:
+        MANIFEST_INDEXES.move_to_end(key)
+        return callback(index)
+
+    dest_file = os.path.join(CACHE, key)
 
     def acquire_complete(path):
         if not path:
             return callback(None)
 
-        conn = sqlite3.connect(path)
-        callback(conn)
+        index = MANIFEST_INDEXES[key] = ManifestIndex.from_file(path)
+        if len(MANIFEST_INDEXES) > MAX_MANIFEST_INDEXES:
+            MANIFEST_INDEXES.popitem(last=False)
+        callback(index)
 
     if not os.path.exists(dest_file):
         acquire_manifest(version, platform, asset_qual, sound_qual, dest_file, acquire_complete)
@@ -49,21 +276,9 @@ manifest_selector_t = namedtuple("manifest_selector_t", ("filename", "md5", "pla
 def acquire_manifest(version, platform, asset_qual, sound_qual, dest_file, callback):
     cl = httpclient.AsyncHTTPClient()
 
-    def read_manifest(response):
+    def read_manifest(path, response):
         print("trace read_manifest", response)
-
-        if response.error:
-            return callback(None)
-
-        buf = response.buffer.read()
-        bio = io.BytesIO()
-        bio.write(buf[4:8])
-        bio.write(buf[16:])
-        data = lz4_decompress(bio.getvalue())
-        with open(dest_file, "wb") as write_db:
-            write_db.write(data)
-
-        callback(dest_file)
+        callback(path)
 
     def read_meta_manifest(response):
         print("trace read_meta_manifest", response)
@@ -72,19 +287,17 @@ def acquire_manifest(version, platform, asset_qual, sound_qual, dest_file, callb
 
         m = response.body.decode("utf8")
         mp = map(lambda x: manifest_selector_t(* x.split(",")), filter(bool, m.split("\n")))
-        get_file = None
         for selector in mp:
             if selector.platform == platform and \
                selector.asset_qual == asset_qual and \
                selector.sound_qual == sound_qual:
-                get_file = selector.filename
                 break
         else:
             print("No such candidate found for", platform, asset_qual, sound_qual)
             return callback(None)
 
-        abso = "/".join(( DBMANIFEST.format(version), get_file ))
-        cl.fetch(abso, read_manifest, headers=extra_acquisition_headers())
+        abso = "/".join(( DBMANIFEST.format(version), selector.filename ))
+        fetch_and_unpack(abso, dest_file, selector.md5, read_manifest)
 
     meta = "/".join(( DBMANIFEST.format(version), "all_dbmanifest" ))
     cl.fetch(meta, read_meta_manifest, headers=extra_acquisition_headers())
@@ -92,41 +305,111 @@ def acquire_manifest(version, platform, asset_qual, sound_qual, dest_file, callb
 def get_master(res_ver, to_path, done):
     print("trace get_master", res_ver, to_path, done)
 
-    def got_master(response):
+    def got_master(path, response):
         print("trace got_master", response)
 
-        if response.error:
+        if not path:
             return done(None)
 
-        buf = response.buffer.read()
-        bio = io.BytesIO()
-        bio.write(buf[4:8])
-        bio.write(buf[16:])
-        data = lz4_decompress(bio.getvalue())
-        with open(to_path, "wb") as write_db:
-            write_db.write(data)
-
         mdate = response.headers.get("Last-Modified")
         if mdate:
             tt = parsedate_tz(mdate)
             mtime = mktime_tz(tt) if tt else int(time())
         else:
-            mtime = int(time.time())
+            mtime = int(time())
         os.utime(to_path, (-1, mtime))
         done(to_path)
 
-    def got_manifest(connection):
-        print("trace got_manifest", connection)
+    def got_manifest(index):
+        print("trace got_manifest", index)
 
-        if not connection:
+        entry = index.get("master.mdb") if index else None
+        if not entry:
             return done(None)
 
-        cur = connection.execute("SELECT hash, attr FROM manifests WHERE name = ?", ("master.mdb",))
-        hash, attr = cur.fetchone()
-        connection.close()
+        url = SQLBASEURL.format(entry.hash, entry.hash[0:2])
+        # Generic resources are named after the md5 of their (compressed) contents.
+        fetch_and_unpack(url, to_path, entry.hash, got_master)
+
+    manifest_index(res_ver, "Android", "High", "High", got_manifest)
+
+fetch_job_t = namedtuple("fetch_job_t", ("url", "dest_file", "md5"))
+
+def fetch_jobs(index, names, dest_dir, url_format=SQLBASEURL):
+    """ fetch_job_t for each name in a ManifestIndex. url_format is formatted
+        with the hash and its first two characters. """
+    jobs = []
+    for name in names:
+        entry = index.get(name)
+        if entry is None:
+            raise KeyError(name)
+        jobs.append(fetch_job_t(url_format.format(entry.hash, entry.hash[0:2]),
+                                os.path.join(dest_dir, name), entry.hash))
+    return jobs
+
+class MultiFetcher(object):
+    """ Downloads a list of fetch_job_t, at most `concurrency` at a time.
+        Files that are already in place with the right md5 are skipped, and a
+        failed download is retried (continuing where it stopped, see
+        Download) up to `retries` times. """
+    def __init__(self, concurrency=4, retries=2):
+        self.concurrency = concurrency
+        self.retries = retries
+
+        self.fetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self.attempts = 0
+
+    @gen.coroutine
+    def fetch_all(self, jobs):
+        """ Resolves to {dest_file: None if it's there, or the last error}. """
+        results = {}
+        pending = iter(jobs)
+
+        @gen.coroutine
+        def worker():
+            # All the workers share one iterator, so each job is taken once.
+            for job in pending:
+                results[job.dest_file] = yield self.fetch_one(job)
+
+        yield [worker() for _ in range(self.concurrency)]
+        return results
+
+    @gen.coroutine
+    def fetch_one(self, job):
+        try:
+            if job.md5 and os.path.exists(job.dest_file):
+                digest = yield unpack_executor.submit(md5_of_file, job.dest_file)
+                if digest == job.md5:
+                    self.skipped += 1
+                    return None
+
+            for attempt in range(self.retries + 1):
+                self.attempts += 1
+                download = Download(job.url, job.dest_file, job.md5)
+                path = yield self.run(download)
+                if path:
+                    self.fetched += 1
+                    return None
+        except OSError as e:
+            # Only this job's problem; the other workers carry on.
+            print("trace MultiFetcher: failed", job.dest_file, e)
+            self.failed += 1
+            return e
+
+        self.failed += 1
+        return download.error
 
-        url = SQLBASEURL.format(hash, hash[0:2])
-        cl = httpclient.AsyncHTTPClient()
-        cl.fetch(url, got_master, headers=extra_acquisition_headers())
+    def run(self, download):
+        future = Future()
+        download.start(lambda path, response: future.set_result(path))
+        return future
 
-    read_manifest(res_ver, "Android", "High", "High", got_manifest)
+    def stats(self):
+        return {
+            "fetched": self.fetched,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "attempts": self.attempts,
+        }
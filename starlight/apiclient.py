@@ -17,7 +17,8 @@
 
 import base64, msgpack, hashlib, random, time, os
 from tornado import httpclient
-import binascii, pyaes
+import binascii
+from .cipher import encrypt_cbc, decrypt_cbc
 
 # laziness
 def VIEWER_ID_KEY():
@@ -26,18 +27,6 @@ def VIEWER_ID_KEY():
 def SID_KEY():
     return os.getenv("VC_SID_SALT", "").encode("ascii")
 
-def decrypt_cbc(s, iv, key):
-    e = pyaes.Decrypter(pyaes.AESModeOfOperationCBC(key, iv))
-    clear = e.feed(s)
-    clear += e.feed()
-    return clear
-
-def encrypt_cbc(s, iv, key):
-    e = pyaes.Encrypter(pyaes.AESModeOfOperationCBC(key, iv))
-    clear = e.feed(s)
-    clear += e.feed()
-    return clear
-
 def is_usable():
     return all([x in os.environ for x in ["VC_ACCOUNT", "VC_AES_KEY", "VC_SID_SALT"]]) \
         and not os.getenv("DISABLE_AUTO_UPDATES", None)
@@ -112,9 +101,17 @@ class ApiClient(object):
                 done(response, None)
                 return
 
-            reply = base64.b64decode(response.buffer.read())
-            plain = decrypt_cbc(reply[:-32], iv, reply[-32:]).split(b"\0")[0]
-            msg = msgpack.unpackb(base64.b64decode(plain))
+            try:
+                reply = base64.b64decode(response.buffer.read())
+                plain = decrypt_cbc(reply[:-32], iv, reply[-32:]).split(b"\0")[0]
+                msg = msgpack.unpackb(base64.b64decode(plain))
+            except Exception as e:
+                # Callers only look at response.error, so report it there.
+                print("trace ApiClient: couldn't decode reply:", e)
+                response.error = e
+                done(response, None)
+                return
+
             try:
                 self.sid = msg["data_headers"]["sid"]
             except:
@@ -0,0 +1,160 @@
+""" AES-CBC for apiclient, using the fastest implementation that's installed.
+
+    `cryptography` and PyCryptodome (as Crypto or Cryptodome) are tried
+    first, then starlight.rijndael and pyaes, which are pure Python but
+    always there. $AES_BACKEND forces one by name. A backend has to pass
+    the known-answer tests before it's used.
+
+    Padding is PKCS#7, added and stripped here exactly the way pyaes does it,
+    so every backend gives the same results. """
+
+import os
+import binascii
+
+class PyAESBackend(object):
+    name = "pyaes"
+
+    def __init__(self):
+        import pyaes
+        self.mode = pyaes.AESModeOfOperationCBC
+
+    def encrypt(self, data, iv, key):
+        mode = self.mode(key, iv)
+        return b"".join(mode.encrypt(data[i:i + 16]) for i in range(0, len(data), 16))
+
+    def decrypt(self, data, iv, key):
+        mode = self.mode(key, iv)
+        return b"".join(mode.decrypt(data[i:i + 16]) for i in range(0, len(data), 16))
+
+class RijndaelBackend(object):
+    name = "rijndael"
+
+    def __init__(self):
+        from . import rijndael
+        self.rijndael = rijndael.rijndael
+
+    def encrypt(self, data, iv, key):
+        return self.rijndael(key).encrypt_cbc(data, iv)
+
+    def decrypt(self, data, iv, key):
+        return self.rijndael(key).decrypt_cbc(data, iv)
+
+class CryptographyBackend(object):
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self.backend = default_backend()
+        self.Cipher, self.AES, self.CBC = Cipher, algorithms.AES, modes.CBC
+
+    def cipher(self, iv, key):
+        return self.Cipher(self.AES(key), self.CBC(iv), backend=self.backend)
+
+    def encrypt(self, data, iv, key):
+        e = self.cipher(iv, key).encryptor()
+        return e.update(data) + e.finalize()
+
+    def decrypt(self, data, iv, key):
+        d = self.cipher(iv, key).decryptor()
+        return d.update(data) + d.finalize()
+
+class PyCryptodomeBackend(object):
+    name = "pycryptodome"
+
+    def __init__(self):
+        try:
+            from Cryptodome.Cipher import AES
+        except ImportError:
+            from Crypto.Cipher import AES
+        self.AES = AES
+
+    def encrypt(self, data, iv, key):
+        return self.AES.new(key, self.AES.MODE_CBC, iv).encrypt(data)
+
+    def decrypt(self, data, iv, key):
+        return self.AES.new(key, self.AES.MODE_CBC, iv).decrypt(data)
+
+# in order of preference
+BACKENDS = (CryptographyBackend, PyCryptodomeBackend, RijndaelBackend, PyAESBackend)
+
+def pad(data):
+    n = 16 - (len(data) % 16)
+    return data + bytes((n,)) * n
+
+def unpad(data):
+    if len(data) % 16:
+        raise ValueError("invalid length")
+    n = data[-1]
+    if n > 16:
+        raise ValueError("invalid padding byte")
+    return data[:-n]
+
+# NIST SP 800-38A, F.2: CBC-AES128, 192 and 256. (key, iv, plaintext, ciphertext)
+KNOWN_ANSWERS = [(binascii.unhexlify(k), binascii.unhexlify(iv), binascii.unhexlify(p), binascii.unhexlify(c))
+                 for k, iv, p, c in (
+    ("2b7e151628aed2a6abf7158809cf4f3c",
+     "000102030405060708090a0b0c0d0e0f",
+     "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51"
+     "30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710",
+     "7649abac8119b246cee98e9b12e9197d5086cb9b507219ee95db113a917678b2"
+     "73bed6b8e3c1743b7116e69e222295163ff1caa1681fac09120eca307586e1a7"),
+    ("8e73b0f7da0e6452c810f32b809079e562f8ead2522c6b7b",
+     "000102030405060708090a0b0c0d0e0f",
+     "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51"
+     "30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710",
+     "4f021db243bc633d7178183a9fa071e8b4d9ada9ad7dedf4e5e738763f69145a"
+     "571b242012fb7ae07fa9baac3df102e008b0e27988598881d920a9e64f5615cd"),
+    ("603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4",
+     "000102030405060708090a0b0c0d0e0f",
+     "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51"
+     "30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710",
+     "f58c4c04d6e5f1ba779eabfb5f7bfbd69cfc4e967edb808d679f777bc6702c7d"
+     "39f23369a9d9bacfa530e26304231461b2eb05e2c39be9fcda6c19078c6a9d1b"),
+)]
+
+def selftest(backend):
+    """ Raises RuntimeError if backend gets any of KNOWN_ANSWERS wrong. Not
+        done with assert, since python -O would skip the checks. """
+    for key, iv, plain, cipher in KNOWN_ANSWERS:
+        if backend.encrypt(plain, iv, key) != cipher:
+            raise RuntimeError("{0}: wrong answer encrypting with a {1}-byte key".format(backend.name, len(key)))
+        if backend.decrypt(cipher, iv, key) != plain:
+            raise RuntimeError("{0}: wrong answer decrypting with a {1}-byte key".format(backend.name, len(key)))
+
+    for n in (0, 1, 15, 16, 17):
+        if unpad(backend.decrypt(backend.encrypt(pad(b"x" * n), iv, key), iv, key)) != b"x" * n:
+            raise RuntimeError("{0}: {1} bytes didn't survive padding".format(backend.name, n))
+
+def available_backends():
+    ret = []
+    for cls in BACKENDS:
+        try:
+            ret.append(cls())
+        except ImportError:
+            pass
+        except Exception as e:
+            print("trace cipher: backend", cls.name, "is installed but won't load:", repr(e))
+    return ret
+
+def choose_backend(name=None):
+    for backend in available_backends():
+        if name and backend.name != name:
+            continue
+        try:
+            selftest(backend)
+        except Exception as e:
+            # A broken build can fail in all sorts of ways, not just with
+            # wrong answers; any of them means try the next one.
+            print("trace cipher: backend", backend.name, "failed its self test:", repr(e))
+            continue
+        return backend
+    raise RuntimeError("no usable AES backend{0}".format(" named " + name if name else ""))
+
+BACKEND = choose_backend(os.environ.get("AES_BACKEND") or None)
+
+def encrypt_cbc(s, iv, key):
+    return BACKEND.encrypt(pad(s), iv, key)
+
+def decrypt_cbc(s, iv, key):
+    return unpad(BACKEND.decrypt(s, iv, key))
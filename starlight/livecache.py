@@ -0,0 +1,140 @@
+""" A cache for things fetched from the game API.
+
+    A value is fresh for `ttl` seconds, and for `stale_ttl` seconds after that
+    it's still served, but the first request to see it stale starts a refresh
+    in the background. Only one fetch per key is ever in flight; everyone who
+    asks while it is waits for the same one. A fetch that fails or takes
+    longer than `timeout` seconds is remembered for `negative_ttl` seconds
+    (during which the stale value, if any, keeps being served) so a broken
+    API isn't asked again on every request. """
+
+from time import time
+from functools import partial
+from tornado import ioloop
+
+class Entry(object):
+    __slots__ = ("value", "expires", "stale_until")
+
+    def __init__(self, value, expires, stale_until):
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
+
+class LiveCache(object):
+    def __init__(self, fetch, ttl=300, stale_ttl=3600, negative_ttl=60, timeout=10):
+        """ fetch(key, callback) must eventually call callback(value), with
+            None meaning it failed. """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+
+        self.entries = {}
+        # key -> list of callbacks waiting for the fetch
+        self.in_flight = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetches = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def usable(self, key):
+        """ (value, waiting_is_needed). Starts a refresh if the value is stale. """
+        entry = self.entries.get(key)
+        now = time()
+
+        if entry is not None:
+            if now < entry.expires:
+                self.hits += 1
+                return entry.value, 0
+            if entry.value is not None and now < entry.stale_until:
+                self.stale_hits += 1
+                self.refresh(key)
+                return entry.value, 0
+
+        self.misses += 1
+        return None, 1
+
+    def get(self, key, done):
+        """ Calls done(value) from the IOLoop, waiting for a fetch only if
+            there's nothing servable in the cache. """
+        value, must_wait = self.usable(key)
+        if must_wait:
+            self.refresh(key, done)
+        else:
+            ioloop.IOLoop.current().add_callback(done, value)
+
+    def peek(self, key):
+        """ Like get, but never waits: a miss returns None and starts a fetch
+            so the value is there for later requests. """
+        value, must_wait = self.usable(key)
+        if must_wait:
+            self.refresh(key)
+        return value
+
+    def refresh(self, key, done=None):
+        waiters = self.in_flight.get(key)
+        if waiters is not None:
+            if done is not None:
+                self.coalesced += 1
+                waiters.append(done)
+            return
+
+        waiters = self.in_flight[key] = [done] if done is not None else []
+        timeout = ioloop.IOLoop.current().call_later(self.timeout, self.give_up, key, waiters)
+        self.fetches += 1
+
+        try:
+            self.fetch(key, partial(self.complete, key, waiters, timeout))
+        except Exception as e:
+            print("trace LiveCache: fetch for", key, "raised", e)
+            self.complete(key, waiters, timeout, None)
+
+    def give_up(self, key, waiters):
+        if self.in_flight.get(key) is waiters:
+            self.timeouts += 1
+            self.complete(key, waiters, None, None)
+
+    def complete(self, key, waiters, timeout, value):
+        now = time()
+
+        if self.in_flight.get(key) is not waiters:
+            # We gave up on this fetch already, but a late answer is still good.
+            if value is not None:
+                self.entries[key] = Entry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+            return
+
+        del self.in_flight[key]
+        if timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(timeout)
+
+        if value is not None:
+            entry = Entry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        else:
+            self.failures += 1
+            entry = self.entries.get(key)
+            if entry is not None and entry.value is not None and now < entry.stale_until:
+                entry = Entry(entry.value, now + self.negative_ttl, entry.stale_until)
+            else:
+                entry = Entry(None, now + self.negative_ttl, now + self.negative_ttl)
+        self.entries[key] = entry
+
+        for done in waiters:
+            ioloop.IOLoop.current().add_callback(done, entry.value)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "in_flight": len(self.in_flight),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "fetches": self.fetches,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+        }
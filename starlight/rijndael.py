@@ -1,389 +1,475 @@
-# Authors:
-#   Bram Cohen - main author
-#   Trevor Perrin - minor changes for Python compatibility
-#
-# See the LICENSE file for legal information regarding use of this file.
-# Also see Bram Cohen's statement below
-
-################ RIJNDAEL ###
-# Trevor edited below code for python 3, and ease of packaging
-
-"""
-A pure python (slow) implementation of rijndael with a decent interface
-
-To include -
-
-from rijndael import rijndael
-
-To do a key setup -
-
-r = rijndael(key, block_size = 16)
-
-key must be a string of length 16, 24, or 32
-blocksize must be 16, 24, or 32. Default is 16
-
-To use -
-
-ciphertext = r.encrypt(plaintext)
-plaintext = r.decrypt(ciphertext)
-
-If any strings are of the wrong length a ValueError is thrown
-"""
-
-# ported from the Java reference code by Bram Cohen, bram@gawth.com, April 2001
-# this code is public domain, unless someone makes
-# an intellectual property claim against the reference
-# code, in which case it can be made public domain by
-# deleting all the comments and renaming all the variables
-
-import copy
-
-
-
-#TREV 2011 - is this still needed? seems not
-#-----------------------
-#TREV - ADDED BECAUSE THERE'S WARNINGS ABOUT INT OVERFLOW BEHAVIOR CHANGING IN
-#2.4.....
-#import os
-#if os.name != "java":
-#    import exceptions
-#    if hasattr(exceptions, "FutureWarning"):
-#        import warnings
-#        warnings.filterwarnings("ignore", category=FutureWarning, append=1)
-#-----------------------
-
-
-
-shifts = [[[0, 0], [1, 3], [2, 2], [3, 1]],
-          [[0, 0], [1, 5], [2, 4], [3, 3]],
-          [[0, 0], [1, 7], [3, 5], [4, 4]]]
-
-# [keysize][block_size]
-num_rounds = {16: {16: 10, 24: 12, 32: 14}, 
-24: {16: 12, 24: 12, 32: 14}, 32: {16: 14, 24: 14, 32: 14}}
-
-A = [[1, 1, 1, 1, 1, 0, 0, 0],
-     [0, 1, 1, 1, 1, 1, 0, 0],
-     [0, 0, 1, 1, 1, 1, 1, 0],
-     [0, 0, 0, 1, 1, 1, 1, 1],
-     [1, 0, 0, 0, 1, 1, 1, 1],
-     [1, 1, 0, 0, 0, 1, 1, 1],
-     [1, 1, 1, 0, 0, 0, 1, 1],
-     [1, 1, 1, 1, 0, 0, 0, 1]]
-
-# produce log and alog tables, needed for multiplying in the
-# field GF(2^m) (generator = 3)
-alog = [1]
-for i in range(255):
-    j = (alog[-1] << 1) ^ alog[-1]
-    if j & 0x100 != 0:
-        j ^= 0x11B
-    alog.append(j)
-
-log = [0] * 256
-for i in range(1, 255):
-    log[alog[i]] = i
-
-# multiply two elements of GF(2^m)
-def mul(a, b):
-    if a == 0 or b == 0:
-        return 0
-    return alog[(log[a & 0xFF] + log[b & 0xFF]) % 255]
-
-# substitution box based on F^{-1}(x)
-box = [[0] * 8 for i in range(256)]
-box[1][7] = 1
-for i in range(2, 256):
-    j = alog[255 - log[i]]
-    for t in range(8):
-        box[i][t] = (j >> (7 - t)) & 0x01
-
-B = [0, 1, 1, 0, 0, 0, 1, 1]
-
-# affine transform:  box[i] <- B + A*box[i]
-cox = [[0] * 8 for i in range(256)]
-for i in range(256):
-    for t in range(8):
-        cox[i][t] = B[t]
-        for j in range(8):
-            cox[i][t] ^= A[t][j] * box[i][j]
-
-# S-boxes and inverse S-boxes
-S =  [0] * 256
-Si = [0] * 256
-for i in range(256):
-    S[i] = cox[i][0] << 7
-    for t in range(1, 8):
-        S[i] ^= cox[i][t] << (7-t)
-    Si[S[i] & 0xFF] = i
-
-# T-boxes
-G = [[2, 1, 1, 3],
-    [3, 2, 1, 1],
-    [1, 3, 2, 1],
-    [1, 1, 3, 2]]
-
-AA = [[0] * 8 for i in range(4)]
-
-for i in range(4):
-    for j in range(4):
-        AA[i][j] = G[i][j]
-        AA[i][i+4] = 1
-
-for i in range(4):
-    pivot = AA[i][i]
-    if pivot == 0:
-        t = i + 1
-        while AA[t][i] == 0 and t < 4:
-            t += 1
-            assert t != 4, 'G matrix must be invertible'
-            for j in range(8):
-                AA[i][j], AA[t][j] = AA[t][j], AA[i][j]
-            pivot = AA[i][i]
-    for j in range(8):
-        if AA[i][j] != 0:
-            AA[i][j] = alog[(255 + log[AA[i][j] & 0xFF] - log[pivot & 0xFF]) % 255]
-    for t in range(4):
-        if i != t:
-            for j in range(i+1, 8):
-                AA[t][j] ^= mul(AA[i][j], AA[t][i])
-            AA[t][i] = 0
-
-iG = [[0] * 4 for i in range(4)]
-
-for i in range(4):
-    for j in range(4):
-        iG[i][j] = AA[i][j + 4]
-
-def mul4(a, bs):
-    if a == 0:
-        return 0
-    r = 0
-    for b in bs:
-        r <<= 8
-        if b != 0:
-            r = r | mul(a, b)
-    return r
-
-T1 = []
-T2 = []
-T3 = []
-T4 = []
-T5 = []
-T6 = []
-T7 = []
-T8 = []
-U1 = []
-U2 = []
-U3 = []
-U4 = []
-
-for t in range(256):
-    s = S[t]
-    T1.append(mul4(s, G[0]))
-    T2.append(mul4(s, G[1]))
-    T3.append(mul4(s, G[2]))
-    T4.append(mul4(s, G[3]))
-
-    s = Si[t]
-    T5.append(mul4(s, iG[0]))
-    T6.append(mul4(s, iG[1]))
-    T7.append(mul4(s, iG[2]))
-    T8.append(mul4(s, iG[3]))
-
-    U1.append(mul4(t, iG[0]))
-    U2.append(mul4(t, iG[1]))
-    U3.append(mul4(t, iG[2]))
-    U4.append(mul4(t, iG[3]))
-
-# round constants
-rcon = [1]
-r = 1
-for t in range(1, 30):
-    r = mul(2, r)
-    rcon.append(r)
-
-del A
-del AA
-del pivot
-del B
-del G
-del box
-del log
-del alog
-del i
-del j
-del r
-del s
-del t
-del mul
-del mul4
-del cox
-del iG
-
-class rijndael:
-    def __init__(self, key, block_size = 16):
-        if block_size != 16 and block_size != 24 and block_size != 32:
-            raise ValueError('Invalid block size: ' + str(block_size))
-        if len(key) != 16 and len(key) != 24 and len(key) != 32:
-            raise ValueError('Invalid key size: ' + str(len(key)))
-        self.block_size = block_size
-
-        ROUNDS = num_rounds[len(key)][block_size]
-        BC = block_size // 4
-        # encryption round keys
-        Ke = [[0] * BC for i in range(ROUNDS + 1)]
-        # decryption round keys
-        Kd = [[0] * BC for i in range(ROUNDS + 1)]
-        ROUND_KEY_COUNT = (ROUNDS + 1) * BC
-        KC = len(key) // 4
-
-        # copy user material bytes into temporary ints
-        tk = []
-        for i in range(0, KC):
-            tk.append((key[i * 4] << 24) | (key[i * 4 + 1] << 16) |
-                (key[i * 4 + 2]) << 8 | key[i * 4 + 3])
-
-        # copy values into round key arrays
-        t = 0
-        j = 0
-        while j < KC and t < ROUND_KEY_COUNT:
-            Ke[t // BC][t % BC] = tk[j]
-            Kd[ROUNDS - (t // BC)][t % BC] = tk[j]
-            j += 1
-            t += 1
-        tt = 0
-        rconpointer = 0
-        while t < ROUND_KEY_COUNT:
-            # extrapolate using phi (the round key evolution function)
-            tt = tk[KC - 1]
-            tk[0] ^= (S[(tt >> 16) & 0xFF] & 0xFF) << 24 ^  \
-                     (S[(tt >>  8) & 0xFF] & 0xFF) << 16 ^  \
-                     (S[ tt        & 0xFF] & 0xFF) <<  8 ^  \
-                     (S[(tt >> 24) & 0xFF] & 0xFF)       ^  \
-                     (rcon[rconpointer]    & 0xFF) << 24
-            rconpointer += 1
-            if KC != 8:
-                for i in range(1, KC):
-                    tk[i] ^= tk[i-1]
-            else:
-                for i in range(1, KC // 2):
-                    tk[i] ^= tk[i-1]
-                tt = tk[KC // 2 - 1]
-                tk[KC // 2] ^= (S[ tt        & 0xFF] & 0xFF)       ^ \
-                              (S[(tt >>  8) & 0xFF] & 0xFF) <<  8 ^ \
-                              (S[(tt >> 16) & 0xFF] & 0xFF) << 16 ^ \
-                              (S[(tt >> 24) & 0xFF] & 0xFF) << 24
-                for i in range(KC // 2 + 1, KC):
-                    tk[i] ^= tk[i-1]
-            # copy values into round key arrays
-            j = 0
-            while j < KC and t < ROUND_KEY_COUNT:
-                Ke[t // BC][t % BC] = tk[j]
-                Kd[ROUNDS - (t // BC)][t % BC] = tk[j]
-                j += 1
-                t += 1
-        # inverse MixColumn where needed
-        for r in range(1, ROUNDS):
-            for j in range(BC):
-                tt = Kd[r][j]
-                Kd[r][j] = U1[(tt >> 24) & 0xFF] ^ \
-                           U2[(tt >> 16) & 0xFF] ^ \
-                           U3[(tt >>  8) & 0xFF] ^ \
-                           U4[ tt        & 0xFF]
-        self.Ke = Ke
-        self.Kd = Kd
-
-    def encrypt(self, plaintext):
-        if len(plaintext) != self.block_size:
-            raise ValueError('wrong block length, expected ' + 
-                str(self.block_size) + ' got ' + str(len(plaintext)))
-        Ke = self.Ke
-
-        BC = self.block_size // 4
-        ROUNDS = len(Ke) - 1
-        if BC == 4:
-            SC = 0
-        elif BC == 6:
-            SC = 1
-        else:
-            SC = 2
-        s1 = shifts[SC][1][0]
-        s2 = shifts[SC][2][0]
-        s3 = shifts[SC][3][0]
-        a = [0] * BC
-        # temporary work array
-        t = []
-        # plaintext to ints + key
-        for i in range(BC):
-            t.append((plaintext[i * 4    ] << 24 |
-                      plaintext[i * 4 + 1] << 16 |
-                      plaintext[i * 4 + 2] <<  8 |
-                      plaintext[i * 4 + 3]        ) ^ Ke[0][i])
-        # apply round transforms
-        for r in range(1, ROUNDS):
-            for i in range(BC):
-                a[i] = (T1[(t[ i           ] >> 24) & 0xFF] ^
-                        T2[(t[(i + s1) % BC] >> 16) & 0xFF] ^
-                        T3[(t[(i + s2) % BC] >>  8) & 0xFF] ^
-                        T4[ t[(i + s3) % BC]        & 0xFF]  ) ^ Ke[r][i]
-            t = copy.copy(a)
-        # last round is special
-        result = []
-        for i in range(BC):
-            tt = Ke[ROUNDS][i]
-            result.append((S[(t[ i           ] >> 24) & 0xFF] ^ (tt >> 24)) & 0xFF)
-            result.append((S[(t[(i + s1) % BC] >> 16) & 0xFF] ^ (tt >> 16)) & 0xFF)
-            result.append((S[(t[(i + s2) % BC] >>  8) & 0xFF] ^ (tt >>  8)) & 0xFF)
-            result.append((S[ t[(i + s3) % BC]        & 0xFF] ^  tt       ) & 0xFF)
-        return bytearray(result)
-
-    def decrypt(self, ciphertext):
-        if len(ciphertext) != self.block_size:
-            raise ValueError('wrong block length, expected ' + 
-                str(self.block_size) + ' got ' + str(len(ciphertext)))
-        Kd = self.Kd
-
-        BC = self.block_size // 4
-        ROUNDS = len(Kd) - 1
-        if BC == 4:
-            SC = 0
-        elif BC == 6:
-            SC = 1
-        else:
-            SC = 2
-        s1 = shifts[SC][1][1]
-        s2 = shifts[SC][2][1]
-        s3 = shifts[SC][3][1]
-        a = [0] * BC
-        # temporary work array
-        t = [0] * BC
-        # ciphertext to ints + key
-        for i in range(BC):
-            t[i] = (ciphertext[i * 4    ] << 24 |
-                    ciphertext[i * 4 + 1] << 16 |
-                    ciphertext[i * 4 + 2] <<  8 |
-                    ciphertext[i * 4 + 3]        ) ^ Kd[0][i]
-        # apply round transforms
-        for r in range(1, ROUNDS):
-            for i in range(BC):
-                a[i] = (T5[(t[ i           ] >> 24) & 0xFF] ^
-                        T6[(t[(i + s1) % BC] >> 16) & 0xFF] ^
-                        T7[(t[(i + s2) % BC] >>  8) & 0xFF] ^
-                        T8[ t[(i + s3) % BC]        & 0xFF]  ) ^ Kd[r][i]
-            t = copy.copy(a)
-        # last round is special
-        result = []
-        for i in range(BC):
-            tt = Kd[ROUNDS][i]
-            result.append((Si[(t[ i           ] >> 24) & 0xFF] ^ (tt >> 24)) & 0xFF)
-            result.append((Si[(t[(i + s1) % BC] >> 16) & 0xFF] ^ (tt >> 16)) & 0xFF)
-            result.append((Si[(t[(i + s2) % BC] >>  8) & 0xFF] ^ (tt >>  8)) & 0xFF)
-            result.append((Si[ t[(i + s3) % BC]        & 0xFF] ^  tt       ) & 0xFF)
-        return bytearray(result)
-
-def encrypt(key, block):
-    return rijndael(key, len(block)).encrypt(block)
-
-def decrypt(key, block):
-    return rijndael(key, len(block)).decrypt(block)
+# Authors:
+#   Bram Cohen - main author
+#   Trevor Perrin - minor changes for Python compatibility
+#
+# See the LICENSE file for legal information regarding use of this file.
+# Also see Bram Cohen's statement below
+
+################ RIJNDAEL ###
+# Trevor edited below code for python 3, and ease of packaging
+
+"""
+A pure python (slow) implementation of rijndael with a decent interface
+
+To include -
+
+from rijndael import rijndael
+
+To do a key setup -
+
+r = rijndael(key, block_size = 16)
+
+key must be a string of length 16, 24, or 32
+blocksize must be 16, 24, or 32. Default is 16
+
+To use -
+
+ciphertext = r.encrypt(plaintext)
+plaintext = r.decrypt(ciphertext)
+
+or, for any number of blocks in CBC mode (no padding is done) -
+
+ciphertext = r.encrypt_cbc(plaintext, iv)
+plaintext = r.decrypt_cbc(ciphertext, iv)
+
+If any strings are of the wrong length a ValueError is thrown
+
+Blocks are handled as 32-bit words, and each round is four T-table lookups
+per word. TEST_VECTORS has a known answer for every key and block size;
+run selftest() to check them.
+"""
+
+# ported from the Java reference code by Bram Cohen, bram@gawth.com, April 2001
+# this code is public domain, unless someone makes
+# an intellectual property claim against the reference
+# code, in which case it can be made public domain by
+# deleting all the comments and renaming all the variables
+
+import struct
+
+
+
+#TREV 2011 - is this still needed? seems not
+#-----------------------
+#TREV - ADDED BECAUSE THERE'S WARNINGS ABOUT INT OVERFLOW BEHAVIOR CHANGING IN
+#2.4.....
+#import os
+#if os.name != "java":
+#    import exceptions
+#    if hasattr(exceptions, "FutureWarning"):
+#        import warnings
+#        warnings.filterwarnings("ignore", category=FutureWarning, append=1)
+#-----------------------
+
+
+
+shifts = [[[0, 0], [1, 3], [2, 2], [3, 1]],
+          [[0, 0], [1, 5], [2, 4], [3, 3]],
+          [[0, 0], [1, 7], [3, 5], [4, 4]]]
+
+# [keysize][block_size]
+num_rounds = {16: {16: 10, 24: 12, 32: 14}, 
+24: {16: 12, 24: 12, 32: 14}, 32: {16: 14, 24: 14, 32: 14}}
+
+A = [[1, 1, 1, 1, 1, 0, 0, 0],
+     [0, 1, 1, 1, 1, 1, 0, 0],
+     [0, 0, 1, 1, 1, 1, 1, 0],
+     [0, 0, 0, 1, 1, 1, 1, 1],
+     [1, 0, 0, 0, 1, 1, 1, 1],
+     [1, 1, 0, 0, 0, 1, 1, 1],
+     [1, 1, 1, 0, 0, 0, 1, 1],
+     [1, 1, 1, 1, 0, 0, 0, 1]]
+
+# produce log and alog tables, needed for multiplying in the
+# field GF(2^m) (generator = 3)
+alog = [1]
+for i in range(255):
+    j = (alog[-1] << 1) ^ alog[-1]
+    if j & 0x100 != 0:
+        j ^= 0x11B
+    alog.append(j)
+
+log = [0] * 256
+for i in range(1, 255):
+    log[alog[i]] = i
+
+# multiply two elements of GF(2^m)
+def mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return alog[(log[a & 0xFF] + log[b & 0xFF]) % 255]
+
+# substitution box based on F^{-1}(x)
+box = [[0] * 8 for i in range(256)]
+box[1][7] = 1
+for i in range(2, 256):
+    j = alog[255 - log[i]]
+    for t in range(8):
+        box[i][t] = (j >> (7 - t)) & 0x01
+
+B = [0, 1, 1, 0, 0, 0, 1, 1]
+
+# affine transform:  box[i] <- B + A*box[i]
+cox = [[0] * 8 for i in range(256)]
+for i in range(256):
+    for t in range(8):
+        cox[i][t] = B[t]
+        for j in range(8):
+            cox[i][t] ^= A[t][j] * box[i][j]
+
+# S-boxes and inverse S-boxes
+S =  [0] * 256
+Si = [0] * 256
+for i in range(256):
+    S[i] = cox[i][0] << 7
+    for t in range(1, 8):
+        S[i] ^= cox[i][t] << (7-t)
+    Si[S[i] & 0xFF] = i
+
+# T-boxes
+G = [[2, 1, 1, 3],
+    [3, 2, 1, 1],
+    [1, 3, 2, 1],
+    [1, 1, 3, 2]]
+
+AA = [[0] * 8 for i in range(4)]
+
+for i in range(4):
+    for j in range(4):
+        AA[i][j] = G[i][j]
+        AA[i][i+4] = 1
+
+for i in range(4):
+    pivot = AA[i][i]
+    if pivot == 0:
+        t = i + 1
+        while AA[t][i] == 0 and t < 4:
+            t += 1
+            assert t != 4, 'G matrix must be invertible'
+            for j in range(8):
+                AA[i][j], AA[t][j] = AA[t][j], AA[i][j]
+            pivot = AA[i][i]
+    for j in range(8):
+        if AA[i][j] != 0:
+            AA[i][j] = alog[(255 + log[AA[i][j] & 0xFF] - log[pivot & 0xFF]) % 255]
+    for t in range(4):
+        if i != t:
+            for j in range(i+1, 8):
+                AA[t][j] ^= mul(AA[i][j], AA[t][i])
+            AA[t][i] = 0
+
+iG = [[0] * 4 for i in range(4)]
+
+for i in range(4):
+    for j in range(4):
+        iG[i][j] = AA[i][j + 4]
+
+def mul4(a, bs):
+    if a == 0:
+        return 0
+    r = 0
+    for b in bs:
+        r <<= 8
+        if b != 0:
+            r = r | mul(a, b)
+    return r
+
+T1 = []
+T2 = []
+T3 = []
+T4 = []
+T5 = []
+T6 = []
+T7 = []
+T8 = []
+U1 = []
+U2 = []
+U3 = []
+U4 = []
+
+for t in range(256):
+    s = S[t]
+    T1.append(mul4(s, G[0]))
+    T2.append(mul4(s, G[1]))
+    T3.append(mul4(s, G[2]))
+    T4.append(mul4(s, G[3]))
+
+    s = Si[t]
+    T5.append(mul4(s, iG[0]))
+    T6.append(mul4(s, iG[1]))
+    T7.append(mul4(s, iG[2]))
+    T8.append(mul4(s, iG[3]))
+
+    U1.append(mul4(t, iG[0]))
+    U2.append(mul4(t, iG[1]))
+    U3.append(mul4(t, iG[2]))
+    U4.append(mul4(t, iG[3]))
+
+# S-boxes pre-shifted into each byte of a word, for the last round
+S24 = [s << 24 for s in S]
+S16 = [s << 16 for s in S]
+S8 = [s << 8 for s in S]
+Si24 = [s << 24 for s in Si]
+Si16 = [s << 16 for s in Si]
+Si8 = [s << 8 for s in Si]
+
+# round constants
+rcon = [1]
+r = 1
+for t in range(1, 30):
+    r = mul(2, r)
+    rcon.append(r)
+
+del A
+del AA
+del pivot
+del B
+del G
+del box
+del log
+del alog
+del i
+del j
+del r
+del s
+del t
+del mul
+del mul4
+del cox
+del iG
+
+class rijndael:
+    def __init__(self, key, block_size = 16):
+        if block_size != 16 and block_size != 24 and block_size != 32:
+            raise ValueError('Invalid block size: ' + str(block_size))
+        if len(key) != 16 and len(key) != 24 and len(key) != 32:
+            raise ValueError('Invalid key size: ' + str(len(key)))
+        self.block_size = block_size
+
+        ROUNDS = num_rounds[len(key)][block_size]
+        BC = block_size // 4
+        # encryption round keys
+        Ke = [[0] * BC for i in range(ROUNDS + 1)]
+        # decryption round keys
+        Kd = [[0] * BC for i in range(ROUNDS + 1)]
+        ROUND_KEY_COUNT = (ROUNDS + 1) * BC
+        KC = len(key) // 4
+
+        # copy user material bytes into temporary ints
+        tk = []
+        for i in range(0, KC):
+            tk.append((key[i * 4] << 24) | (key[i * 4 + 1] << 16) |
+                (key[i * 4 + 2]) << 8 | key[i * 4 + 3])
+
+        # copy values into round key arrays
+        t = 0
+        j = 0
+        while j < KC and t < ROUND_KEY_COUNT:
+            Ke[t // BC][t % BC] = tk[j]
+            Kd[ROUNDS - (t // BC)][t % BC] = tk[j]
+            j += 1
+            t += 1
+        tt = 0
+        rconpointer = 0
+        while t < ROUND_KEY_COUNT:
+            # extrapolate using phi (the round key evolution function)
+            tt = tk[KC - 1]
+            tk[0] ^= (S[(tt >> 16) & 0xFF] & 0xFF) << 24 ^  \
+                     (S[(tt >>  8) & 0xFF] & 0xFF) << 16 ^  \
+                     (S[ tt        & 0xFF] & 0xFF) <<  8 ^  \
+                     (S[(tt >> 24) & 0xFF] & 0xFF)       ^  \
+                     (rcon[rconpointer]    & 0xFF) << 24
+            rconpointer += 1
+            if KC != 8:
+                for i in range(1, KC):
+                    tk[i] ^= tk[i-1]
+            else:
+                for i in range(1, KC // 2):
+                    tk[i] ^= tk[i-1]
+                tt = tk[KC // 2 - 1]
+                tk[KC // 2] ^= (S[ tt        & 0xFF] & 0xFF)       ^ \
+                              (S[(tt >>  8) & 0xFF] & 0xFF) <<  8 ^ \
+                              (S[(tt >> 16) & 0xFF] & 0xFF) << 16 ^ \
+                              (S[(tt >> 24) & 0xFF] & 0xFF) << 24
+                for i in range(KC // 2 + 1, KC):
+                    tk[i] ^= tk[i-1]
+            # copy values into round key arrays
+            j = 0
+            while j < KC and t < ROUND_KEY_COUNT:
+                Ke[t // BC][t % BC] = tk[j]
+                Kd[ROUNDS - (t // BC)][t % BC] = tk[j]
+                j += 1
+                t += 1
+        # inverse MixColumn where needed
+        for r in range(1, ROUNDS):
+            for j in range(BC):
+                tt = Kd[r][j]
+                Kd[r][j] = U1[(tt >> 24) & 0xFF] ^ \
+                           U2[(tt >> 16) & 0xFF] ^ \
+                           U3[(tt >>  8) & 0xFF] ^ \
+                           U4[ tt        & 0xFF]
+        self.Ke = Ke
+        self.Kd = Kd
+
+        # for each word of the state, the words its four bytes come from
+        # after ShiftRows (encrypting) or InvShiftRows (decrypting)
+        SC = {4: 0, 6: 1, 8: 2}[BC]
+        self.e_columns = [(i, (i + shifts[SC][1][0]) % BC, (i + shifts[SC][2][0]) % BC,
+                              (i + shifts[SC][3][0]) % BC) for i in range(BC)]
+        self.d_columns = [(i, (i + shifts[SC][1][1]) % BC, (i + shifts[SC][2][1]) % BC,
+                              (i + shifts[SC][3][1]) % BC) for i in range(BC)]
+        self.word_format = ">{0}I".format(BC)
+        if BC == 4:
+            self.encrypt_words = self.encrypt_words4
+            self.decrypt_words = self.decrypt_words4
+
+    def encrypt_words(self, t):
+        """ Encrypts one block given as a list of BC words. """
+        Ke = self.Ke
+        columns = self.e_columns
+
+        t = [w ^ k for w, k in zip(t, Ke[0])]
+        for rk in Ke[1:-1]:
+            t = [T1[t[a] >> 24] ^ T2[(t[b] >> 16) & 0xFF] ^ T3[(t[c] >> 8) & 0xFF] ^ T4[t[d] & 0xFF] ^ k
+                 for (a, b, c, d), k in zip(columns, rk)]
+        # last round is special
+        return [(S24[t[a] >> 24] | S16[(t[b] >> 16) & 0xFF] | S8[(t[c] >> 8) & 0xFF] | S[t[d] & 0xFF]) ^ k
+                for (a, b, c, d), k in zip(columns, Ke[-1])]
+
+    def decrypt_words(self, t):
+        """ Decrypts one block given as a list of BC words. """
+        Kd = self.Kd
+        columns = self.d_columns
+
+        t = [w ^ k for w, k in zip(t, Kd[0])]
+        for rk in Kd[1:-1]:
+            t = [T5[t[a] >> 24] ^ T6[(t[b] >> 16) & 0xFF] ^ T7[(t[c] >> 8) & 0xFF] ^ T8[t[d] & 0xFF] ^ k
+                 for (a, b, c, d), k in zip(columns, rk)]
+        # last round is special
+        return [(Si24[t[a] >> 24] | Si16[(t[b] >> 16) & 0xFF] | Si8[(t[c] >> 8) & 0xFF] | Si[t[d] & 0xFF]) ^ k
+                for (a, b, c, d), k in zip(columns, Kd[-1])]
+
+    def encrypt_words4(self, t):
+        """ encrypt_words unrolled for 16-byte blocks, which is all AES uses. """
+        Ke = self.Ke
+        k0, k1, k2, k3 = Ke[0]
+        s0, s1, s2, s3 = t[0] ^ k0, t[1] ^ k1, t[2] ^ k2, t[3] ^ k3
+        for k0, k1, k2, k3 in Ke[1:-1]:
+            s0, s1, s2, s3 = (
+                T1[s0 >> 24] ^ T2[(s1 >> 16) & 0xFF] ^ T3[(s2 >> 8) & 0xFF] ^ T4[s3 & 0xFF] ^ k0,
+                T1[s1 >> 24] ^ T2[(s2 >> 16) & 0xFF] ^ T3[(s3 >> 8) & 0xFF] ^ T4[s0 & 0xFF] ^ k1,
+                T1[s2 >> 24] ^ T2[(s3 >> 16) & 0xFF] ^ T3[(s0 >> 8) & 0xFF] ^ T4[s1 & 0xFF] ^ k2,
+                T1[s3 >> 24] ^ T2[(s0 >> 16) & 0xFF] ^ T3[(s1 >> 8) & 0xFF] ^ T4[s2 & 0xFF] ^ k3)
+        k0, k1, k2, k3 = Ke[-1]
+        return ((S24[s0 >> 24] | S16[(s1 >> 16) & 0xFF] | S8[(s2 >> 8) & 0xFF] | S[s3 & 0xFF]) ^ k0,
+                (S24[s1 >> 24] | S16[(s2 >> 16) & 0xFF] | S8[(s3 >> 8) & 0xFF] | S[s0 & 0xFF]) ^ k1,
+                (S24[s2 >> 24] | S16[(s3 >> 16) & 0xFF] | S8[(s0 >> 8) & 0xFF] | S[s1 & 0xFF]) ^ k2,
+                (S24[s3 >> 24] | S16[(s0 >> 16) & 0xFF] | S8[(s1 >> 8) & 0xFF] | S[s2 & 0xFF]) ^ k3)
+
+    def decrypt_words4(self, t):
+        """ decrypt_words unrolled for 16-byte blocks. """
+        Kd = self.Kd
+        k0, k1, k2, k3 = Kd[0]
+        s0, s1, s2, s3 = t[0] ^ k0, t[1] ^ k1, t[2] ^ k2, t[3] ^ k3
+        for k0, k1, k2, k3 in Kd[1:-1]:
+            s0, s1, s2, s3 = (
+                T5[s0 >> 24] ^ T6[(s3 >> 16) & 0xFF] ^ T7[(s2 >> 8) & 0xFF] ^ T8[s1 & 0xFF] ^ k0,
+                T5[s1 >> 24] ^ T6[(s0 >> 16) & 0xFF] ^ T7[(s3 >> 8) & 0xFF] ^ T8[s2 & 0xFF] ^ k1,
+                T5[s2 >> 24] ^ T6[(s1 >> 16) & 0xFF] ^ T7[(s0 >> 8) & 0xFF] ^ T8[s3 & 0xFF] ^ k2,
+                T5[s3 >> 24] ^ T6[(s2 >> 16) & 0xFF] ^ T7[(s1 >> 8) & 0xFF] ^ T8[s0 & 0xFF] ^ k3)
+        k0, k1, k2, k3 = Kd[-1]
+        return ((Si24[s0 >> 24] | Si16[(s3 >> 16) & 0xFF] | Si8[(s2 >> 8) & 0xFF] | Si[s1 & 0xFF]) ^ k0,
+                (Si24[s1 >> 24] | Si16[(s0 >> 16) & 0xFF] | Si8[(s3 >> 8) & 0xFF] | Si[s2 & 0xFF]) ^ k1,
+                (Si24[s2 >> 24] | Si16[(s1 >> 16) & 0xFF] | Si8[(s0 >> 8) & 0xFF] | Si[s3 & 0xFF]) ^ k2,
+                (Si24[s3 >> 24] | Si16[(s2 >> 16) & 0xFF] | Si8[(s1 >> 8) & 0xFF] | Si[s0 & 0xFF]) ^ k3)
+
+    def check_length(self, data, multiple=0):
+        if multiple:
+            if len(data) % self.block_size:
+                raise ValueError('wrong data length, expected a multiple of ' +
+                    str(self.block_size) + ' got ' + str(len(data)))
+        elif len(data) != self.block_size:
+            raise ValueError('wrong block length, expected ' +
+                str(self.block_size) + ' got ' + str(len(data)))
+
+    def encrypt(self, plaintext):
+        self.check_length(plaintext)
+        return bytearray(struct.pack(self.word_format,
+            *self.encrypt_words(struct.unpack(self.word_format, plaintext))))
+
+    def decrypt(self, ciphertext):
+        self.check_length(ciphertext)
+        return bytearray(struct.pack(self.word_format,
+            *self.decrypt_words(struct.unpack(self.word_format, ciphertext))))
+
+    def encrypt_cbc(self, plaintext, iv):
+        """ Encrypts any number of blocks in CBC mode. The caller pads. """
+        self.check_length(plaintext, multiple=1)
+        self.check_length(iv)
+        BC = self.block_size // 4
+        words = struct.unpack(">{0}I".format(len(plaintext) // 4), plaintext)
+
+        out = []
+        prev = struct.unpack(self.word_format, iv)
+        for i in range(0, len(words), BC):
+            prev = self.encrypt_words([w ^ p for w, p in zip(words[i:i + BC], prev)])
+            out.extend(prev)
+        return struct.pack(">{0}I".format(len(out)), *out)
+
+    def decrypt_cbc(self, ciphertext, iv):
+        """ Decrypts any number of blocks in CBC mode. The caller unpads. """
+        self.check_length(ciphertext, multiple=1)
+        self.check_length(iv)
+        BC = self.block_size // 4
+        words = struct.unpack(">{0}I".format(len(ciphertext) // 4), ciphertext)
+
+        out = []
+        prev = struct.unpack(self.word_format, iv)
+        for i in range(0, len(words), BC):
+            block = words[i:i + BC]
+            out.extend(w ^ p for w, p in zip(self.decrypt_words(block), prev))
+            prev = block
+        return struct.pack(">{0}I".format(len(out)), *out)
+
+def encrypt(key, block):
+    return rijndael(key, len(block)).encrypt(block)
+
+def decrypt(key, block):
+    return rijndael(key, len(block)).decrypt(block)
+
+# (key size, block size) -> ciphertext, for key = 00 01 02 ... and
+# plaintext = 00 11 22 ... (repeating). The 16-byte block ones are the
+# FIPS-197 appendix C examples; the rest were checked against a second,
+# independent Rijndael implementation.
+TEST_VECTORS = {
+    (16, 16): "69c4e0d86a7b0430d8cdb78070b4c55a",
+    (16, 24): "e64018d211d8349b350f38893d7d23899fece7a9aca7c6ba",
+    (16, 32): "98c6f98ba9631b91c34f431e0887c561b6ac44c985cecd38dbc4cb30b9170d2f",
+    (24, 16): "dda97ca4864cdfe06eaf70a0ec0d7191",
+    (24, 24): "78be2d48f76d71da6966f3a175fb71ad66b70b2076c3cf1d",
+    (24, 32): "3c386395e910345a59a7dd165dcbda604bf072f0a03a6b0055a79b734e668868",
+    (32, 16): "8ea2b7ca516745bfeafc49904b496089",
+    (32, 24): "65d851df8d04b5cbb510935fdd1eb17b33efb8cb255ee712",
+    (32, 32): "288fa9d23d00d9dc0a39b33fa92867c6488b5e0f18a6f74c072078ec815462e6",
+}
+
+def test_vector_input(key_size, block_size):
+    return bytes(range(key_size)), bytes((0x11 * i) & 0xFF for i in range(block_size))
+
+def selftest():
+    """ Raises AssertionError if any of TEST_VECTORS comes out wrong, either
+        way, one block at a time or as part of a CBC run. """
+    for (key_size, block_size), expect in TEST_VECTORS.items():
+        key, plain = test_vector_input(key_size, block_size)
+        expect = bytes.fromhex(expect)
+        r = rijndael(key, block_size)
+
+        assert r.encrypt(plain) == expect, ("encrypt", key_size, block_size)
+        assert r.decrypt(expect) == plain, ("decrypt", key_size, block_size)
+
+        # With a zero IV, the first CBC block is just the block cipher.
+        iv = bytes(block_size)
+        data = plain * 3
+        cipher = r.encrypt_cbc(data, iv)
+        assert cipher[:block_size] == expect, ("encrypt_cbc", key_size, block_size)
+        assert r.decrypt_cbc(cipher, iv) == data, ("decrypt_cbc", key_size, block_size)
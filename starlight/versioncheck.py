@@ -0,0 +1,117 @@
+""" Polls for truth updates in the background, instead of whenever a request
+    happens to come in.
+
+    Checks happen every `interval` seconds, on the interval boundary plus a
+    random delay of up to `jitter` seconds. Truth updates usually land on the
+    hour, and the jitter keeps several servers from asking all at once. A
+    failed check is retried after `retry_interval` seconds rather than
+    waiting for the next boundary. A check that hasn't finished after
+    `timeout` seconds counts as failed. """
+
+import random
+from time import time
+from tornado import ioloop
+
+IDLE = "idle"
+CHECKING = "checking"
+STOPPED = "stopped"
+
+class VersionCheckScheduler(object):
+    # How often the timer wakes up to see if a check is due, in seconds.
+    TICK = 10
+
+    def __init__(self, check, interval=3600, jitter=60, retry_interval=300,
+                 timeout=1800, abandon=None):
+        """ check(done) should eventually call done(error), with None for
+            success. If it doesn't within `timeout` seconds, abandon() is
+            called (so the check's owner can clean up) and done is ignored
+            if it does turn up later. """
+        self.check = check
+        self.interval = interval
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.abandon = abandon
+
+        self.state = STOPPED
+        self.timer = None
+        self.next_check = None
+        self.last_started = None
+        self.last_finished = None
+        self.last_error = None
+        self.last_error_time = None
+
+        self.checks = 0
+        self.failures = 0
+
+    def start(self):
+        """ Starts the timer on the current IOLoop. The first check is made
+            within `jitter` seconds. """
+        self.next_check = time() + random.uniform(0, self.jitter)
+        self.state = IDLE
+        self.timer = ioloop.PeriodicCallback(self.tick, self.TICK * 1000)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        self.state = STOPPED
+
+    def next_boundary(self, now):
+        return now - (now % self.interval) + self.interval + random.uniform(0, self.jitter)
+
+    def tick(self):
+        now = time()
+        if self.state == CHECKING and now - self.last_started > self.timeout:
+            if self.abandon is not None:
+                self.abandon()
+            self.finished(TimeoutError("no result after {0} seconds".format(self.timeout)))
+        elif self.state == IDLE and now >= self.next_check:
+            self.run()
+
+    def run(self):
+        self.state = CHECKING
+        self.last_started = time()
+        self.checks += 1
+
+        this_check = self.checks
+        try:
+            self.check(lambda error: self.finished(error, this_check))
+        except Exception as e:
+            self.finished(e)
+
+    def finished(self, error, check=None):
+        if check is not None and (check != self.checks or self.state != CHECKING):
+            print("trace VersionCheckScheduler: ignoring result of abandoned check", check, error)
+            return
+
+        now = time()
+        self.last_finished = now
+
+        if error is not None:
+            print("trace VersionCheckScheduler: check failed:", error)
+            self.failures += 1
+            self.last_error = str(error) or error.__class__.__name__
+            self.last_error_time = now
+            self.next_check = now + min(self.retry_interval, self.interval) + random.uniform(0, self.jitter)
+        else:
+            self.next_check = self.next_boundary(now)
+
+        if self.state == CHECKING:
+            self.state = IDLE
+
+    def status(self):
+        return {
+            "state": self.state,
+            "interval": self.interval,
+            "jitter": self.jitter,
+            "timeout": self.timeout,
+            "next_check": self.next_check,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_error": self.last_error,
+            "last_error_time": self.last_error_time,
+            "checks": self.checks,
+            "failures": self.failures,
+        }
@@ -1,65 +1,54 @@
-function load_completion_list_and_call(func) {
-    var xhr = new XMLHttpRequest()
-    xhr.open("GET", "/suggest", true)
-    xhr.onreadystatechange = function() {
-        if (xhr.readyState == 4 && xhr.status == 200) {
-            window.name_completion_list = JSON.parse(xhr.responseText)
-            func()
-        }
-    }
-    xhr.send()
+function escape_regex(s) {
+    return s.replace(/[.*+?^${}()|[\]\\]/g, "\\$&")
 }
 
-function fuzzyfinder(string, names) {
-    suggestions = []
-    pattern = string.split("").join('.*?')
-    regex = new RegExp(pattern)
+function show_suggestions(text, found) {
+    document.getElementById("suggestions").innerHTML = ""
+    var pattern = new RegExp(text.toLowerCase().split("").map(escape_regex).join(".*?"))
 
-    for (var i = 0; i < names.length; i++) {
-        var match = regex.exec(names[i])
+    for (var i = 0; i < found.length; i++) {
+        var n = document.createElement("a");
+        var aname = found[i][0]
 
+        // the server may have matched on kana or kanji, in which case
+        // there's nothing to highlight in the romaji name
+        var match = pattern.exec(aname.toLowerCase())
         if (match !== null) {
-            var len = match[0].length
-            var loc = match.index
-
-            suggestions.push([len, loc, names[i]])
+            put = "<span class='highlight'>"
+            s1 = aname.slice(0, match.index)
+            s2 = aname.slice(match.index, match.index + match[0].length)
+            s3 = aname.slice(match.index + match[0].length)
+            n.innerHTML = s1 + put + s2 + "</span>" + s3
+        } else {
+            n.textContent = aname
         }
-    }
 
-    suggestions.sort(function(a, b) {
-        return a[0] - b[0];
-    });
-    return suggestions
+        n.href = "/char/" + found[i][1]
+        document.getElementById("suggestions").appendChild(n)
+    }
 }
 
 function suggest(that, text) {
     if (!text) {
+        window.suggest_latest_query = null
         document.getElementById("suggestions").innerHTML = ""
         return
     }
 
-    if (window.name_completion_list === undefined) {
-        load_completion_list_and_call(function() { suggest(that, that.value) })
-        return
-    }
-
-    var found = fuzzyfinder(text, Object.keys(window.name_completion_list))
-    document.getElementById("suggestions").innerHTML = ""
-    console.log(found)
-
-    for (var i = 0; i < found.length; i++) {
-        var n = document.createElement("a");
+    window.suggest_latest_query = text
 
-        put = "<span class='highlight'>"
-        aname = window.name_completion_list[found[i][2]][0]
-        s1 = aname.slice(0, found[i][1])
-        s2 = aname.slice(found[i][1], found[i][1] + found[i][0])
-        s3 = aname.slice(found[i][1] + found[i][0])
+    var xhr = new XMLHttpRequest()
+    xhr.open("GET", "/suggest?limit=10&q=" + encodeURIComponent(text), true)
+    xhr.onreadystatechange = function() {
+        if (xhr.readyState == 4 && xhr.status == 200) {
+            // drop responses for queries the user has already typed past
+            if (window.suggest_latest_query !== text)
+                return
 
-        n.innerHTML = s1 + put + s2 + "</span>" + s3
-        n.href = "/char/" + window.name_completion_list[found[i][2]][1]
-        document.getElementById("suggestions").appendChild(n)
+            show_suggestions(text, JSON.parse(xhr.responseText).result)
+        }
     }
+    xhr.send()
 }
 
 // https://stackoverflow.com/questions/10073699/pad-a-number-with-leading-zeros-in-javascript
@@ -317,10 +317,26 @@ function st_sort_table_interactive(that) {
     if (reversed === "yes")
         reverse_the_sort = false;
 
+    // Paginated tables only have one page of rows here, so ask the server.
+    if (get_table().getAttribute("data-server-sort") === "yes") {
+        st_sort_table_on_server(datum_name, reverse_the_sort);
+        return;
+    }
+
     // then sort it.
     sort_table_and_update_ui(datum_name, reverse_the_sort);
 }
 
+function st_sort_table_on_server(by_datum, descending) {
+    var args = window.location.search.replace(/^\?/, "").split("&").filter(function(v) {
+        return v && !/^(sort|order|page)=/.test(v);
+    });
+
+    args.push("sort=" + encodeURIComponent(by_datum));
+    args.push("order=" + (descending? "desc" : "asc"));
+    window.location.search = "?" + args.join("&");
+}
+
 function st_init() {
     var the_table = get_table();
 
@@ -328,5 +344,14 @@ function st_init() {
         th.setAttribute("onclick", 'st_sort_table_interactive(this)');
     });
 
+    // Show which header the server sorted by.
+    var matched = /[?&]sort=(\w+)/.exec(window.location.search);
+    var th = matched && the_table.querySelector(".sort_key[data-sort-key='" + matched[1] + "']");
+    if (th) {
+        var ascending = /[?&]order=asc/.test(window.location.search);
+        th.setAttribute("data-sort-reverse", ascending? "no" : "yes");
+        th.classList.add("in_use");
+    }
+
     parse_hash();
 }
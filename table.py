@@ -307,3 +307,189 @@ def select_categories(s):
 
     fils = sorted(set(fils))
     return fils, cats
+
+### Server-side filtering, sorting and pagination.
+
+# These match the data-sort-key attributes above and SortableData in sort_table.js.
+# Datums with zeros_last sort cards with a 0 value (i.e. no skill) to the end
+# in both directions, like STANDARD_SORT_IGNORE_ZERO_FUNCTION.
+sort_datum_t = namedtuple("sort_datum_t", ("value", "zeros_last"))
+SORT_DATA = {
+    "STCardNumberDatum": sort_datum_t(lambda card: card.id, 0),
+    "STVocalStatDatum": sort_datum_t(lambda card: card.vocal_max + card.bonus_vocal, 0),
+    "STVisualStatDatum": sort_datum_t(lambda card: card.visual_max + card.bonus_visual, 0),
+    "STDanceStatDatum": sort_datum_t(lambda card: card.dance_max + card.bonus_dance, 0),
+    "STSkillTimeDatum": sort_datum_t(lambda card: card.skill.condition if card.skill else 0, 1),
+    "STSkillProcChanceDatum": sort_datum_t(lambda card: card.skill.max_chance if card.skill else 0, 1),
+    "STSkillDurationDatum": sort_datum_t(lambda card: card.skill.max_duration if card.skill else 0, 1),
+    "STSkillEffectiveValueDatum": sort_datum_t(lambda card: card.skill.value if card.skill else 0, 1),
+    "STLeadSkillUpDatum": sort_datum_t(lambda card: card.lead_skill.up_value if card.lead_skill else 0, 1),
+    # AppealsLow (B) shows level 1 stats under the same sort keys as
+    # AppealsHigh (A). parse_query switches to these when B is the one shown.
+    "STVocalStatDatum/min": sort_datum_t(lambda card: card.vocal_min, 0),
+    "STVisualStatDatum/min": sort_datum_t(lambda card: card.visual_min, 0),
+    "STDanceStatDatum/min": sort_datum_t(lambda card: card.dance_min, 0),
+}
+
+def shows_low_stats(dataset):
+    """ Whether the first stat datum in dataset (a string of uids) is
+        AppealsLow, which is the column sort_table.js would sort by. """
+    for uid in dataset:
+        if uid in "AB":
+            return uid == "B"
+    return 0
+
+# query argument -> filter. The argument is a comma-separated list of the
+# option kill classes to keep, e.g. ?attribute=Cute_kc,Cool_kc
+FACETS = {
+    "attribute": card_attribute,
+    "rarity": rarity,
+    "skill_type": skill_type,
+    "high_stat": high_stat,
+    "ls_target_type": ls_target_type,
+    "ls_target_stat": ls_target_stat,
+}
+
+# Card sets whose orderings are kept between requests. All of them are
+# filters over the chain heads.
+BASES = {
+    "all": lambda card: True,
+    "skill": lambda card: card.skill is not None,
+    "lead_skill": lambda card: card.lead_skill is not None,
+}
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 500
+
+# facets is a sorted tuple of (argument, frozenset of kill classes).
+# page=None means everything on one page.
+table_query_t = namedtuple("table_query_t", ("facets", "sort", "descending", "page", "per_page"))
+page_t = namedtuple("page_t", ("page", "pages", "per_page", "total"))
+
+def parse_query(get_argument, dataset=""):
+    """ Reads a table_query_t from the request arguments. Returns None if
+        none of them were given, and raises ValueError if one is bad.
+        dataset is the uids of the table's datums, if it's shown as one. """
+    given = 0
+
+    facets = []
+    for name, facet in sorted(FACETS.items()):
+        arg = get_argument(name, None)
+        if arg is None:
+            continue
+        given = 1
+
+        wanted = set(filter(bool, arg.split(",")))
+        classes = set()
+        for option in facet.options:
+            option_classes = option.kill_class.split()
+            if wanted.intersection(option_classes):
+                classes.update(option_classes)
+                wanted.difference_update(option_classes)
+        if wanted:
+            raise ValueError("unknown {0} value(s): {1}".format(name, ", ".join(sorted(wanted))))
+        facets.append((name, frozenset(classes)))
+
+    sort = get_argument("sort", None)
+    if sort is not None:
+        given = 1
+        if sort not in SORT_DATA or "/" in sort:
+            raise ValueError("can't sort by {0}".format(sort))
+        if sort + "/min" in SORT_DATA and shows_low_stats(dataset):
+            sort += "/min"
+
+    order = get_argument("order", "desc")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+
+    page = get_argument("page", None)
+    per_page = get_argument("per_page", None)
+    if page is not None or per_page is not None:
+        given = 1
+        try:
+            page = int(page or 1)
+            per_page = int(per_page or DEFAULT_PER_PAGE)
+        except ValueError:
+            raise ValueError("page and per_page must be numbers")
+        if page < 1 or not (0 < per_page <= MAX_PER_PAGE):
+            raise ValueError("page must be at least 1, and per_page between 1 and {0}".format(MAX_PER_PAGE))
+
+    if not given:
+        return None
+    return table_query_t(tuple(facets), sort, order == "desc", page, per_page)
+
+def sort_key(sort, descending):
+    value, zeros_last = SORT_DATA[sort]
+    sign = -1 if descending else 1
+    if zeros_last:
+        return lambda card: (value(card) == 0, sign * value(card), card.id)
+    return lambda card: (sign * value(card), card.id)
+
+class CardIndex(object):
+    """ Sorted orderings of the BASES card sets for one truth version, plus
+        each card's facet classes, so a table query is a walk over a list we
+        already have. """
+    def __init__(self, version):
+        self.version = version
+        self.orderings = {}
+        self.classes = {name: {} for name in FACETS}
+
+    def ordering(self, base, cards, sort, descending):
+        key = (base, sort, descending if sort else None)
+        ret = self.orderings.get(key)
+        if ret is None:
+            ret = list(cards)
+            if sort:
+                ret.sort(key=sort_key(sort, descending))
+            self.orderings[key] = ret
+        return ret
+
+    def facet_class(self, name, card):
+        known = self.classes[name]
+        ret = known.get(card.id, known)
+        if ret is known:
+            ret = known[card.id] = FACETS[name].gen_object_class(card)
+        return ret
+
+    def matches(self, card, facets):
+        # Cards without a class for a facet (no skill, say) are never hidden
+        # by it, same as toggle_kill_css in sort_table.js.
+        for name, classes in facets:
+            cls = self.facet_class(name, card)
+            if cls is not None and cls not in classes:
+                return 0
+        return 1
+
+    def select(self, cards, query, base=None):
+        """ Filters, sorts and slices cards according to query. If base is
+            given, it's used as the cache key for the ordering of cards, and
+            cards is only read the first time. Returns (cards, page_t). """
+        if base is not None:
+            ordered = self.ordering(base, cards, query.sort, query.descending)
+        else:
+            ordered = list(cards)
+            if query.sort:
+                ordered.sort(key=sort_key(query.sort, query.descending))
+
+        if query.facets:
+            ordered = [card for card in ordered if self.matches(card, query.facets)]
+
+        total = len(ordered)
+        if query.page is None:
+            return ordered, page_t(1, 1, total, total)
+
+        pages = max(1, -(-total // query.per_page))
+        start = (query.page - 1) * query.per_page
+        return ordered[start:start + query.per_page], page_t(query.page, pages, query.per_page, total)
+
+_index = None
+
+def card_index():
+    global _index
+
+    if _index is None or _index.version != starlight.data.version:
+        _index = CardIndex(starlight.data.version)
+    return _index
+
+def base_cards(base):
+    return filter(BASES[base], starlight.data.iter_cards(starlight.data.all_chain_ids()))
@@ -0,0 +1,133 @@
+""" Coalesces read_tl lookups.
+
+    Every card page asks read_tl for the same skill names, titles and so on,
+    so when lots of pages are loading at once they mostly want the same keys.
+    Keys requested within `window` seconds of each other are looked up in a
+    single query, and a request for a key that's already being looked up
+    waits for that query instead of starting another one. Queries run on a
+    worker thread with their own TranslationSQL, so the IOLoop doesn't block
+    on the database. """
+
+import time
+import functools
+import tornado.gen
+import tornado.ioloop
+from tornado.concurrent import Future
+from concurrent.futures import ThreadPoolExecutor
+import models
+import metrics
+
+class TranslationBatcher(object):
+    WINDOW = 0.005
+    # A batch is sent early if it gets this big, to keep the IN (...) sane.
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, connect_url=None, window=None):
+        # TranslationSQL isn't thread safe, so the worker gets its own.
+        self.reader = models.TranslationSQL(connect_url)
+        self.executor = ThreadPoolExecutor(1)
+        self.window = self.WINDOW if window is None else window
+
+        self.pending_keys = set()
+        self.pending = None
+        self.pending_timeout = None
+        # key -> Future of the query that's looking it up
+        self.in_flight = {}
+
+        self.requests = 0
+        self.keys_requested = 0
+        self.keys_shared = 0
+        self.batches = 0
+        self.keys_queried = 0
+        self.keys_found = 0
+
+    def lookup(self, keys):
+        """ Returns a Future that resolves to {key: translation} for the
+            keys that have one. """
+        keys = set(keys)
+        waits = set()
+
+        self.requests += 1
+        self.keys_requested += len(keys)
+
+        for key in keys:
+            batch = self.in_flight.get(key)
+            if batch is None and key in self.pending_keys:
+                batch = self.pending
+
+            if batch is not None:
+                self.keys_shared += 1
+            else:
+                if self.pending is None:
+                    self.pending = Future()
+                    self.pending_timeout = tornado.ioloop.IOLoop.current().call_later(
+                        self.window, self.flush)
+                self.pending_keys.add(key)
+                batch = self.pending
+                # Checked per key, so one big request is split up too.
+                if len(self.pending_keys) >= self.MAX_BATCH_SIZE:
+                    self.flush()
+            waits.add(batch)
+
+        return self.gather(keys, list(waits))
+
+    @tornado.gen.coroutine
+    def gather(self, keys, waits):
+        merged = {}
+        for result in (yield waits):
+            merged.update(result)
+        return {key: merged[key] for key in keys if key in merged}
+
+    def flush(self):
+        if self.pending is None:
+            return
+
+        tornado.ioloop.IOLoop.current().remove_timeout(self.pending_timeout)
+        keys, batch = self.pending_keys, self.pending
+        self.pending_keys, self.pending, self.pending_timeout = set(), None, None
+
+        for key in keys:
+            self.in_flight[key] = batch
+        self.batches += 1
+        self.keys_queried += len(keys)
+
+        query = self.executor.submit(self.query, sorted(keys))
+        tornado.ioloop.IOLoop.current().add_future(query,
+            functools.partial(self.finish_batch, keys, batch))
+
+    def finish_batch(self, keys, batch, query):
+        for key in keys:
+            if self.in_flight.get(key) is batch:
+                del self.in_flight[key]
+
+        try:
+            elapsed, result = query.result()
+        except Exception as e:
+            batch.set_exception(e)
+            return
+
+        metrics.observe("TranslationBatcher", "db", elapsed)
+        self.keys_found += len(result)
+        batch.set_result(result)
+
+    def query(self, keys):
+        # runs on the worker thread
+        start = time.perf_counter()
+        result = {}
+        def done(entries):
+            result.update((tlo.key, tlo.english) for tlo in entries if tlo.english != tlo.key)
+        self.reader.translate(done, *keys)
+        return time.perf_counter() - start, result
+
+    def stats(self):
+        """ coalescing_ratio is keys asked for per key actually queried. """
+        return {
+            "requests": self.requests,
+            "keys_requested": self.keys_requested,
+            "keys_shared": self.keys_shared,
+            "batches": self.batches,
+            "keys_queried": self.keys_queried,
+            "keys_found": self.keys_found,
+            "in_flight": len(self.in_flight),
+            "coalescing_ratio": self.keys_requested / self.keys_queried if self.keys_queried else None,
+        }
@@ -0,0 +1,75 @@
+""" Decides whether a User-Agent belongs to a phone or tablet, for
+    request.is_low_bandwidth.
+
+    user_agents.parse runs a long list of regexes, and we see the same few
+    hundred UA strings all day, so results are kept in an LRU keyed by the
+    raw string. Before falling back to user_agents, the common shapes of
+    mobile and desktop browser UAs are recognized by one regex each. Anything
+    unusual (bots, TVs, consoles, e-readers...) is left to user_agents. """
+
+import re
+from collections import OrderedDict
+import user_agents
+
+# iOS devices, and Android phones (Chrome and friends say "Mobile Safari").
+FAST_MOBILE = re.compile(r"^Mozilla/5\.0 \((?:iPhone|iPad|iPod(?: touch)?); (?:U; )?CPU "
+                         r"|^Mozilla/5\.0 \(Linux; (?:U; )?Android [0-9.]+;[^)]*\) AppleWebKit/[0-9.]+ "
+                         r"\(KHTML, like Gecko\) (?:Version/[0-9.]+ )?Chrome/[0-9.]+ Mobile Safari/[0-9.]+$")
+# Windows, Mac and Linux desktop browsers.
+FAST_DESKTOP = re.compile(r"^Mozilla/5\.0 \((?:Windows NT [0-9.]+(?:; (?:Win64; x64|WOW64))?"
+                          r"|Macintosh; Intel Mac OS X [0-9_.]+"
+                          r"|X11; (?:Ubuntu; )?Linux x86_64)(?:; rv:[0-9.]+)?\) "
+                          r"(?:AppleWebKit/[0-9.]+ \(KHTML, like Gecko\)|Gecko/[0-9]+)"
+                          r"[A-Za-z0-9/. ]*$")
+# Things the fast path shouldn't guess about, even if the rest looks normal.
+NOT_FAST_WORDS = ("bot", "crawl", "spider", "slurp", "mobile", "tablet", "touch",
+                  "android", "kindle", "silk", "tv", "playstation", "nintendo", "xbox")
+
+class UserAgentClassifier(object):
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+
+        self.cache_hits = 0
+        self.fast_path = 0
+        self.parsed = 0
+        self.evictions = 0
+
+    def classify(self, ua):
+        """ 1 if ua is a phone or tablet, 0 otherwise. Not cached. """
+        if FAST_DESKTOP.match(ua):
+            lowered = ua.lower()
+            if not any(word in lowered for word in NOT_FAST_WORDS):
+                self.fast_path += 1
+                return 0
+        elif FAST_MOBILE.match(ua) and "bot" not in ua.lower():
+            self.fast_path += 1
+            return 1
+
+        self.parsed += 1
+        parsed = user_agents.parse(ua)
+        return 1 if parsed.is_mobile or parsed.is_tablet else 0
+
+    def is_low_bandwidth(self, ua):
+        ret = self.cache.get(ua)
+        if ret is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(ua)
+            return ret
+
+        ret = self.cache[ua] = self.classify(ua)
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+        return ret
+
+    def stats(self):
+        return {
+            "entries": len(self.cache),
+            "cache_hits": self.cache_hits,
+            "fast_path": self.fast_path,
+            "parsed": self.parsed,
+            "evictions": self.evictions,
+        }
+
+CLASSIFIER = UserAgentClassifier()
@@ -0,0 +1,55 @@
+""" Startup warm-up: does the work that the first requests after a deploy
+    would otherwise pay for, and times each part of starting up. """
+
+import os
+import time
+from contextlib import contextmanager
+
+class StartupTimer(object):
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.last = self.started
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.last = time.perf_counter()
+            self.phases.append((name, self.last - start))
+
+    def mark(self, name):
+        """ Records the time since the last phase ended (or since started) as
+            a phase, for work that isn't convenient to wrap in a with block. """
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.started
+
+    def report(self):
+        for name, seconds in self.phases:
+            print("trace startup: {0:<12} {1:9.1f} ms".format(name, seconds * 1000))
+        print("trace startup: {0:<12} {1:9.1f} ms".format("total", self.total() * 1000))
+
+def compile_templates(loader, root):
+    """ Compiles every template under root into loader's cache. Returns the
+        number compiled. A template that fails is reported and skipped; the
+        request that uses it will fail the same way. """
+    count = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if not filename.endswith(".html"):
+                continue
+
+            name = os.path.relpath(os.path.join(dirpath, filename), root)
+            try:
+                loader.load(name)
+            except Exception as e:
+                print("trace warmup: couldn't compile {0}: {1}".format(name, e))
+            else:
+                count += 1
+    return count